@@ -1,7 +1,5 @@
 import os
 import sys
-import csv
-import io
 import json
 import time
 import hmac
@@ -10,17 +8,26 @@ import base64
 import hashlib
 import logging
 import asyncio
-import threading
-
-from datetime import datetime
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import signal
+import socket
+import tempfile
+import zlib
+import contextvars
+
+from collections import OrderedDict, deque
+from collections.abc import Awaitable, Callable
+from datetime import date, datetime, timedelta, timezone
+from types import MappingProxyType
 from urllib.parse import urlencode, urlsplit, urlunsplit, parse_qsl
 from zoneinfo import ZoneInfo
 
 import aiohttp
 import asyncpg
 
+from aiohttp import web
+
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.dispatcher.middlewares.base import BaseMiddleware
 from aiogram.enums import ContentType
 from aiogram.exceptions import (
@@ -30,8 +37,9 @@ from aiogram.exceptions import (
     TelegramRetryAfter,
 )
 from aiogram.filters import Command
-from aiogram.types import BufferedInputFile
+from aiogram.types import FSInputFile
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 
 
 # ============================================================================
@@ -87,6 +95,38 @@ RESTART_MINUTES = int(
     )
 )
 
+# Перезапуск по памяти и дескрипторам. 0 — проверка отключена.
+RESTART_MAX_RSS_MB = int(
+    os.getenv(
+        "RESTART_MAX_RSS_MB",
+        "450",
+    )
+)
+
+RESTART_MAX_OPEN_FDS = int(
+    os.getenv(
+        "RESTART_MAX_OPEN_FDS",
+        "900",
+    )
+)
+
+# Сколько секунд ждать завершения начатых обработчиков и очередей.
+RESTART_DRAIN_SECONDS = int(
+    os.getenv(
+        "RESTART_DRAIN_SECONDS",
+        "25",
+    )
+)
+
+# exec — перезапуск в том же процессе, exit — выход,
+# после которого процесс поднимет платформа.
+RESTART_MODE = os.getenv(
+    "RESTART_MODE",
+    "exec",
+).strip().lower()
+
+RESTART_CHECK_SECONDS = 60
+
 PORT = int(
     os.getenv(
         "PORT",
@@ -94,6 +134,49 @@ PORT = int(
     )
 )
 
+# polling — бот сам забирает обновления (запасной режим),
+# webhook — Telegram присылает их на HTTP-сервер бота.
+BOT_MODE = os.getenv(
+    "BOT_MODE",
+    "polling",
+).strip().lower()
+
+# Публичный адрес бота, например https://bot.up.railway.app.
+WEBHOOK_BASE_URL = (
+    os.getenv("WEBHOOK_BASE_URL")
+    or (
+        f"https://{os.getenv('RAILWAY_PUBLIC_DOMAIN')}"
+        if os.getenv("RAILWAY_PUBLIC_DOMAIN")
+        else ""
+    )
+).rstrip("/")
+
+WEBHOOK_PATH = "/telegram/webhook"
+
+# Telegram присылает его в X-Telegram-Bot-Api-Secret-Token.
+WEBHOOK_SECRET = os.getenv(
+    "WEBHOOK_SECRET",
+    hashlib.sha256(
+        f"webhook:{API_TOKEN}".encode("utf-8")
+    ).hexdigest(),
+)
+
+# /readyz отвечает 503, если исходящая очередь Telegram
+# длиннее или ждёт дольше этих порогов.
+READY_MAX_OUTBOUND_QUEUE = int(
+    os.getenv(
+        "READY_MAX_OUTBOUND_QUEUE",
+        "500",
+    )
+)
+
+READY_MAX_OUTBOUND_WAIT_SECONDS = int(
+    os.getenv(
+        "READY_MAX_OUTBOUND_WAIT_SECONDS",
+        "30",
+    )
+)
+
 
 MANAGER_URL = os.getenv(
     "MANAGER_URL",
@@ -120,6 +203,152 @@ PRINT_URL = os.getenv(
 )
 
 
+# Очередь печати: первая пауза между повторами и максимальная, секунд.
+PRINT_RETRY_BASE_SECONDS = int(
+    os.getenv(
+        "PRINT_RETRY_BASE_SECONDS",
+        "5",
+    )
+)
+
+PRINT_RETRY_MAX_SECONDS = int(
+    os.getenv(
+        "PRINT_RETRY_MAX_SECONDS",
+        "300",
+    )
+)
+
+# После скольких неудачных попыток предупредить менеджера.
+PRINT_ALERT_AFTER_ATTEMPTS = int(
+    os.getenv(
+        "PRINT_ALERT_AFTER_ATTEMPTS",
+        "3",
+    )
+)
+
+PRINT_OUTBOX_POLL_SECONDS = 10
+
+# Таймаут каждого действия после сохранения заказа, секунд.
+ORDER_SIDE_EFFECT_TIMEOUT = int(
+    os.getenv(
+        "ORDER_SIDE_EFFECT_TIMEOUT",
+        "20",
+    )
+)
+
+# Сколько раз пытаться записать заказ после списания бонусов.
+ORDER_SAVE_ATTEMPTS = 3
+
+# Канал LISTEN/NOTIFY, в который база сообщает о новой версии меню.
+MENU_CATALOG_CHANNEL = "menu_catalog"
+
+# Как часто сверять версию меню, если уведомление потерялось, секунд.
+MENU_CATALOG_POLL_SECONDS = 60
+
+# Имя этого процесса в singleton_leases и broadcast_logs.owner.
+# Уникально для каждого запуска: после execv на той же реплике
+# новый процесс не должен считать своей аренду старого.
+INSTANCE_ID = (
+    f"{os.getenv('RAILWAY_REPLICA_ID') or socket.gethostname()}"
+    f"-{os.getpid()}-{os.urandom(3).hex()}"
+)
+
+# Аренда одиночной задачи: срок и период продления, секунд.
+LEASE_TTL_SECONDS = 30
+LEASE_RENEW_SECONDS = 10
+
+# Как часто искать прерванные рассылки, секунд.
+BROADCAST_RESUME_CHECK_SECONDS = 300
+
+# Как часто пересчитывать статистику текущего дня, секунд.
+DAILY_STATS_REFRESH_SECONDS = int(
+    os.getenv(
+        "DAILY_STATS_REFRESH_SECONDS",
+        "300",
+    )
+)
+
+# Предел одного документа выгрузки. Telegram принимает до 50 МБ.
+EXPORT_PART_MAX_BYTES = 45 * 1024 * 1024
+
+# Сколько строк читается из серверного курсора за раз.
+# Для колоночной выгрузки это же размер группы строк.
+EXPORT_CURSOR_BATCH_ROWS = 5000
+
+# Самый длинный период для /export_orders, дней.
+EXPORT_ORDERS_MAX_RANGE_DAYS = 366
+
+# Самый длинный период для /nu4etam, дней.
+DAILY_STATS_MAX_RANGE_DAYS = 366
+
+# Сколько недостающих прошедших дней отчёт досчитывает сам.
+# Остальные досчитываются в фоне, по одному дню за раз.
+DAILY_STATS_INLINE_BACKFILL_DAYS = 7
+
+# Сколько живёт незавершённый диалог администратора, секунд.
+ADMIN_STATE_TTL_SECONDS = int(
+    os.getenv(
+        "ADMIN_STATE_TTL_SECONDS",
+        "3600",
+    )
+)
+
+# Сколько секунд доверять локальной копии состояния.
+ADMIN_STATE_CACHE_SECONDS = 5
+
+# Как часто удалять просроченные состояния, секунд.
+ADMIN_STATE_SWEEP_SECONDS = 600
+
+# Сколько секунд задача печати считается занятой одной попыткой.
+PRINT_JOB_LEASE_SECONDS = 60
+
+
+# Сколько одновременных HTTP-соединений держать к одному хосту.
+HTTP_LIMIT_PER_HOST = int(
+    os.getenv(
+        "HTTP_LIMIT_PER_HOST",
+        "10",
+    )
+)
+
+HTTP_UPSTREAM_MINI_APP = "mini_app"
+
+HTTP_UPSTREAM_PRINT = "print"
+
+
+# Как часто сбрасывать накопленную активность пользователей в базу.
+USER_ACTIVITY_FLUSH_MS = int(
+    os.getenv(
+        "USER_ACTIVITY_FLUSH_MS",
+        "2000",
+    )
+)
+
+# Сколько пользователей накопить до внеочередного сброса.
+USER_ACTIVITY_FLUSH_USERS = int(
+    os.getenv(
+        "USER_ACTIVITY_FLUSH_USERS",
+        "200",
+    )
+)
+
+# Сколько известных пользователей помнить в памяти.
+KNOWN_USER_IDS_MAX = int(
+    os.getenv(
+        "KNOWN_USER_IDS_MAX",
+        "50000",
+    )
+)
+
+# Сколько закрытых периодов /stats держать в памяти.
+ANALYTICS_MEMORY_CACHE_MAX = int(
+    os.getenv(
+        "ANALYTICS_MEMORY_CACHE_MAX",
+        "256",
+    )
+)
+
+
 # ============================================================================
 # ИНИЦИАЛИЗАЦИЯ
 # ============================================================================
@@ -134,36 +363,159 @@ dp = Dispatcher()
 KEYBOARD_SHOWN_USERS: set[int] = set()
 
 
-# Менеджер пишет клиенту.
-waiting_reply: dict[
-    int,
-    dict[str, int],
-] = {}
+# Пользователи, уже записанные в базу этим процессом.
+# Порядок вставки dict — порядок последнего обращения,
+# самые давние вытесняются после KNOWN_USER_IDS_MAX.
+KNOWN_USER_IDS: OrderedDict[int, None] = OrderedDict()
 
 
-# Менеджер готовит рекламную рассылку.
-waiting_broadcast: set[int] = set()
+def remember_known_user(
+    telegram_id: int,
+) -> None:
+    KNOWN_USER_IDS[telegram_id] = None
+    KNOWN_USER_IDS.move_to_end(
+        telegram_id
+    )
 
+    while len(KNOWN_USER_IDS) > KNOWN_USER_IDS_MAX:
+        KNOWN_USER_IDS.popitem(
+            last=False
+        )
 
-# Подготовленное сообщение для рассылки.
-pending_broadcasts: dict[
+
+# Отложенная активность пользователей:
+# telegram_id -> (username, first_name, last_name, touched_at).
+pending_user_activity: dict[
     int,
-    dict,
+    tuple,
 ] = {}
 
+user_activity_wakeup = asyncio.Event()
+
+user_activity_task: asyncio.Task | None = None
+
+
+# Диалоги администратора хранятся в таблице admin_states.
+# Менеджер пишет клиенту.
+ADMIN_STATE_REPLY = "reply"
+
+# Менеджер готовит рекламную рассылку.
+ADMIN_STATE_BROADCAST = "broadcast"
+
+# Подготовленное сообщение для рассылки.
+ADMIN_STATE_PENDING_BROADCAST = "pending_broadcast"
 
 # Состояние команды /bonus.
-waiting_bonus: dict[
-    int,
-    dict,
-] = {}
+ADMIN_STATE_BONUS = "bonus"
 
 
 broadcast_lock = asyncio.Lock()
 
+# Кэш числа получателей: broadcast_type -> (count, expires_at).
+broadcast_target_count_cache: dict[
+    str,
+    tuple[int, float],
+] = {}
+
+print_outbox_wakeup = asyncio.Event()
+print_outbox_stopping = asyncio.Event()
+
+print_outbox_task: asyncio.Task | None = None
+
+# Запущенные задачи рассылок, чтобы корректно остановить их при выходе.
+broadcast_tasks: set[asyncio.Task] = set()
+
 broadcast_running = False
 
-BROADCAST_DELAY = 0.06
+# Будит поиск прерванных рассылок, когда текущая закончилась.
+broadcast_resume_wakeup = asyncio.Event()
+
+
+# Общий лимит всех исходящих вызовов Telegram, сообщений в секунду.
+TELEGRAM_RATE_PER_SECOND = float(
+    os.getenv(
+        "TELEGRAM_RATE_PER_SECOND",
+        "30",
+    )
+)
+
+# Не чаще одного сообщения в чат за этот интервал, секунд.
+TELEGRAM_CHAT_INTERVAL = float(
+    os.getenv(
+        "TELEGRAM_CHAT_INTERVAL",
+        "1.0",
+    )
+)
+
+# Сколько раз повторять вызов после ответа 429 Too Many Requests.
+TELEGRAM_MAX_RETRIES = int(
+    os.getenv(
+        "TELEGRAM_MAX_RETRIES",
+        "3",
+    )
+)
+
+
+# Чат администратора: отдельный лимит с запасом на всплеск,
+# чтобы заказы, чеки и прогресс рассылки не ждали друг друга.
+TELEGRAM_ADMIN_CHAT_RATE = float(
+    os.getenv(
+        "TELEGRAM_ADMIN_CHAT_RATE",
+        "1.0",
+    )
+)
+
+TELEGRAM_ADMIN_CHAT_BURST = float(
+    os.getenv(
+        "TELEGRAM_ADMIN_CHAT_BURST",
+        "20",
+    )
+)
+
+# Сколько отправок рассылки выполняется одновременно.
+BROADCAST_WORKERS = int(
+    os.getenv(
+        "BROADCAST_WORKERS",
+        "20",
+    )
+)
+
+BROADCAST_PROGRESS_SECONDS = 3
+
+# Прерванную рассылку возобновляем, только если она не старше этого.
+BROADCAST_RESUME_HOURS = int(
+    os.getenv(
+        "BROADCAST_RESUME_HOURS",
+        "24",
+    )
+)
+
+# Сколько секунд кэшировать число получателей для предпросмотра.
+BROADCAST_COUNT_CACHE_SECONDS = int(
+    os.getenv(
+        "BROADCAST_COUNT_CACHE_SECONDS",
+        "60",
+    )
+)
+
+# Сколько получателей читать из базы за один запрос.
+BROADCAST_PAGE_SIZE = int(
+    os.getenv(
+        "BROADCAST_PAGE_SIZE",
+        "2000",
+    )
+)
+
+# Сколько результатов рассылки записывать в базу одним запросом.
+BROADCAST_RESULT_BATCH = int(
+    os.getenv(
+        "BROADCAST_RESULT_BATCH",
+        "300",
+    )
+)
+
+# Сколько раз повторять последнюю запись результатов рассылки.
+BROADCAST_RESULT_FLUSH_ATTEMPTS = 3
 
 
 db_pool: asyncpg.Pool | None = None
@@ -173,6 +525,8 @@ TIMEZONE = ZoneInfo(
     "Asia/Bangkok"
 )
 
+# Начальное наполнение таблицы menu_items. Используется, только
+# пока таблица пуста; дальше цены и наличие меняются в базе.
 MENU_PRICE_MAP: dict[str, int] = {
     "Борщ": 180,
     "Солянка": 180,
@@ -224,2261 +578,5879 @@ MAX_BONUS_REDEEM_PERCENT = 20
 
 
 # ============================================================================
-# БАЗА ДАННЫХ
+# ОГРАНИЧЕНИЕ СКОРОСТИ ОТПРАВКИ
 # ============================================================================
 
-async def init_database() -> None:
-    global db_pool
+class TokenBucket:
+    """
+    Классический token bucket: rate токенов в секунду,
+    не больше capacity в запасе.
+    """
 
-    db_pool = await asyncpg.create_pool(
-        DATABASE_URL,
-        min_size=1,
-        max_size=5,
-        command_timeout=30,
-    )
+    def __init__(
+        self,
+        rate: float,
+        capacity: float | None = None,
+    ) -> None:
+        self.rate = max(
+            0.1,
+            float(rate),
+        )
 
-    async with db_pool.acquire() as conn:
-        await conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS users (
-                telegram_id BIGINT PRIMARY KEY,
-                username TEXT,
-                telegram_first_name TEXT,
-                telegram_last_name TEXT,
-                profile_name TEXT,
-                phone TEXT,
-                address TEXT,
-                photo_url TEXT,
-                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-                updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-                last_bot_activity_at TIMESTAMPTZ,
-                last_site_visit_at TIMESTAMPTZ
-            );
+        self.capacity = max(
+            1.0,
+            float(
+                capacity
+                if capacity is not None
+                else self.rate
+            ),
+        )
 
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
 
-            ALTER TABLE users
-            ADD COLUMN IF NOT EXISTS username TEXT;
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
 
+                self._tokens = min(
+                    self.capacity,
+                    self._tokens
+                    + (now - self._updated_at) * self.rate,
+                )
 
-            ALTER TABLE users
-            ADD COLUMN IF NOT EXISTS telegram_first_name TEXT;
+                self._updated_at = now
 
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
 
-            ALTER TABLE users
-            ADD COLUMN IF NOT EXISTS telegram_last_name TEXT;
+                await asyncio.sleep(
+                    (1 - self._tokens) / self.rate
+                )
 
 
-            ALTER TABLE users
-            ADD COLUMN IF NOT EXISTS profile_name TEXT;
+class ChatRateGuard:
+    """
+    Не даёт отправлять в один чат чаще,
+    чем раз в interval секунд.
+    """
 
+    def __init__(
+        self,
+        interval: float,
+    ) -> None:
+        self.interval = interval
+        self._next_allowed: dict[int, float] = {}
 
-            ALTER TABLE users
-            ADD COLUMN IF NOT EXISTS phone TEXT;
+    async def wait(
+        self,
+        chat_id: int,
+    ) -> None:
+        now = time.monotonic()
+
+        if len(self._next_allowed) > 10_000:
+            self._next_allowed = {
+                key: value
+                for key, value in self._next_allowed.items()
+                if value > now
+            }
 
+        allowed_at = max(
+            now,
+            self._next_allowed.get(
+                chat_id,
+                0.0,
+            ),
+        )
 
-            ALTER TABLE users
-            ADD COLUMN IF NOT EXISTS address TEXT;
+        self._next_allowed[
+            chat_id
+        ] = allowed_at + self.interval
 
+        if allowed_at > now:
+            await asyncio.sleep(
+                allowed_at - now
+            )
 
-            ALTER TABLE users
-            ADD COLUMN IF NOT EXISTS photo_url TEXT;
 
+PRIORITY_TRANSACTIONAL = "transactional"
 
-            ALTER TABLE users
-            ADD COLUMN IF NOT EXISTS created_at
-                TIMESTAMPTZ NOT NULL DEFAULT NOW();
+PRIORITY_BULK = "bulk"
 
 
-            ALTER TABLE users
-            ADD COLUMN IF NOT EXISTS updated_at
-                TIMESTAMPTZ NOT NULL DEFAULT NOW();
+# Приоритет исходящих вызовов Telegram в текущей задаче.
+# По умолчанию всё транзакционное: заказы, ответы менеджера, бонусы.
+OUTBOUND_PRIORITY: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "outbound_priority",
+    default=PRIORITY_TRANSACTIONAL,
+)
 
 
-            ALTER TABLE users
-            ADD COLUMN IF NOT EXISTS last_bot_activity_at
-                TIMESTAMPTZ;
+OUTBOUND_LANES = (
+    PRIORITY_TRANSACTIONAL,
+    PRIORITY_BULK,
+)
 
 
-            ALTER TABLE users
-            ADD COLUMN IF NOT EXISTS last_site_visit_at
-                TIMESTAMPTZ;
+class OutboundScheduler:
+    """
+    Раздаёт токены общего лимита по полосам приоритета.
 
+    Каждая отправка встаёт в очередь своей полосы. Диспетчер
+    выдаёт токен первой ожидающей отправке из самой приоритетной
+    непустой полосы, поэтому массовые отправки уступают,
+    как только появляется транзакционное сообщение.
+    """
 
-            ALTER TABLE users
-            ADD COLUMN IF NOT EXISTS is_active
-                BOOLEAN NOT NULL DEFAULT TRUE;
+    def __init__(
+        self,
+        rate: float,
+    ) -> None:
+        self.bucket = TokenBucket(
+            rate
+        )
 
+        self._waiters: dict[str, deque] = {
+            lane: deque()
+            for lane in OUTBOUND_LANES
+        }
 
-            ALTER TABLE users
-            ADD COLUMN IF NOT EXISTS marketing_allowed
-                BOOLEAN NOT NULL DEFAULT TRUE;
+        self._metrics: dict[str, dict[str, float]] = {
+            lane: {
+                "granted": 0,
+                "wait_total": 0.0,
+                "wait_max": 0.0,
+            }
+            for lane in OUTBOUND_LANES
+        }
 
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
 
-            ALTER TABLE users
-            ADD COLUMN IF NOT EXISTS blocked_at
-                TIMESTAMPTZ;
+    def _next_lane(self) -> str | None:
+        for lane in OUTBOUND_LANES:
+            waiters = self._waiters[lane]
 
+            while (
+                waiters
+                and waiters[0][0].done()
+            ):
+                waiters.popleft()
 
-            ALTER TABLE users
-            ADD COLUMN IF NOT EXISTS last_send_error
-                TEXT;
+            if waiters:
+                return lane
 
+        return None
 
-            ALTER TABLE users
-            ADD COLUMN IF NOT EXISTS last_successful_send_at
-                TIMESTAMPTZ;
+    async def _dispatch(self) -> None:
+        while True:
+            if self._next_lane() is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
 
+            await self.bucket.acquire()
 
-            ALTER TABLE users
-            ADD COLUMN IF NOT EXISTS last_broadcast_at
-                TIMESTAMPTZ;
+            # Пока ждали токен, могла прийти более важная отправка.
+            lane = self._next_lane()
 
+            if lane is None:
+                continue
 
-            ALTER TABLE users
-            ADD COLUMN IF NOT EXISTS last_keyboard_sent_at
-                TIMESTAMPTZ;
+            future, enqueued_at = self._waiters[lane].popleft()
 
+            future.set_result(
+                None
+            )
 
-            /*
-             * Историческая сумма покупок,
-             * заданная менеджером через /bonus.
-             */
-            ALTER TABLE users
-            ADD COLUMN IF NOT EXISTS manual_spend
-                BIGINT NOT NULL DEFAULT 0;
+            waited = time.monotonic() - enqueued_at
+            metrics = self._metrics[lane]
 
+            metrics["granted"] += 1
+            metrics["wait_total"] += waited
+            metrics["wait_max"] = max(
+                metrics["wait_max"],
+                waited,
+            )
 
-            ALTER TABLE users
-            ADD COLUMN IF NOT EXISTS bonus_updated_at
-                TIMESTAMPTZ;
+    async def acquire(
+        self,
+        lane: str,
+    ) -> None:
+        if lane not in self._waiters:
+            lane = PRIORITY_BULK
 
+        if (
+            self._task is None
+            or self._task.done()
+        ):
+            self._task = asyncio.create_task(
+                self._dispatch()
+            )
 
-            ALTER TABLE users
-            ADD COLUMN IF NOT EXISTS bonus_updated_by
-                BIGINT;
+        future = asyncio.get_running_loop().create_future()
 
+        self._waiters[lane].append(
+            (
+                future,
+                time.monotonic(),
+            )
+        )
 
-            CREATE INDEX IF NOT EXISTS idx_users_active
-            ON users(is_active);
+        self._wakeup.set()
 
+        await future
 
-            CREATE INDEX IF NOT EXISTS idx_users_marketing
-            ON users(marketing_allowed);
+    def queue_depth(
+        self,
+        lane: str,
+    ) -> int:
+        return sum(
+            1
+            for future, _ in self._waiters.get(lane, ())
+            if not future.done()
+        )
+
+    def snapshot(self) -> dict[str, dict[str, float]]:
+        now = time.monotonic()
+        result = {}
+
+        for lane in OUTBOUND_LANES:
+            metrics = self._metrics[lane]
+            waiters = self._waiters[lane]
+
+            granted = int(metrics["granted"])
+
+            result[lane] = {
+                "queued": self.queue_depth(lane),
+                "oldest_wait": (
+                    now - waiters[0][1]
+                    if waiters
+                    else 0.0
+                ),
+                "granted": granted,
+                "avg_wait": (
+                    metrics["wait_total"] / granted
+                    if granted
+                    else 0.0
+                ),
+                "max_wait": metrics["wait_max"],
+            }
 
+        return result
 
-            CREATE INDEX IF NOT EXISTS idx_users_last_activity
-            ON users(last_bot_activity_at);
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
 
+            try:
+                await self._task
 
-            CREATE TABLE IF NOT EXISTS visits (
-                id BIGSERIAL PRIMARY KEY,
+            except asyncio.CancelledError:
+                pass
 
-                telegram_id BIGINT
-                    REFERENCES users(telegram_id)
-                    ON DELETE SET NULL,
+            self._task = None
 
-                visited_at TIMESTAMPTZ
-                    NOT NULL DEFAULT NOW(),
 
-                session_key TEXT,
-                user_agent TEXT
-            );
+class TelegramRateGovernor(
+    BaseRequestMiddleware
+):
+    """
+    Общий для процесса регулятор вызовов Telegram Bot API.
 
+    Все отправки в чаты проходят через OutboundScheduler
+    и ограничение на чат. Ответ 429 ставит на паузу весь процесс
+    на retry_after, а не только упавшую отправку.
 
-            CREATE INDEX IF NOT EXISTS idx_visits_visited_at
-            ON visits(visited_at);
+    Чат администратора ограничивается своим token bucket
+    с запасом на всплеск, а правка уже отправленных сообщений
+    не ждёт ограничения на чат вовсе.
+    """
 
+    def __init__(
+        self,
+        rate: float,
+        chat_interval: float,
+        max_retries: int,
+    ) -> None:
+        self.scheduler = OutboundScheduler(
+            rate
+        )
 
-            CREATE INDEX IF NOT EXISTS idx_visits_telegram_id
-            ON visits(telegram_id);
+        self.chat_guard = ChatRateGuard(
+            chat_interval
+        )
 
+        self.admin_chat_bucket = TokenBucket(
+            TELEGRAM_ADMIN_CHAT_RATE,
+            TELEGRAM_ADMIN_CHAT_BURST,
+        )
 
-            CREATE TABLE IF NOT EXISTS orders (
-                id BIGSERIAL PRIMARY KEY,
+        self.max_retries = max(
+            0,
+            max_retries,
+        )
 
-                telegram_id BIGINT NOT NULL
-                    REFERENCES users(telegram_id)
-                    ON DELETE RESTRICT,
+        self.paused_until = 0.0
 
-                source TEXT
-                    NOT NULL DEFAULT 'mini_app',
+    async def wait_for_pause(self) -> None:
+        while True:
+            delay = self.paused_until - time.monotonic()
 
-                customer_name TEXT,
-                phone TEXT,
-                address TEXT,
-                address_plain TEXT,
-                payment_method TEXT,
+            if delay <= 0:
+                return
 
-                delivery_fee INTEGER
-                    NOT NULL DEFAULT 0,
+            await asyncio.sleep(
+                delay
+            )
 
-                items_total INTEGER
-                    NOT NULL DEFAULT 0,
+    async def wait_for_chat(
+        self,
+        chat_id: int | str,
+        method,
+    ) -> None:
+        if not isinstance(chat_id, int):
+            return
 
-                discount_percent INTEGER
-                    NOT NULL DEFAULT 0,
+        if getattr(
+            method,
+            "__api_method__",
+            "",
+        ).startswith("edit"):
+            return
 
-                discount_amount INTEGER
-                    NOT NULL DEFAULT 0,
+        if chat_id == ADMIN_CHAT_ID:
+            await self.admin_chat_bucket.acquire()
+            return
 
-                total INTEGER
-                    NOT NULL DEFAULT 0,
+        await self.chat_guard.wait(
+            chat_id
+        )
 
-                order_when TEXT,
-                order_date DATE,
-                order_time TEXT,
-                comment TEXT,
+    async def __call__(
+        self,
+        make_request,
+        bot,
+        method,
+    ):
+        chat_id = getattr(
+            method,
+            "chat_id",
+            None,
+        )
 
-                status TEXT
-                    NOT NULL DEFAULT 'created',
+        # getUpdates, answerCallbackQuery и служебные вызовы
+        # не адресованы чату и не ограничиваются.
+        if chat_id is None:
+            return await make_request(
+                bot,
+                method,
+            )
 
-                created_at TIMESTAMPTZ
-                    NOT NULL DEFAULT NOW()
-            );
+        priority = OUTBOUND_PRIORITY.get()
 
+        attempt = 0
 
-            /*
-             * Номер заказа назначает только бот.
-             * Первый новый номер: SM-472.
-             */
-            ALTER TABLE orders
-            ADD COLUMN IF NOT EXISTS order_number TEXT;
+        while True:
+            await self.wait_for_pause()
 
-            ALTER TABLE orders
-            ADD COLUMN IF NOT EXISTS bonus_used INTEGER NOT NULL DEFAULT 0;
+            # Сначала ждём чат, потом берём общий токен:
+            # иначе токен сгорает, пока отправка стоит у чата.
+            await self.wait_for_chat(
+                chat_id,
+                method,
+            )
 
-            ALTER TABLE orders
-            ADD COLUMN IF NOT EXISTS cashback_percent INTEGER NOT NULL DEFAULT 0;
+            await self.scheduler.acquire(
+                priority
+            )
 
-            ALTER TABLE orders
-            ADD COLUMN IF NOT EXISTS cashback_earned INTEGER NOT NULL DEFAULT 0;
+            try:
+                return await make_request(
+                    bot,
+                    method,
+                )
 
-            ALTER TABLE orders
-            ADD COLUMN IF NOT EXISTS loyalty_request_id TEXT;
+            except TelegramRetryAfter as exc:
+                self.paused_until = max(
+                    self.paused_until,
+                    time.monotonic()
+                    + float(exc.retry_after)
+                    + 1,
+                )
 
+                logger.warning(
+                    "TELEGRAM FLOOD CONTROL: retry_after=%s chat=%s "
+                    "priority=%s attempt=%s",
+                    exc.retry_after,
+                    chat_id,
+                    priority,
+                    attempt + 1,
+                )
 
-            CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_order_number
-            ON orders(order_number)
-            WHERE order_number IS NOT NULL;
+                if attempt >= self.max_retries:
+                    raise
 
+                attempt += 1
 
-            /*
-             * Последовательность хранится в PostgreSQL,
-             * поэтому не сбрасывается при Redeploy Railway.
-             *
-             * Если последовательность создаётся впервые,
-             * учитываем уже записанные номера SM-*.
-             */
-            DO $order_number_sequence$
-            DECLARE
-                max_existing_number BIGINT;
-            BEGIN
-                IF NOT EXISTS (
-                    SELECT 1
-                    FROM pg_class
-                    WHERE relkind = 'S'
-                      AND relname = 'sm_order_number_seq'
-                )
-                THEN
-                    CREATE SEQUENCE sm_order_number_seq
-                    START WITH 472
-                    INCREMENT BY 1
-                    MINVALUE 1
-                    NO MAXVALUE
-                    CACHE 1;
-
-                    SELECT COALESCE(
-                        MAX(
-                            CASE
-                                WHEN order_number ~ '^SM-[0-9]+$'
-                                THEN SUBSTRING(order_number FROM 4)::BIGINT
-                                ELSE NULL
-                            END
-                        ),
-                        471
-                    )
-                    INTO max_existing_number
-                    FROM orders;
-
-                    PERFORM setval(
-                        'sm_order_number_seq',
-                        GREATEST(max_existing_number, 471),
-                        TRUE
-                    );
-                END IF;
-            END
-            $order_number_sequence$;
 
+telegram_rate_governor = TelegramRateGovernor(
+    TELEGRAM_RATE_PER_SECOND,
+    TELEGRAM_CHAT_INTERVAL,
+    TELEGRAM_MAX_RETRIES,
+)
 
+bot.session.middleware(
+    telegram_rate_governor
+)
 
-            CREATE INDEX IF NOT EXISTS idx_orders_created_at
-            ON orders(created_at);
 
+# ============================================================================
+# БАЗА ДАННЫХ
+# ============================================================================
 
-            CREATE INDEX IF NOT EXISTS idx_orders_telegram_id
-            ON orders(telegram_id);
+# Ключ advisory lock, под которым применяются миграции схемы.
+SCHEMA_MIGRATIONS_LOCK_KEY = 7_340_016
 
 
-            CREATE TABLE IF NOT EXISTS order_items (
-                id BIGSERIAL PRIMARY KEY,
+SCHEMA_BASELINE_SQL = """
+    CREATE TABLE IF NOT EXISTS users (
+        telegram_id BIGINT PRIMARY KEY,
+        username TEXT,
+        telegram_first_name TEXT,
+        telegram_last_name TEXT,
+        profile_name TEXT,
+        phone TEXT,
+        address TEXT,
+        photo_url TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        last_bot_activity_at TIMESTAMPTZ,
+        last_site_visit_at TIMESTAMPTZ
+    );
 
-                order_id BIGINT NOT NULL
-                    REFERENCES orders(id)
-                    ON DELETE CASCADE,
 
-                item_name TEXT NOT NULL,
-                quantity INTEGER NOT NULL,
-                unit_price INTEGER NOT NULL,
-                image_url TEXT
-            );
+    ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS username TEXT;
 
 
-            CREATE INDEX IF NOT EXISTS idx_order_items_order_id
-            ON order_items(order_id);
+    ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS telegram_first_name TEXT;
 
 
-            /*
-             * История массовых рассылок.
-             */
-            CREATE TABLE IF NOT EXISTS broadcast_logs (
-                id BIGSERIAL PRIMARY KEY,
-                broadcast_type TEXT,
-                created_by BIGINT,
-                source_chat_id BIGINT,
-                source_message_id BIGINT,
-                total_targets INTEGER NOT NULL DEFAULT 0,
-                delivered INTEGER NOT NULL DEFAULT 0,
-                blocked INTEGER NOT NULL DEFAULT 0,
-                failed INTEGER NOT NULL DEFAULT 0,
-                status TEXT NOT NULL DEFAULT 'created',
-                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-                completed_at TIMESTAMPTZ
-            );
+    ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS telegram_last_name TEXT;
 
 
-            ALTER TABLE broadcast_logs
-            ADD COLUMN IF NOT EXISTS broadcast_type TEXT;
+    ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS profile_name TEXT;
 
 
-            ALTER TABLE broadcast_logs
-            ADD COLUMN IF NOT EXISTS created_by BIGINT;
+    ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS phone TEXT;
 
 
-            ALTER TABLE broadcast_logs
-            ADD COLUMN IF NOT EXISTS source_chat_id BIGINT;
+    ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS address TEXT;
 
 
-            ALTER TABLE broadcast_logs
-            ADD COLUMN IF NOT EXISTS source_message_id BIGINT;
+    ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS photo_url TEXT;
 
 
-            ALTER TABLE broadcast_logs
-            ADD COLUMN IF NOT EXISTS total_targets
-                INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS created_at
+        TIMESTAMPTZ NOT NULL DEFAULT NOW();
 
 
-            ALTER TABLE broadcast_logs
-            ADD COLUMN IF NOT EXISTS delivered
-                INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS updated_at
+        TIMESTAMPTZ NOT NULL DEFAULT NOW();
 
 
-            ALTER TABLE broadcast_logs
-            ADD COLUMN IF NOT EXISTS blocked
-                INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS last_bot_activity_at
+        TIMESTAMPTZ;
 
 
-            ALTER TABLE broadcast_logs
-            ADD COLUMN IF NOT EXISTS failed
-                INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS last_site_visit_at
+        TIMESTAMPTZ;
 
 
-            ALTER TABLE broadcast_logs
-            ADD COLUMN IF NOT EXISTS status
-                TEXT NOT NULL DEFAULT 'created';
+    ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS is_active
+        BOOLEAN NOT NULL DEFAULT TRUE;
 
 
-            ALTER TABLE broadcast_logs
-            ADD COLUMN IF NOT EXISTS created_at
-                TIMESTAMPTZ NOT NULL DEFAULT NOW();
+    ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS marketing_allowed
+        BOOLEAN NOT NULL DEFAULT TRUE;
 
 
-            ALTER TABLE broadcast_logs
-            ADD COLUMN IF NOT EXISTS completed_at
-                TIMESTAMPTZ;
+    ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS blocked_at
+        TIMESTAMPTZ;
 
 
-            /*
-             * Исправление старой таблицы,
-             * где колонка называлась kind.
-             */
-            DO $broadcast_migration$
-            BEGIN
-                IF EXISTS (
-                    SELECT 1
-                    FROM information_schema.columns
-                    WHERE table_schema = 'public'
-                      AND table_name = 'broadcast_logs'
-                      AND column_name = 'kind'
-                )
-                THEN
-                    EXECUTE '
-                        UPDATE broadcast_logs
-                        SET broadcast_type =
-                            COALESCE(broadcast_type, kind)
-                    ';
-
-                    EXECUTE '
-                        ALTER TABLE broadcast_logs
-                        ALTER COLUMN kind DROP NOT NULL
-                    ';
-                END IF;
-            END
-            $broadcast_migration$;
+    ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS last_send_error
+        TEXT;
 
 
-            UPDATE broadcast_logs
-            SET broadcast_type = 'unknown'
-            WHERE broadcast_type IS NULL;
+    ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS last_successful_send_at
+        TIMESTAMPTZ;
 
 
-            ALTER TABLE broadcast_logs
-            ALTER COLUMN broadcast_type SET DEFAULT 'unknown';
+    ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS last_broadcast_at
+        TIMESTAMPTZ;
 
 
-            ALTER TABLE broadcast_logs
-            ALTER COLUMN broadcast_type SET NOT NULL;
+    ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS last_keyboard_sent_at
+        TIMESTAMPTZ;
 
 
-            CREATE INDEX IF NOT EXISTS idx_broadcast_logs_created_at
-            ON broadcast_logs(created_at DESC);
+    /*
+     * Историческая сумма покупок,
+     * заданная менеджером через /bonus.
+     */
+    ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS manual_spend
+        BIGINT NOT NULL DEFAULT 0;
 
 
-            /*
-             * История ручных начислений лояльности.
-             */
-            CREATE TABLE IF NOT EXISTS loyalty_adjustments (
-                id BIGSERIAL PRIMARY KEY,
-                request_id TEXT UNIQUE,
-                telegram_id BIGINT NOT NULL,
-                previous_amount BIGINT NOT NULL DEFAULT 0,
-                new_amount BIGINT NOT NULL DEFAULT 0,
-                created_by BIGINT,
-                source TEXT NOT NULL DEFAULT 'manager_bonus',
-                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-            );
+    ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS bonus_updated_at
+        TIMESTAMPTZ;
 
 
-            CREATE INDEX IF NOT EXISTS idx_loyalty_adjustments_user
-            ON loyalty_adjustments(telegram_id);
+    ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS bonus_updated_by
+        BIGINT;
 
 
-            CREATE INDEX IF NOT EXISTS idx_loyalty_adjustments_created
-            ON loyalty_adjustments(created_at DESC);
-            """
-        )
+    CREATE INDEX IF NOT EXISTS idx_users_active
+    ON users(is_active);
 
-        await conn.execute(
-            """
-            UPDATE broadcast_logs
-            SET
-                status = 'interrupted',
-                completed_at = NOW()
-            WHERE status = 'running'
-            """
-        )
 
-    logger.info(
-        "База данных подключена, таблицы готовы"
-    )
+    CREATE INDEX IF NOT EXISTS idx_users_marketing
+    ON users(marketing_allowed);
 
 
-async def upsert_user(
-    user: types.User | None,
-) -> asyncpg.Record | None:
-    if not db_pool or not user:
-        return None
+    CREATE INDEX IF NOT EXISTS idx_users_last_activity
+    ON users(last_bot_activity_at);
 
-    if user.is_bot:
-        return None
 
-    try:
-        row = await db_pool.fetchrow(
-            """
-            INSERT INTO users (
-                telegram_id,
-                username,
-                telegram_first_name,
-                telegram_last_name,
-                created_at,
-                updated_at,
-                last_bot_activity_at,
-                is_active,
-                blocked_at,
-                last_send_error
-            )
-            VALUES (
-                $1,
-                $2,
-                $3,
-                $4,
-                NOW(),
-                NOW(),
-                NOW(),
-                TRUE,
-                NULL,
-                NULL
-            )
+    /*
+     * Частичные индексы под условия выборки получателей:
+     * реклама и обновление клавиатуры.
+     */
+    CREATE INDEX IF NOT EXISTS idx_users_broadcast_advertising
+    ON users(telegram_id)
+    WHERE is_active = TRUE AND marketing_allowed = TRUE;
 
-            ON CONFLICT (telegram_id)
-            DO UPDATE SET
-                username = EXCLUDED.username,
-                telegram_first_name = EXCLUDED.telegram_first_name,
-                telegram_last_name = EXCLUDED.telegram_last_name,
-                updated_at = NOW(),
-                last_bot_activity_at = NOW(),
-                is_active = TRUE,
-                blocked_at = NULL,
-                last_send_error = NULL
 
-            RETURNING
-                telegram_id,
-                username,
-                telegram_first_name,
-                telegram_last_name,
-                created_at,
-                last_bot_activity_at,
-                manual_spend
-            """,
-            user.id,
-            user.username,
-            user.first_name,
-            user.last_name,
-        )
+    CREATE INDEX IF NOT EXISTS idx_users_broadcast_keyboard
+    ON users(telegram_id)
+    WHERE is_active = TRUE;
 
-        logger.info(
-            "USER SAVED: id=%s username=@%s name=%s %s",
-            row["telegram_id"],
-            row["username"] or "-",
-            row["telegram_first_name"] or "",
-            row["telegram_last_name"] or "",
-        )
 
-        return row
+    CREATE TABLE IF NOT EXISTS visits (
+        id BIGSERIAL PRIMARY KEY,
 
-    except Exception:
-        logger.exception(
-            "USER SAVE ERROR: id=%s",
-            getattr(
-                user,
-                "id",
-                "unknown",
-            ),
-        )
+        telegram_id BIGINT
+            REFERENCES users(telegram_id)
+            ON DELETE SET NULL,
 
-        return None
+        visited_at TIMESTAMPTZ
+            NOT NULL DEFAULT NOW(),
 
+        session_key TEXT,
+        user_agent TEXT
+    );
 
-async def set_marketing_allowed(
-    telegram_id: int,
-    allowed: bool,
-) -> None:
-    if not db_pool:
-        return
 
-    await db_pool.execute(
-        """
-        UPDATE users
-        SET
-            marketing_allowed = $2,
-            updated_at = NOW(),
-            is_active = TRUE,
-            blocked_at = NULL
-        WHERE telegram_id = $1
-        """,
-        telegram_id,
-        allowed,
-    )
+    CREATE INDEX IF NOT EXISTS idx_visits_visited_at
+    ON visits(visited_at);
 
 
-async def mark_send_success(
-    telegram_id: int,
-    send_type: str,
-) -> None:
-    if not db_pool:
-        return
+    CREATE INDEX IF NOT EXISTS idx_visits_telegram_id
+    ON visits(telegram_id);
 
-    if send_type == "broadcast":
-        await db_pool.execute(
-            """
-            UPDATE users
-            SET
-                is_active = TRUE,
-                blocked_at = NULL,
-                last_send_error = NULL,
-                last_successful_send_at = NOW(),
-                last_broadcast_at = NOW()
-            WHERE telegram_id = $1
-            """,
-            telegram_id,
-        )
 
-    elif send_type == "keyboard":
-        await db_pool.execute(
-            """
-            UPDATE users
-            SET
-                is_active = TRUE,
-                blocked_at = NULL,
-                last_send_error = NULL,
-                last_successful_send_at = NOW(),
-                last_keyboard_sent_at = NOW()
-            WHERE telegram_id = $1
-            """,
-            telegram_id,
-        )
+    CREATE TABLE IF NOT EXISTS orders (
+        id BIGSERIAL PRIMARY KEY,
 
-    else:
-        await db_pool.execute(
-            """
-            UPDATE users
-            SET
-                is_active = TRUE,
-                blocked_at = NULL,
-                last_send_error = NULL,
-                last_successful_send_at = NOW()
-            WHERE telegram_id = $1
-            """,
-            telegram_id,
-        )
+        telegram_id BIGINT NOT NULL
+            REFERENCES users(telegram_id)
+            ON DELETE RESTRICT,
 
+        source TEXT
+            NOT NULL DEFAULT 'mini_app',
 
-async def mark_send_error(
-    telegram_id: int,
-    error_text: str,
-    deactivate: bool,
-) -> None:
-    if not db_pool:
-        return
+        customer_name TEXT,
+        phone TEXT,
+        address TEXT,
+        address_plain TEXT,
+        payment_method TEXT,
 
-    await db_pool.execute(
-        """
-        UPDATE users
-        SET
-            is_active = CASE
-                WHEN $3 THEN FALSE
-                ELSE is_active
-            END,
+        delivery_fee INTEGER
+            NOT NULL DEFAULT 0,
 
-            blocked_at = CASE
-                WHEN $3 THEN NOW()
-                ELSE blocked_at
-            END,
+        items_total INTEGER
+            NOT NULL DEFAULT 0,
 
-            last_send_error = LEFT($2, 1000),
-            updated_at = NOW()
+        discount_percent INTEGER
+            NOT NULL DEFAULT 0,
 
-        WHERE telegram_id = $1
-        """,
-        telegram_id,
-        error_text,
-        deactivate,
-    )
+        discount_amount INTEGER
+            NOT NULL DEFAULT 0,
 
+        total INTEGER
+            NOT NULL DEFAULT 0,
 
-# ============================================================================
-# АВТОМАТИЧЕСКОЕ СОХРАНЕНИЕ ПОЛЬЗОВАТЕЛЯ
-# ============================================================================
+        order_when TEXT,
+        order_date DATE,
+        order_time TEXT,
+        comment TEXT,
 
-class UserTrackingMiddleware(
-    BaseMiddleware
-):
-    async def __call__(
-        self,
-        handler,
-        event,
-        data,
-    ):
-        user = data.get(
-            "event_from_user"
-        )
+        status TEXT
+            NOT NULL DEFAULT 'created',
 
-        if user:
-            await upsert_user(
-                user
-            )
+        created_at TIMESTAMPTZ
+            NOT NULL DEFAULT NOW()
+    );
 
-        return await handler(
-            event,
-            data,
-        )
 
+    /*
+     * Номер заказа назначает только бот.
+     * Первый новый номер: SM-472.
+     */
+    ALTER TABLE orders
+    ADD COLUMN IF NOT EXISTS order_number TEXT;
 
-dp.message.outer_middleware(
-    UserTrackingMiddleware()
-)
+    ALTER TABLE orders
+    ADD COLUMN IF NOT EXISTS bonus_used INTEGER NOT NULL DEFAULT 0;
 
-dp.callback_query.outer_middleware(
-    UserTrackingMiddleware()
-)
+    ALTER TABLE orders
+    ADD COLUMN IF NOT EXISTS cashback_percent INTEGER NOT NULL DEFAULT 0;
 
+    ALTER TABLE orders
+    ADD COLUMN IF NOT EXISTS cashback_earned INTEGER NOT NULL DEFAULT 0;
 
-# ============================================================================
-# ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
-# ============================================================================
+    ALTER TABLE orders
+    ADD COLUMN IF NOT EXISTS loyalty_request_id TEXT;
 
-def safe_int(
-    value,
-    default: int = 0,
-) -> int:
-    try:
-        return int(value)
+    /*
+     * Идемпотентный приём заказа: повторно доставленный
+     * payload Mini App возвращает уже созданный заказ.
+     */
+    ALTER TABLE orders
+    ADD COLUMN IF NOT EXISTS order_request_id TEXT;
 
-    except Exception:
-        return default
 
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_order_number
+    ON orders(order_number)
+    WHERE order_number IS NOT NULL;
 
-def safe_str(
-    value,
-    default: str = "",
-) -> str:
-    try:
-        if value is None:
-            return default
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_order_request_id
+    ON orders(order_request_id)
+    WHERE order_request_id IS NOT NULL;
 
-        return str(value)
 
-    except Exception:
-        return default
+    /*
+     * Последовательность хранится в PostgreSQL,
+     * поэтому не сбрасывается при Redeploy Railway.
+     *
+     * Если последовательность создаётся впервые,
+     * учитываем уже записанные номера SM-*.
+     */
+    DO $order_number_sequence$
+    DECLARE
+        max_existing_number BIGINT;
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1
+            FROM pg_class
+            WHERE relkind = 'S'
+              AND relname = 'sm_order_number_seq'
+        )
+        THEN
+            CREATE SEQUENCE sm_order_number_seq
+            START WITH 472
+            INCREMENT BY 1
+            MINVALUE 1
+            NO MAXVALUE
+            CACHE 1;
+
+            SELECT COALESCE(
+                MAX(
+                    CASE
+                        WHEN order_number ~ '^SM-[0-9]+$'
+                        THEN SUBSTRING(order_number FROM 4)::BIGINT
+                        ELSE NULL
+                    END
+                ),
+                471
+            )
+            INTO max_existing_number
+            FROM orders;
 
+            PERFORM setval(
+                'sm_order_number_seq',
+                GREATEST(max_existing_number, 471),
+                TRUE
+            );
+        END IF;
+    END
+    $order_number_sequence$;
 
-def is_admin(
-    telegram_id: int,
-) -> bool:
-    return (
-        telegram_id
-        == ADMIN_CHAT_ID
-    )
 
 
-def is_blocking_error(
-    error: Exception,
-) -> bool:
-    if isinstance(
-        error,
-        TelegramForbiddenError,
-    ):
-        return True
+    CREATE INDEX IF NOT EXISTS idx_orders_created_at
+    ON orders(created_at);
 
-    error_text = str(
-        error
-    ).lower()
 
-    blocking_phrases = (
-        "bot was blocked by the user",
-        "bot was blocked",
-        "chat not found",
-        "user is deactivated",
-        "bot was kicked",
-        "forbidden",
-    )
+    CREATE INDEX IF NOT EXISTS idx_orders_telegram_id
+    ON orders(telegram_id);
 
-    return any(
-        phrase in error_text
-        for phrase in blocking_phrases
-    )
 
+    CREATE TABLE IF NOT EXISTS order_items (
+        id BIGSERIAL PRIMARY KEY,
 
-def parse_money_amount(
-    value: str,
-) -> int | None:
-    cleaned = (
-        str(value or "")
-        .replace("฿", "")
-        .replace("₽", "")
-        .replace(" ", "")
-        .replace(",", "")
-        .strip()
-    )
+        order_id BIGINT NOT NULL
+            REFERENCES orders(id)
+            ON DELETE CASCADE,
 
-    if not cleaned.isdigit():
-        return None
+        item_name TEXT NOT NULL,
+        quantity INTEGER NOT NULL,
+        unit_price INTEGER NOT NULL,
+        image_url TEXT
+    );
 
-    amount = int(
-        cleaned
-    )
 
-    if (
-        amount < 0
-        or amount > 10_000_000
-    ):
-        return None
+    CREATE INDEX IF NOT EXISTS idx_order_items_order_id
+    ON order_items(order_id);
 
-    return amount
 
+    /*
+     * Очередь отправки заказов в чековую программу.
+     * draft — заказ ещё финализируется,
+     * pending — ждёт отправки,
+     * delivered — принят чековой программой,
+     * cancelled — заказ отменён.
+     */
+    CREATE TABLE IF NOT EXISTS print_jobs (
+        id BIGSERIAL PRIMARY KEY,
 
-def discount_by_spend(
-    total_spend: int,
-) -> int:
-    if total_spend >= 20_000:
-        return 20
+        order_id BIGINT NOT NULL UNIQUE
+            REFERENCES orders(id)
+            ON DELETE CASCADE,
 
-    if total_spend >= 15_000:
-        return 15
+        status TEXT
+            NOT NULL DEFAULT 'draft',
 
-    if total_spend >= 10_000:
-        return 10
+        payload JSONB,
 
-    if total_spend >= 5_000:
-        return 5
+        attempts INTEGER
+            NOT NULL DEFAULT 0,
 
-    return 0
+        next_attempt_at TIMESTAMPTZ
+            NOT NULL DEFAULT NOW(),
 
+        last_error TEXT,
 
-# ============================================================================
-# HEALTHCHECK И ПЛАНОВЫЙ ПЕРЕЗАПУСК
-# ============================================================================
+        alerted BOOLEAN
+            NOT NULL DEFAULT FALSE,
 
-def run_fake_server(
-    port: int = PORT,
-) -> None:
-    class Handler(
-        BaseHTTPRequestHandler
-    ):
-        def do_GET(self) -> None:
-            self.send_response(
-                200
-            )
+        created_at TIMESTAMPTZ
+            NOT NULL DEFAULT NOW(),
 
-            self.end_headers()
+        delivered_at TIMESTAMPTZ
+    );
 
-            self.wfile.write(
-                b"OK"
-            )
 
-        def log_message(
-            self,
-            format: str,
-            *args,
-        ) -> None:
-            return
+    CREATE INDEX IF NOT EXISTS idx_print_jobs_due
+    ON print_jobs(next_attempt_at)
+    WHERE status IN ('draft', 'pending');
 
-    server = HTTPServer(
-        (
-            "",
-            port,
-        ),
-        Handler,
-    )
 
-    threading.Thread(
-        target=server.serve_forever,
-        daemon=True,
-    ).start()
+    /*
+     * История массовых рассылок.
+     */
+    CREATE TABLE IF NOT EXISTS broadcast_logs (
+        id BIGSERIAL PRIMARY KEY,
+        broadcast_type TEXT,
+        created_by BIGINT,
+        source_chat_id BIGINT,
+        source_message_id BIGINT,
+        total_targets INTEGER NOT NULL DEFAULT 0,
+        delivered INTEGER NOT NULL DEFAULT 0,
+        blocked INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        status TEXT NOT NULL DEFAULT 'created',
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        completed_at TIMESTAMPTZ
+    );
 
 
-def schedule_restart() -> None:
-    if RESTART_MINUTES <= 0:
-        logger.info(
-            "Плановый перезапуск отключён"
-        )
-        return
+    ALTER TABLE broadcast_logs
+    ADD COLUMN IF NOT EXISTS broadcast_type TEXT;
 
-    def _restart() -> None:
-        global broadcast_running
 
-        if broadcast_running:
-            logger.warning(
-                "Перезапуск отложен: выполняется рассылка"
-            )
+    ALTER TABLE broadcast_logs
+    ADD COLUMN IF NOT EXISTS created_by BIGINT;
 
-            retry_timer = threading.Timer(
-                600,
-                _restart,
-            )
 
-            retry_timer.daemon = True
-            retry_timer.start()
+    ALTER TABLE broadcast_logs
+    ADD COLUMN IF NOT EXISTS source_chat_id BIGINT;
 
-            return
 
-        os.execv(
-            sys.executable,
-            [
-                sys.executable,
-                *sys.argv,
-            ],
-        )
+    ALTER TABLE broadcast_logs
+    ADD COLUMN IF NOT EXISTS source_message_id BIGINT;
 
-    timer = threading.Timer(
-        RESTART_MINUTES * 60,
-        _restart,
-    )
 
-    timer.daemon = True
-    timer.start()
+    ALTER TABLE broadcast_logs
+    ADD COLUMN IF NOT EXISTS total_targets
+        INTEGER NOT NULL DEFAULT 0;
 
 
-# ============================================================================
-# ПОДПИСАННАЯ ССЫЛКА MINI APP
-# ============================================================================
+    ALTER TABLE broadcast_logs
+    ADD COLUMN IF NOT EXISTS delivered
+        INTEGER NOT NULL DEFAULT 0;
 
-def build_signed_webapp_url(
-    user: types.User,
-) -> str:
-    payload = {
-        "i": user.id,
-        "n": user.username or "",
-        "f": user.first_name or "",
-        "l": user.last_name or "",
-        "t": int(time.time()),
-    }
 
-    payload_json = json.dumps(
-        payload,
-        ensure_ascii=False,
-        separators=(",", ":"),
-        sort_keys=True,
-    ).encode(
-        "utf-8"
-    )
+    ALTER TABLE broadcast_logs
+    ADD COLUMN IF NOT EXISTS blocked
+        INTEGER NOT NULL DEFAULT 0;
 
-    token = (
-        base64
-        .urlsafe_b64encode(
-            payload_json
-        )
-        .decode("ascii")
-        .rstrip("=")
-    )
 
-    signature = hmac.new(
-        API_TOKEN.encode(
-            "utf-8"
-        ),
-        token.encode(
-            "ascii"
-        ),
-        hashlib.sha256,
-    ).hexdigest()
+    ALTER TABLE broadcast_logs
+    ADD COLUMN IF NOT EXISTS failed
+        INTEGER NOT NULL DEFAULT 0;
 
-    parts = urlsplit(
-        WEBAPP_URL
-    )
 
-    query = dict(
-        parse_qsl(
-            parts.query,
-            keep_blank_values=True,
-        )
-    )
+    ALTER TABLE broadcast_logs
+    ADD COLUMN IF NOT EXISTS status
+        TEXT NOT NULL DEFAULT 'created';
 
-    query.update(
-        {
-            "u": token,
-            "s": signature,
-        }
-    )
 
-    return urlunsplit(
-        (
-            parts.scheme,
-            parts.netloc,
-            parts.path or "/",
-            urlencode(query),
-            parts.fragment,
-        )
-    )
+    ALTER TABLE broadcast_logs
+    ADD COLUMN IF NOT EXISTS created_at
+        TIMESTAMPTZ NOT NULL DEFAULT NOW();
 
 
-def start_keyboard(
-    user: types.User,
-) -> types.ReplyKeyboardMarkup:
-    web_app_btn = types.KeyboardButton(
-        text=MENU_BTN_TEXT,
-        web_app=types.WebAppInfo(
-            url=build_signed_webapp_url(
-                user
-            )
-        ),
-    )
+    ALTER TABLE broadcast_logs
+    ADD COLUMN IF NOT EXISTS completed_at
+        TIMESTAMPTZ;
 
-    ask_btn = types.KeyboardButton(
-        text=ASK_BTN_TEXT
-    )
 
-    return types.ReplyKeyboardMarkup(
-        keyboard=[
-            [
-                web_app_btn
-            ],
-            [
-                ask_btn
-            ],
-        ],
-        resize_keyboard=True,
-        is_persistent=True,
-    )
+    /*
+     * Исправление старой таблицы,
+     * где колонка называлась kind.
+     */
+    DO $broadcast_migration$
+    BEGIN
+        IF EXISTS (
+            SELECT 1
+            FROM information_schema.columns
+            WHERE table_schema = 'public'
+              AND table_name = 'broadcast_logs'
+              AND column_name = 'kind'
+        )
+        THEN
+            EXECUTE '
+                UPDATE broadcast_logs
+                SET broadcast_type =
+                    COALESCE(broadcast_type, kind)
+            ';
 
+            EXECUTE '
+                ALTER TABLE broadcast_logs
+                ALTER COLUMN kind DROP NOT NULL
+            ';
+        END IF;
+    END
+    $broadcast_migration$;
 
-def updated_keyboard(
-    user: types.User,
-) -> types.ReplyKeyboardMarkup:
-    return start_keyboard(
-        user
-    )
 
+    UPDATE broadcast_logs
+    SET broadcast_type = 'unknown'
+    WHERE broadcast_type IS NULL;
 
-async def send_main_keyboard(
-    message: types.Message,
-    text: str,
-    force: bool = False,
-) -> bool:
-    uid = message.from_user.id
 
-    if (
-        uid in KEYBOARD_SHOWN_USERS
-        and not force
-    ):
-        return False
+    ALTER TABLE broadcast_logs
+    ALTER COLUMN broadcast_type SET DEFAULT 'unknown';
 
-    await message.answer(
-        text,
-        reply_markup=start_keyboard(
-            message.from_user
-        ),
-    )
 
-    KEYBOARD_SHOWN_USERS.add(
-        uid
-    )
+    ALTER TABLE broadcast_logs
+    ALTER COLUMN broadcast_type SET NOT NULL;
 
-    return True
 
+    CREATE INDEX IF NOT EXISTS idx_broadcast_logs_created_at
+    ON broadcast_logs(created_at DESC);
 
-def make_user_from_database(
-    row: asyncpg.Record,
-) -> types.User:
-    return types.User(
-        id=int(
-            row["telegram_id"]
-        ),
-        is_bot=False,
-        first_name=(
-            row[
-                "telegram_first_name"
-            ]
-            or "Пользователь"
-        ),
-        last_name=row[
-            "telegram_last_name"
-        ],
-        username=row[
-            "username"
-        ],
-    )
 
+    /*
+     * Получатели каждой рассылки.
+     * pending — ещё не отправляли,
+     * sending — взяты в работу,
+     * delivered / blocked / failed — результат,
+     * skipped — отправка была прервана,
+     * повторно не отправляем.
+     */
+    CREATE TABLE IF NOT EXISTS broadcast_recipients (
+        broadcast_id BIGINT NOT NULL
+            REFERENCES broadcast_logs(id)
+            ON DELETE CASCADE,
 
-# ============================================================================
-# КНОПКИ
-# ============================================================================
+        telegram_id BIGINT NOT NULL,
 
-def build_admin_kb_full(
-    client_id: int,
-    order_id: int,
-) -> types.InlineKeyboardMarkup:
-    kb = InlineKeyboardBuilder()
+        status TEXT
+            NOT NULL DEFAULT 'pending',
 
-    kb.button(
-        text="👤 Открыть профиль клиента",
-        url=f"tg://user?id={client_id}",
-    )
+        processed_at TIMESTAMPTZ,
 
-    kb.button(
-        text="✍️ Написать клиенту",
-        callback_data=(
-            f"write_client:{client_id}"
-        ),
-    )
+        PRIMARY KEY (
+            broadcast_id,
+            telegram_id
+        )
+    );
 
-    kb.button(
-        text="🧾 Отправить чек",
-        callback_data=(
-            f"resend_receipt:{order_id}"
-        ),
-    )
 
-    kb.adjust(1)
+    CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_pending
+    ON broadcast_recipients(broadcast_id, telegram_id)
+    WHERE status = 'pending';
 
-    return kb.as_markup()
 
+    /*
+     * История ручных начислений лояльности.
+     */
+    CREATE TABLE IF NOT EXISTS loyalty_adjustments (
+        id BIGSERIAL PRIMARY KEY,
+        request_id TEXT UNIQUE,
+        telegram_id BIGINT NOT NULL,
+        previous_amount BIGINT NOT NULL DEFAULT 0,
+        new_amount BIGINT NOT NULL DEFAULT 0,
+        created_by BIGINT,
+        source TEXT NOT NULL DEFAULT 'manager_bonus',
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
 
-def build_admin_kb_safe(
-    client_id: int,
-    order_id: int,
-) -> types.InlineKeyboardMarkup:
-    kb = InlineKeyboardBuilder()
-
-    kb.button(
-        text="✍️ Написать клиенту",
-        callback_data=(
-            f"write_client:{client_id}"
-        ),
-    )
-
-    kb.button(
-        text="🧾 Отправить чек",
-        callback_data=(
-            f"resend_receipt:{order_id}"
-        ),
-    )
-
-    kb.adjust(1)
-
-    return kb.as_markup()
 
-def build_unsubscribe_keyboard(
-) -> types.InlineKeyboardMarkup:
-    kb = InlineKeyboardBuilder()
+    CREATE INDEX IF NOT EXISTS idx_loyalty_adjustments_user
+    ON loyalty_adjustments(telegram_id);
 
-    kb.button(
-        text="🔕 Не получать рекламу",
-        callback_data="unsubscribe_ads",
-    )
 
-    return kb.as_markup()
+    CREATE INDEX IF NOT EXISTS idx_loyalty_adjustments_created
+    ON loyalty_adjustments(created_at DESC);
+"""
 
 
-def build_broadcast_confirm_keyboard(
-) -> types.InlineKeyboardMarkup:
-    kb = InlineKeyboardBuilder()
+MENU_CATALOG_SQL = """
+    /*
+     * Каталог меню. Бот проверяет заказы по нему,
+     * поэтому смена цены или наличия не требует деплоя.
+     */
+    CREATE TABLE IF NOT EXISTS menu_items (
+        name TEXT PRIMARY KEY,
+        price INTEGER NOT NULL CHECK (price >= 0),
+        is_available BOOLEAN NOT NULL DEFAULT TRUE,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
 
-    kb.button(
-        text="✅ Начать рассылку",
-        callback_data="broadcast_confirm",
-    )
 
-    kb.button(
-        text="❌ Отменить",
-        callback_data="broadcast_cancel",
-    )
+    CREATE TABLE IF NOT EXISTS menu_price_history (
+        id BIGSERIAL PRIMARY KEY,
+        item_name TEXT NOT NULL,
+        old_price INTEGER,
+        new_price INTEGER NOT NULL,
+        changed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
 
-    kb.adjust(1)
 
-    return kb.as_markup()
+    CREATE INDEX IF NOT EXISTS idx_menu_price_history_item
+    ON menu_price_history(item_name, changed_at DESC);
 
 
-def build_keyboard_update_confirm(
-) -> types.InlineKeyboardMarkup:
-    kb = InlineKeyboardBuilder()
+    /*
+     * Единственная строка с версией каталога.
+     */
+    CREATE TABLE IF NOT EXISTS menu_catalog_version (
+        id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+        version BIGINT NOT NULL DEFAULT 1,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
 
-    kb.button(
-        text="✅ Отправить клавиатуру всем",
-        callback_data="keyboard_update_confirm",
-    )
 
-    kb.button(
-        text="❌ Отменить",
-        callback_data="keyboard_update_cancel",
-    )
+    INSERT INTO menu_catalog_version (id)
+    VALUES (TRUE)
+    ON CONFLICT (id) DO NOTHING;
 
-    kb.adjust(1)
 
-    return kb.as_markup()
+    CREATE OR REPLACE FUNCTION menu_items_track_price()
+    RETURNS TRIGGER
+    LANGUAGE plpgsql
+    AS $$
+    BEGIN
+        IF TG_OP = 'INSERT'
+           OR OLD.price IS DISTINCT FROM NEW.price THEN
+            INSERT INTO menu_price_history (
+                item_name,
+                old_price,
+                new_price
+            )
+            VALUES (
+                NEW.name,
+                CASE WHEN TG_OP = 'UPDATE' THEN OLD.price END,
+                NEW.price
+            );
 
+            NEW.updated_at := NOW();
+        END IF;
 
-# ============================================================================
-# ОТПРАВКА ЗАКАЗА МЕНЕДЖЕРУ
-# ============================================================================
+        IF TG_OP = 'UPDATE'
+           AND OLD.is_available IS DISTINCT FROM NEW.is_available THEN
+            NEW.updated_at := NOW();
+        END IF;
 
-async def send_order_to_admin(
-    admin_text_html: str,
-    client_id: int,
-    order_id: int,
-) -> None:
-    try:
-        await bot.send_message(
-            ADMIN_CHAT_ID,
-            admin_text_html,
-            parse_mode="HTML",
-            reply_markup=(
-                build_admin_kb_full(
-                    client_id,
-                    order_id,
-                )
-            ),
-        )
+        RETURN NEW;
+    END;
+    $$;
 
-        logger.info(
-            "ADMIN: заказ отправлен с полной клавиатурой"
-        )
 
-    except Exception as exc:
-        error_text = str(
-            exc
-        )
+    CREATE OR REPLACE FUNCTION menu_items_bump_version()
+    RETURNS TRIGGER
+    LANGUAGE plpgsql
+    AS $$
+    DECLARE
+        new_version BIGINT;
+    BEGIN
+        UPDATE menu_catalog_version
+        SET
+            version = version + 1,
+            updated_at = NOW()
+        RETURNING version INTO new_version;
 
-        logger.error(
-            "ADMIN send failed: %s",
-            error_text,
-        )
+        PERFORM pg_notify(
+            'menu_catalog',
+            new_version::TEXT
+        );
 
-        if (
-            "BUTTON_USER_PRIVACY_RESTRICTED"
-            in error_text
-        ):
-            await bot.send_message(
-                ADMIN_CHAT_ID,
-                admin_text_html,
-                parse_mode="HTML",
-                reply_markup=(
-                    build_admin_kb_safe(
-                        client_id,
-                        order_id,
-                    )
-                ),
-            )
+        RETURN NULL;
+    END;
+    $$;
 
-            return
 
-        raise
+    DROP TRIGGER IF EXISTS trg_menu_items_track_price
+    ON menu_items;
 
+    CREATE TRIGGER trg_menu_items_track_price
+    BEFORE INSERT OR UPDATE ON menu_items
+    FOR EACH ROW
+    EXECUTE FUNCTION menu_items_track_price();
 
-# ============================================================================
-# ЗАЩИЩЁННАЯ СИСТЕМА ЛОЯЛЬНОСТИ
-# ============================================================================
 
-def make_loyalty_signature_payload(
-    telegram_id: int,
-    order_ref: str,
-    items_total: int,
-    delivery: int,
-    requested_bonus: int,
-    timestamp: int,
-) -> str:
-    return "|".join(
-        [
-            str(telegram_id),
-            str(order_ref),
-            str(items_total),
-            str(delivery),
-            str(requested_bonus),
-            str(timestamp),
-        ]
-    )
+    DROP TRIGGER IF EXISTS trg_menu_items_bump_version
+    ON menu_items;
 
+    CREATE TRIGGER trg_menu_items_bump_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON menu_items
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION menu_items_bump_version();
+"""
 
-async def settle_loyalty_order(
-    telegram_id: int,
-    order_ref: str,
-    items_total: int,
-    delivery: int,
-    requested_bonus: int,
-) -> dict:
-    timestamp = int(time.time())
-    body = {
-        "telegramId": str(telegram_id),
-        "orderRef": str(order_ref),
-        "itemsTotal": int(items_total),
-        "delivery": int(delivery),
-        "requestedBonus": int(requested_bonus),
-    }
 
-    signature_payload = make_loyalty_signature_payload(
-        telegram_id,
-        order_ref,
-        items_total,
-        delivery,
-        requested_bonus,
-        timestamp,
+async def seed_menu_items(
+    conn: asyncpg.Connection,
+) -> None:
+    """
+    Переносит прежний словарь цен в пустую таблицу menu_items.
+    """
+    await conn.execute(
+        """
+        INSERT INTO menu_items (
+            name,
+            price
+        )
+        SELECT
+            item.name,
+            item.price
+        FROM unnest(
+            $1::TEXT[],
+            $2::INTEGER[]
+        ) AS item(name, price)
+        WHERE NOT EXISTS (
+            SELECT 1
+            FROM menu_items
+        )
+        """,
+        list(MENU_PRICE_MAP.keys()),
+        list(MENU_PRICE_MAP.values()),
     )
 
-    signature = hmac.new(
-        API_TOKEN.encode("utf-8"),
-        signature_payload.encode("utf-8"),
-        hashlib.sha256,
-    ).hexdigest()
-
-    timeout = aiohttp.ClientTimeout(total=20)
 
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        async with session.post(
-            LOYALTY_SETTLE_URL,
-            json=body,
-            headers={
-                "X-Loyalty-Timestamp": str(timestamp),
-                "X-Loyalty-Signature": signature,
-            },
-        ) as response:
-            raw = await response.text()
+# Шаги схемы: (версия, название, SQL или функция от соединения).
+# Каждый шаг применяется один раз в своей транзакции.
+# Новые шаги добавляются только в конец, уже выпущенные не меняются.
+MIGRATIONS: list[
+    tuple[
+        int,
+        str,
+        str | Callable[[asyncpg.Connection], Awaitable[None]],
+    ]
+] = [
+    (1, "baseline schema", SCHEMA_BASELINE_SQL),
+    (2, "menu catalog", MENU_CATALOG_SQL),
+    (3, "menu catalog seed", seed_menu_items),
+    (
+        4,
+        "admin states",
+        """
+        /*
+         * Незавершённые диалоги администратора:
+         * переживают перезапуск и видны всем экземплярам бота.
+         */
+        CREATE TABLE IF NOT EXISTS admin_states (
+            admin_id BIGINT NOT NULL,
+            state_key TEXT NOT NULL,
+            data JSONB NOT NULL DEFAULT '{}'::JSONB,
+            expires_at TIMESTAMPTZ NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (admin_id, state_key)
+        );
+
+
+        CREATE INDEX IF NOT EXISTS idx_admin_states_expires_at
+        ON admin_states(expires_at);
+        """,
+    ),
+    (
+        5,
+        "singleton leases",
+        """
+        /*
+         * Аренды одиночных задач: рассылки, перезапуск,
+         * очистка состояний. Держатель — INSTANCE_ID.
+         */
+        CREATE TABLE IF NOT EXISTS singleton_leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL,
+            acquired_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """,
+    ),
+    (
+        6,
+        "daily stats",
+        """
+        /*
+         * Дневная статистика по бангкокской дате.
+         * Итоги по пользователям — снимок на момент пересчёта;
+         * после закрытия дня строка помечается is_final.
+         */
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            stat_date DATE PRIMARY KEY,
+            total_users INTEGER NOT NULL DEFAULT 0,
+            active_users INTEGER NOT NULL DEFAULT 0,
+            marketing_users INTEGER NOT NULL DEFAULT 0,
+            blocked_users INTEGER NOT NULL DEFAULT 0,
+            active_today INTEGER NOT NULL DEFAULT 0,
+            new_users INTEGER NOT NULL DEFAULT 0,
+            visits INTEGER NOT NULL DEFAULT 0,
+            unique_visitors INTEGER NOT NULL DEFAULT 0,
+            orders_count INTEGER NOT NULL DEFAULT 0,
+            buyers INTEGER NOT NULL DEFAULT 0,
+            revenue BIGINT NOT NULL DEFAULT 0,
+            is_final BOOLEAN NOT NULL DEFAULT FALSE,
+            refreshed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """,
+    ),
+    (
+        7,
+        "analytics cache",
+        """
+        /*
+         * Метрики закрытых периодов для /stats.
+         * Закрытый период больше не меняется и считается один раз.
+         */
+        CREATE TABLE IF NOT EXISTS analytics_cache (
+            period_start DATE NOT NULL,
+            period_end DATE NOT NULL,
+            metrics JSONB NOT NULL,
+            computed_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (period_start, period_end)
+        );
+        """,
+    ),
+    (
+        8,
+        "print jobs without drafts",
+        """
+        /*
+         * Задача печати пишется вместе с заказом одним запросом
+         * и сразу готова к отправке: черновиков больше нет.
+         */
+        UPDATE print_jobs
+        SET status = 'pending'
+        WHERE status = 'draft';
+
+        ALTER TABLE print_jobs
+        ALTER COLUMN status SET DEFAULT 'pending';
+
+        DROP INDEX IF EXISTS idx_print_jobs_due;
+
+        CREATE INDEX idx_print_jobs_due
+        ON print_jobs(next_attempt_at)
+        WHERE status = 'pending';
+        """,
+    ),
+    (
+        9,
+        "broadcast owner",
+        """
+        /*
+         * Процесс (INSTANCE_ID), который ведёт рассылку.
+         * Итог рассылки записывает только её владелец.
+         */
+        ALTER TABLE broadcast_logs
+        ADD COLUMN IF NOT EXISTS owner TEXT;
+        """,
+    ),
+    (
+        10,
+        "daily stats user snapshot",
+        """
+        /*
+         * Итоги по пользователям — снимок, который можно снять
+         * только в течение самого дня. Для досчитанных задним
+         * числом дней снимка нет: NULL.
+         */
+        ALTER TABLE daily_stats
+            ALTER COLUMN total_users DROP NOT NULL,
+            ALTER COLUMN active_users DROP NOT NULL,
+            ALTER COLUMN marketing_users DROP NOT NULL,
+            ALTER COLUMN blocked_users DROP NOT NULL,
+            ALTER COLUMN active_today DROP NOT NULL;
+
+        -- Строки, посчитанные заметно позже конца дня,
+        -- записаны с текущими итогами пользователей.
+        UPDATE daily_stats
+        SET
+            total_users = NULL,
+            active_users = NULL,
+            marketing_users = NULL,
+            blocked_users = NULL,
+            active_today = NULL
+        WHERE
+            is_final = TRUE
+            AND refreshed_at > (
+                (stat_date + 1)::TIMESTAMP
+                AT TIME ZONE 'Asia/Bangkok'
+            ) + INTERVAL '1 hour';
+        """,
+    ),
+]
 
-            try:
-                result = json.loads(raw)
-            except Exception:
-                result = {"ok": False, "error": raw[:500]}
 
-            if response.status != 200 or not result.get("ok"):
-                raise RuntimeError(
-                    result.get("error")
-                    or f"Loyalty HTTP {response.status}"
-                )
+async def get_schema_version(
+    conn: asyncpg.Connection,
+) -> int:
+    try:
+        return int(
+            await conn.fetchval(
+                """
+                SELECT COALESCE(MAX(version), 0)
+                FROM schema_migrations
+                """
+            )
+        )
 
-            return result
+    except asyncpg.UndefinedTableError:
+        return 0
 
 
-async def update_saved_order_loyalty(
-    order_id: int,
-    bonus_used: int,
-    cashback_percent: int,
-    cashback_earned: int,
-    final_total: int,
-    loyalty_request_id: str,
+async def apply_migrations(
+    conn: asyncpg.Connection,
 ) -> None:
     """
-    Обновляет бонусы и итог заказа.
+    Доводит схему до последней версии.
 
-    Номер SM-* является только номером заказа.
-    Нумерацию кассовых чеков ведёт printer_gui.py.
+    Тёплый старт — один запрос версии. Иначе недостающие шаги
+    применяются под advisory lock, чтобы два экземпляра бота
+    не мигрировали базу одновременно.
     """
-    if not db_pool:
-        raise RuntimeError("База данных не подключена")
+    latest_version = MIGRATIONS[-1][0]
 
-    result = await db_pool.execute(
-        """
-        UPDATE orders
-        SET
-            discount_percent = 0,
-            discount_amount = $2,
-            bonus_used = $2,
-            cashback_percent = $3,
-            cashback_earned = $4,
-            total = $5,
-            loyalty_request_id = $6
-        WHERE id = $1
-        """,
-        order_id,
-        bonus_used,
-        cashback_percent,
-        cashback_earned,
-        final_total,
-        loyalty_request_id,
+    if await get_schema_version(conn) >= latest_version:
+        return
+
+    await conn.execute(
+        "SELECT pg_advisory_lock($1)",
+        SCHEMA_MIGRATIONS_LOCK_KEY,
     )
 
-    if result != "UPDATE 1":
-        raise RuntimeError(
-            "Заказ не найден при финализации"
+    try:
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+            """
         )
 
+        # Пока ждали блокировку, шаги мог применить другой экземпляр.
+        applied = {
+            row["version"]
+            for row in await conn.fetch(
+                """
+                SELECT version
+                FROM schema_migrations
+                """
+            )
+        }
 
-async def cancel_saved_order(order_id: int) -> None:
-    if db_pool:
-        await db_pool.execute(
-            "UPDATE orders SET status='cancelled' WHERE id=$1",
-            order_id,
-        )
+        for version, name, step in MIGRATIONS:
+            if version in applied:
+                continue
 
+            started = time.monotonic()
 
-# ============================================================================
-# СОХРАНЕНИЕ ЗАКАЗА В БАЗУ
-# ============================================================================
+            async with conn.transaction():
+                if isinstance(step, str):
+                    await conn.execute(
+                        step
+                    )
 
-async def save_order_to_database(
-    user: types.User,
-    data: dict,
-    order_items: list[dict],
-) -> tuple[int, str]:
-    """
-    Сохраняет заказ и атомарно получает следующий номер SM-*.
+                else:
+                    await step(
+                        conn
+                    )
 
-    SM-* — это внутренний номер заказа, а не номер кассового чека.
-    Пропуски в номерах заказов допустимы. Нумерацию чеков ведёт
-    локальная программа printer_gui.py.
-    """
+                await conn.execute(
+                    """
+                    INSERT INTO schema_migrations (
+                        version,
+                        name
+                    )
+                    VALUES (
+                        $1,
+                        $2
+                    )
+                    """,
+                    version,
+                    name,
+                )
 
-    if not db_pool:
-        raise RuntimeError(
-            "База данных не подключена"
+            logger.info(
+                "Миграция применена: version=%s name=%s (%.2f с)",
+                version,
+                name,
+                time.monotonic() - started,
+            )
+
+    finally:
+        await conn.execute(
+            "SELECT pg_advisory_unlock($1)",
+            SCHEMA_MIGRATIONS_LOCK_KEY,
         )
 
-    await upsert_user(
-        user
-    )
 
-    items_total = sum(
-        max(
-            0,
-            safe_int(
-                item.get("qty")
+async def init_database() -> None:
+    global db_pool
+
+    db_pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=1,
+        max_size=5,
+        command_timeout=30,
+    )
+
+    async with db_pool.acquire() as conn:
+        await apply_migrations(
+            conn
+        )
+
+        await interrupt_orphaned_broadcasts(
+            conn
+        )
+
+    logger.info(
+        "База данных подключена, таблицы готовы"
+    )
+
+
+async def interrupt_orphaned_broadcasts(
+    conn: asyncpg.Connection | asyncpg.Pool,
+) -> None:
+    """
+    Помечает interrupted рассылки в статусе running, владелец
+    которых не держит живую аренду рассылок: его процесс
+    упал или перезапустился.
+    """
+    await conn.execute(
+        """
+        UPDATE broadcast_logs AS l
+        SET
+            status = 'interrupted',
+            completed_at = NOW()
+        WHERE
+            l.status = 'running'
+            AND NOT EXISTS (
+                SELECT 1
+                FROM singleton_leases s
+                WHERE
+                    s.name = $1
+                    AND s.holder = l.owner
+                    AND s.expires_at > NOW()
+            )
+        """,
+        LEASE_BROADCAST,
+    )
+
+
+async def upsert_user(
+    user: types.User | None,
+) -> asyncpg.Record | None:
+    if not db_pool or not user:
+        return None
+
+    if user.is_bot:
+        return None
+
+    try:
+        row = await db_pool.fetchrow(
+            """
+            INSERT INTO users (
+                telegram_id,
+                username,
+                telegram_first_name,
+                telegram_last_name,
+                created_at,
+                updated_at,
+                last_bot_activity_at,
+                is_active,
+                blocked_at,
+                last_send_error
+            )
+            VALUES (
+                $1,
+                $2,
+                $3,
+                $4,
+                NOW(),
+                NOW(),
+                NOW(),
+                TRUE,
+                NULL,
+                NULL
+            )
+
+            ON CONFLICT (telegram_id)
+            DO UPDATE SET
+                username = EXCLUDED.username,
+                telegram_first_name = EXCLUDED.telegram_first_name,
+                telegram_last_name = EXCLUDED.telegram_last_name,
+                updated_at = NOW(),
+                last_bot_activity_at = NOW(),
+                is_active = TRUE,
+                blocked_at = NULL,
+                last_send_error = NULL
+
+            RETURNING
+                telegram_id,
+                username,
+                telegram_first_name,
+                telegram_last_name,
+                created_at,
+                last_bot_activity_at,
+                manual_spend
+            """,
+            user.id,
+            user.username,
+            user.first_name,
+            user.last_name,
+        )
+
+        remember_known_user(
+            int(row["telegram_id"])
+        )
+
+        # Новый или разблокированный пользователь меняет число получателей.
+        invalidate_broadcast_target_counts()
+
+        logger.info(
+            "USER SAVED: id=%s username=@%s name=%s %s",
+            row["telegram_id"],
+            row["username"] or "-",
+            row["telegram_first_name"] or "",
+            row["telegram_last_name"] or "",
+        )
+
+        return row
+
+    except Exception:
+        logger.exception(
+            "USER SAVE ERROR: id=%s",
+            getattr(
+                user,
+                "id",
+                "unknown",
+            ),
+        )
+
+        return None
+
+
+async def touch_user(
+    user: types.User | None,
+) -> None:
+    """
+    Отмечает активность пользователя.
+
+    Новый пользователь сразу записывается в базу, чтобы на него
+    могли ссылаться заказы. Для уже известных пользователей
+    активность только накапливается в памяти и сбрасывается
+    в базу пачкой фоновой задачей.
+    """
+    if not db_pool or not user:
+        return
+
+    if user.is_bot:
+        return
+
+    if user.id not in KNOWN_USER_IDS:
+        await upsert_user(
+            user
+        )
+        return
+
+    remember_known_user(
+        user.id
+    )
+
+    pending_user_activity[
+        user.id
+    ] = (
+        user.username,
+        user.first_name,
+        user.last_name,
+        datetime.now(
+            timezone.utc
+        ),
+    )
+
+    if (
+        len(pending_user_activity)
+        >= USER_ACTIVITY_FLUSH_USERS
+    ):
+        user_activity_wakeup.set()
+
+
+async def flush_user_activity() -> int:
+    global pending_user_activity
+
+    if (
+        not db_pool
+        or not pending_user_activity
+    ):
+        return 0
+
+    batch = pending_user_activity
+    pending_user_activity = {}
+
+    telegram_ids = list(batch)
+
+    try:
+        reactivated = await db_pool.fetchval(
+            """
+            WITH a AS (
+                SELECT *
+                FROM unnest(
+                    $1::BIGINT[],
+                    $2::TEXT[],
+                    $3::TEXT[],
+                    $4::TEXT[],
+                    $5::TIMESTAMPTZ[]
+                ) AS a(
+                    telegram_id,
+                    username,
+                    first_name,
+                    last_name,
+                    touched_at
+                )
+            ),
+
+            /*
+             * Снимок до вставки: был ли среди них
+             * неактивный пользователь.
+             */
+            inactive AS (
+                SELECT EXISTS (
+                    SELECT 1
+                    FROM users u
+                    JOIN a
+                        ON a.telegram_id = u.telegram_id
+                    WHERE u.is_active = FALSE
+                ) AS found
             ),
+
+            upserted AS (
+                INSERT INTO users (
+                    telegram_id,
+                    username,
+                    telegram_first_name,
+                    telegram_last_name,
+                    created_at,
+                    updated_at,
+                    last_bot_activity_at,
+                    is_active,
+                    blocked_at,
+                    last_send_error
+                )
+                SELECT
+                    a.telegram_id,
+                    a.username,
+                    a.first_name,
+                    a.last_name,
+                    a.touched_at,
+                    a.touched_at,
+                    a.touched_at,
+                    TRUE,
+                    NULL,
+                    NULL
+                FROM a
+
+                ON CONFLICT (telegram_id)
+                DO UPDATE SET
+                    username = EXCLUDED.username,
+                    telegram_first_name = EXCLUDED.telegram_first_name,
+                    telegram_last_name = EXCLUDED.telegram_last_name,
+                    updated_at = NOW(),
+
+                    last_bot_activity_at = GREATEST(
+                        users.last_bot_activity_at,
+                        EXCLUDED.last_bot_activity_at
+                    ),
+
+                    /*
+                     * Ошибка отправки, записанная уже после
+                     * активности, не должна затираться.
+                     */
+                    is_active = CASE
+                        WHEN users.blocked_at IS NULL
+                          OR users.blocked_at
+                             <= EXCLUDED.last_bot_activity_at
+                        THEN TRUE
+                        ELSE users.is_active
+                    END,
+
+                    blocked_at = CASE
+                        WHEN users.blocked_at IS NULL
+                          OR users.blocked_at
+                             <= EXCLUDED.last_bot_activity_at
+                        THEN NULL
+                        ELSE users.blocked_at
+                    END,
+
+                    last_send_error = CASE
+                        WHEN users.blocked_at IS NULL
+                          OR users.blocked_at
+                             <= EXCLUDED.last_bot_activity_at
+                        THEN NULL
+                        ELSE users.last_send_error
+                    END
+            )
+
+            SELECT found
+            FROM inactive
+            """,
+            telegram_ids,
+            [batch[uid][0] for uid in telegram_ids],
+            [batch[uid][1] for uid in telegram_ids],
+            [batch[uid][2] for uid in telegram_ids],
+            [batch[uid][3] for uid in telegram_ids],
+        )
+
+    except (Exception, asyncio.CancelledError) as exc:
+        # Возвращаем пачку, не затирая более свежие отметки.
+        for uid, value in batch.items():
+            pending_user_activity.setdefault(
+                uid,
+                value,
+            )
+
+        if isinstance(exc, asyncio.CancelledError):
+            raise
+
+        logger.exception(
+            "USER ACTIVITY FLUSH ERROR: users=%s",
+            len(batch),
+        )
+
+        return 0
+
+    if reactivated:
+        invalidate_broadcast_target_counts()
+
+    return len(batch)
+
+
+async def user_activity_flush_loop() -> None:
+    while True:
+        try:
+            await asyncio.wait_for(
+                user_activity_wakeup.wait(),
+                timeout=USER_ACTIVITY_FLUSH_MS / 1000,
+            )
+
+        except asyncio.TimeoutError:
+            pass
+
+        user_activity_wakeup.clear()
+
+        await flush_user_activity()
+
+
+def start_user_activity_buffer() -> None:
+    global user_activity_task
+
+    if user_activity_task is None:
+        user_activity_task = asyncio.create_task(
+            user_activity_flush_loop()
+        )
+
+
+async def stop_user_activity_buffer() -> None:
+    global user_activity_task
+
+    if user_activity_task is not None:
+        user_activity_task.cancel()
+
+        try:
+            await user_activity_task
+
+        except asyncio.CancelledError:
+            pass
+
+        user_activity_task = None
+
+    flushed = await flush_user_activity()
+
+    if flushed:
+        logger.info(
+            "Активность пользователей сохранена перед остановкой: %s",
+            flushed,
+        )
+
+
+async def set_marketing_allowed(
+    telegram_id: int,
+    allowed: bool,
+) -> None:
+    if not db_pool:
+        return
+
+    await db_pool.execute(
+        """
+        UPDATE users
+        SET
+            marketing_allowed = $2,
+            updated_at = NOW(),
+            is_active = TRUE,
+            blocked_at = NULL
+        WHERE telegram_id = $1
+        """,
+        telegram_id,
+        allowed,
+    )
+
+    invalidate_broadcast_target_counts()
+
+
+async def mark_send_success(
+    telegram_id: int,
+    send_type: str,
+) -> None:
+    if not db_pool:
+        return
+
+    if send_type == "broadcast":
+        await db_pool.execute(
+            """
+            UPDATE users
+            SET
+                is_active = TRUE,
+                blocked_at = NULL,
+                last_send_error = NULL,
+                last_successful_send_at = NOW(),
+                last_broadcast_at = NOW()
+            WHERE telegram_id = $1
+            """,
+            telegram_id,
+        )
+
+    elif send_type == "keyboard":
+        await db_pool.execute(
+            """
+            UPDATE users
+            SET
+                is_active = TRUE,
+                blocked_at = NULL,
+                last_send_error = NULL,
+                last_successful_send_at = NOW(),
+                last_keyboard_sent_at = NOW()
+            WHERE telegram_id = $1
+            """,
+            telegram_id,
+        )
+
+    else:
+        await db_pool.execute(
+            """
+            UPDATE users
+            SET
+                is_active = TRUE,
+                blocked_at = NULL,
+                last_send_error = NULL,
+                last_successful_send_at = NOW()
+            WHERE telegram_id = $1
+            """,
+            telegram_id,
+        )
+
+
+async def mark_send_error(
+    telegram_id: int,
+    error_text: str,
+    deactivate: bool,
+) -> None:
+    if not db_pool:
+        return
+
+    await db_pool.execute(
+        """
+        UPDATE users
+        SET
+            is_active = CASE
+                WHEN $3 THEN FALSE
+                ELSE is_active
+            END,
+
+            blocked_at = CASE
+                WHEN $3 THEN NOW()
+                ELSE blocked_at
+            END,
+
+            last_send_error = LEFT($2, 1000),
+            updated_at = NOW()
+
+        WHERE telegram_id = $1
+        """,
+        telegram_id,
+        error_text,
+        deactivate,
+    )
+
+    if deactivate:
+        invalidate_broadcast_target_counts()
+
+
+# ============================================================================
+# АВТОМАТИЧЕСКОЕ СОХРАНЕНИЕ ПОЛЬЗОВАТЕЛЯ
+# ============================================================================
+
+class UserTrackingMiddleware(
+    BaseMiddleware
+):
+    async def __call__(
+        self,
+        handler,
+        event,
+        data,
+    ):
+        user = data.get(
+            "event_from_user"
+        )
+
+        if user:
+            await touch_user(
+                user
+            )
+
+        return await handler(
+            event,
+            data,
+        )
+
+
+dp.message.outer_middleware(
+    UserTrackingMiddleware()
+)
+
+dp.callback_query.outer_middleware(
+    UserTrackingMiddleware()
+)
+
+
+# ============================================================================
+# ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
+# ============================================================================
+
+def safe_int(
+    value,
+    default: int = 0,
+) -> int:
+    try:
+        return int(value)
+
+    except Exception:
+        return default
+
+
+def safe_str(
+    value,
+    default: str = "",
+) -> str:
+    try:
+        if value is None:
+            return default
+
+        return str(value)
+
+    except Exception:
+        return default
+
+
+def is_admin(
+    telegram_id: int,
+) -> bool:
+    return (
+        telegram_id
+        == ADMIN_CHAT_ID
+    )
+
+
+def is_blocking_error(
+    error: Exception,
+) -> bool:
+    if isinstance(
+        error,
+        TelegramForbiddenError,
+    ):
+        return True
+
+    error_text = str(
+        error
+    ).lower()
+
+    blocking_phrases = (
+        "bot was blocked by the user",
+        "bot was blocked",
+        "chat not found",
+        "user is deactivated",
+        "bot was kicked",
+        "forbidden",
+    )
+
+    return any(
+        phrase in error_text
+        for phrase in blocking_phrases
+    )
+
+
+def parse_money_amount(
+    value: str,
+) -> int | None:
+    cleaned = (
+        str(value or "")
+        .replace("฿", "")
+        .replace("₽", "")
+        .replace(" ", "")
+        .replace(",", "")
+        .strip()
+    )
+
+    if not cleaned.isdigit():
+        return None
+
+    amount = int(
+        cleaned
+    )
+
+    if (
+        amount < 0
+        or amount > 10_000_000
+    ):
+        return None
+
+    return amount
+
+
+def discount_by_spend(
+    total_spend: int,
+) -> int:
+    if total_spend >= 20_000:
+        return 20
+
+    if total_spend >= 15_000:
+        return 15
+
+    if total_spend >= 10_000:
+        return 10
+
+    if total_spend >= 5_000:
+        return 5
+
+    return 0
+
+
+# ============================================================================
+# КООРДИНАЦИЯ НЕСКОЛЬКИХ ЭКЗЕМПЛЯРОВ
+# ============================================================================
+
+LEASE_BROADCAST = "broadcast"
+LEASE_RESTART = "restart"
+LEASE_ADMIN_STATE_SWEEP = "admin_state_sweep"
+LEASE_DAILY_STATS = "daily_stats"
+
+
+async def try_acquire_lease(
+    name: str,
+    ttl_seconds: float,
+) -> bool:
+    """
+    Берёт или продлевает аренду. Чужую аренду можно забрать
+    только после истечения её срока.
+    """
+    if not db_pool:
+        return False
+
+    holder = await db_pool.fetchval(
+        """
+        INSERT INTO singleton_leases (
+            name,
+            holder,
+            expires_at,
+            acquired_at
+        )
+        VALUES (
+            $1,
+            $2,
+            NOW() + make_interval(secs => $3),
+            NOW()
+        )
+        ON CONFLICT (name)
+        DO UPDATE SET
+            holder = EXCLUDED.holder,
+            expires_at = EXCLUDED.expires_at,
+            acquired_at = CASE
+                WHEN singleton_leases.holder = EXCLUDED.holder
+                THEN singleton_leases.acquired_at
+                ELSE NOW()
+            END
+        WHERE
+            singleton_leases.holder = EXCLUDED.holder
+            OR singleton_leases.expires_at <= NOW()
+        RETURNING holder
+        """,
+        name,
+        INSTANCE_ID,
+        float(ttl_seconds),
+    )
+
+    return holder == INSTANCE_ID
+
+
+async def release_lease(
+    name: str,
+) -> None:
+    if not db_pool:
+        return
+
+    await db_pool.execute(
+        """
+        DELETE FROM singleton_leases
+        WHERE
+            name = $1
+            AND holder = $2
+        """,
+        name,
+        INSTANCE_ID,
+    )
+
+
+async def lease_held_elsewhere(
+    name: str,
+) -> bool:
+    if not db_pool:
+        return False
+
+    return bool(
+        await db_pool.fetchval(
+            """
+            SELECT EXISTS (
+                SELECT 1
+                FROM singleton_leases
+                WHERE
+                    name = $1
+                    AND holder <> $2
+                    AND expires_at > NOW()
+            )
+            """,
+            name,
+            INSTANCE_ID,
+        )
+    )
+
+
+class Lease:
+    """
+    Аренда, которую экземпляр держит, пока идёт работа.
+
+    Повторный acquire внутри процесса только увеличивает счётчик,
+    фоновая задача продлевает аренду. Если продлить не удалось,
+    вызывается on_lost: работу нужно прервать, её подхватит
+    другой экземпляр.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        ttl_seconds: float = LEASE_TTL_SECONDS,
+        renew_seconds: float = LEASE_RENEW_SECONDS,
+        on_lost: Callable[[], None] | None = None,
+    ) -> None:
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.renew_seconds = renew_seconds
+        self.on_lost = on_lost
+        self._holds = 0
+        self._renew_task: asyncio.Task | None = None
+
+        # acquire и release ждут базу: без замка два первых
+        # acquire оба увидят _holds == 0 и запустят по задаче
+        # продления, а release удалит аренду при живом держателе.
+        self._lock = asyncio.Lock()
+
+    @property
+    def held(self) -> bool:
+        return self._holds > 0
+
+    async def acquire(self) -> bool:
+        async with self._lock:
+            if self._holds:
+                self._holds += 1
+                return True
+
+            if not await try_acquire_lease(
+                self.name,
+                self.ttl_seconds,
+            ):
+                return False
+
+            self._holds = 1
+
+            if (
+                self._renew_task is None
+                or self._renew_task.done()
+            ):
+                self._renew_task = asyncio.create_task(
+                    self._renew_loop()
+                )
+
+            return True
+
+    async def release(self) -> None:
+        async with self._lock:
+            if not self._holds:
+                return
+
+            self._holds -= 1
+
+            if self._holds:
+                return
+
+            if self._renew_task is not None:
+                self._renew_task.cancel()
+                self._renew_task = None
+
+            try:
+                await release_lease(
+                    self.name
+                )
+
+            except Exception:
+                logger.exception(
+                    "Не удалось освободить аренду %s",
+                    self.name,
+                )
+
+    async def _renew_loop(self) -> None:
+        while True:
+            await asyncio.sleep(
+                self.renew_seconds
+            )
+
+            try:
+                renewed = await try_acquire_lease(
+                    self.name,
+                    self.ttl_seconds,
+                )
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception:
+                logger.exception(
+                    "Не удалось продлить аренду %s",
+                    self.name,
+                )
+                continue
+
+            if renewed:
+                continue
+
+            logger.error(
+                "Аренда %s перешла другому экземпляру",
+                self.name,
+            )
+
+            self._holds = 0
+            self._renew_task = None
+
+            if self.on_lost is not None:
+                self.on_lost()
+
+            return
+
+
+def cancel_broadcast_tasks() -> None:
+    for task in list(broadcast_tasks):
+        task.cancel()
+
+
+broadcast_lease = Lease(
+    LEASE_BROADCAST,
+    on_lost=cancel_broadcast_tasks,
+)
+
+
+async def broadcast_busy() -> bool:
+    """
+    Идёт ли рассылка здесь или на другом экземпляре бота.
+    """
+    return (
+        broadcast_running
+        or broadcast_lock.locked()
+        or await lease_held_elsewhere(
+            LEASE_BROADCAST
+        )
+    )
+
+
+# ============================================================================
+# СОСТОЯНИЕ ДИАЛОГОВ АДМИНИСТРАТОРА
+# ============================================================================
+
+class AdminStateStore:
+    """
+    Состояния диалогов администратора в PostgreSQL с TTL.
+
+    Все состояния одного администратора читаются одним запросом
+    и коротко кэшируются: роутер сообщений проверяет их на каждом
+    сообщении. Запись идёт сразу в базу и обновляет кэш.
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: float,
+        cache_seconds: float,
+    ) -> None:
+        self.ttl_seconds = ttl_seconds
+        self.cache_seconds = cache_seconds
+        self._cache: dict[
+            int,
+            tuple[float, dict[str, tuple[dict, float]]],
+        ] = {}
+
+    def _cached_states(
+        self,
+        admin_id: int,
+    ) -> dict[str, tuple[dict, float]] | None:
+        cached = self._cache.get(admin_id)
+
+        if cached is None:
+            return None
+
+        loaded_at, states = cached
+
+        if time.monotonic() - loaded_at > self.cache_seconds:
+            self._cache.pop(admin_id, None)
+            return None
+
+        return states
+
+    async def get_all(
+        self,
+        admin_id: int,
+    ) -> dict[str, dict]:
+        states = self._cached_states(admin_id)
+
+        if states is None:
+            states = {}
+
+            if db_pool:
+                rows = await db_pool.fetch(
+                    """
+                    SELECT
+                        state_key,
+                        data,
+                        EXTRACT(
+                            EPOCH FROM expires_at - NOW()
+                        ) AS ttl
+                    FROM admin_states
+                    WHERE
+                        admin_id = $1
+                        AND expires_at > NOW()
+                    """,
+                    admin_id,
+                )
+
+                now = time.monotonic()
+
+                states = {
+                    row["state_key"]: (
+                        json.loads(row["data"]),
+                        now + float(row["ttl"]),
+                    )
+                    for row in rows
+                }
+
+            self._cache[admin_id] = (
+                time.monotonic(),
+                states,
+            )
+
+        now = time.monotonic()
+
+        return {
+            key: dict(data)
+            for key, (data, expires_at) in states.items()
+            if expires_at > now
+        }
+
+    async def get(
+        self,
+        admin_id: int,
+        state_key: str,
+    ) -> dict | None:
+        return (
+            await self.get_all(admin_id)
+        ).get(state_key)
+
+    async def set(
+        self,
+        admin_id: int,
+        state_key: str,
+        data: dict | None = None,
+    ) -> None:
+        data = dict(data or {})
+
+        if not db_pool:
+            raise RuntimeError(
+                "База данных не подключена"
+            )
+
+        await db_pool.execute(
+            """
+            INSERT INTO admin_states (
+                admin_id,
+                state_key,
+                data,
+                expires_at,
+                updated_at
+            )
+            VALUES (
+                $1,
+                $2,
+                $3::JSONB,
+                NOW() + make_interval(secs => $4),
+                NOW()
+            )
+            ON CONFLICT (admin_id, state_key)
+            DO UPDATE SET
+                data = EXCLUDED.data,
+                expires_at = EXCLUDED.expires_at,
+                updated_at = NOW()
+            """,
+            admin_id,
+            state_key,
+            json.dumps(
+                data,
+                ensure_ascii=False,
+            ),
+            float(self.ttl_seconds),
+        )
+
+        states = self._cached_states(admin_id)
+
+        if states is not None:
+            states[state_key] = (
+                data,
+                time.monotonic() + self.ttl_seconds,
+            )
+
+    async def pop(
+        self,
+        admin_id: int,
+        state_key: str,
+    ) -> dict | None:
+        """
+        Удаляет состояние и возвращает его. Удаление атомарно,
+        поэтому одно состояние не обработают два экземпляра.
+        """
+        states = self._cached_states(admin_id)
+
+        if states is not None:
+            states.pop(state_key, None)
+
+        if not db_pool:
+            return None
+
+        raw = await db_pool.fetchval(
+            """
+            DELETE FROM admin_states
+            WHERE
+                admin_id = $1
+                AND state_key = $2
+            RETURNING
+                CASE
+                    WHEN expires_at > NOW() THEN data
+                END
+            """,
+            admin_id,
+            state_key,
+        )
+
+        return json.loads(raw) if raw else None
+
+    async def clear(
+        self,
+        admin_id: int,
+        *state_keys: str,
+    ) -> bool:
+        """
+        Удаляет перечисленные состояния или все, если ключи не заданы.
+        Возвращает True, если было что отменять.
+        """
+        self._cache.pop(admin_id, None)
+
+        if not db_pool:
+            return False
+
+        removed = await db_pool.fetchval(
+            """
+            WITH removed AS (
+                DELETE FROM admin_states
+                WHERE
+                    admin_id = $1
+                    AND (
+                        cardinality($2::TEXT[]) = 0
+                        OR state_key = ANY($2::TEXT[])
+                    )
+                RETURNING expires_at
+            )
+            SELECT COUNT(*)
+            FROM removed
+            WHERE expires_at > NOW()
+            """,
+            admin_id,
+            list(state_keys),
+        )
+
+        return bool(removed)
+
+    async def sweep(self) -> int:
+        if not db_pool:
+            return 0
+
+        result = await db_pool.execute(
+            """
+            DELETE FROM admin_states
+            WHERE expires_at <= NOW()
+            """
+        )
+
+        return safe_int(
+            result.split()[-1],
+            0,
+        )
+
+
+admin_states = AdminStateStore(
+    ADMIN_STATE_TTL_SECONDS,
+    ADMIN_STATE_CACHE_SECONDS,
+)
+
+admin_state_sweeper_task: asyncio.Task | None = None
+
+
+async def admin_state_sweeper() -> None:
+    while True:
+        try:
+            # Очистку за интервал выполняет один экземпляр.
+            removed = (
+                await admin_states.sweep()
+                if await try_acquire_lease(
+                    LEASE_ADMIN_STATE_SWEEP,
+                    ADMIN_STATE_SWEEP_SECONDS,
+                )
+                else 0
+            )
+
+            if removed:
+                logger.info(
+                    "Удалены просроченные состояния администратора: %s",
+                    removed,
+                )
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception:
+            logger.exception(
+                "ADMIN STATE SWEEP ERROR"
+            )
+
+        await asyncio.sleep(
+            ADMIN_STATE_SWEEP_SECONDS
+        )
+
+
+def start_admin_state_sweeper() -> None:
+    global admin_state_sweeper_task
+
+    if admin_state_sweeper_task is None:
+        admin_state_sweeper_task = asyncio.create_task(
+            admin_state_sweeper()
+        )
+
+
+async def stop_admin_state_sweeper() -> None:
+    global admin_state_sweeper_task
+
+    if admin_state_sweeper_task is not None:
+        admin_state_sweeper_task.cancel()
+
+        try:
+            await admin_state_sweeper_task
+
+        except asyncio.CancelledError:
+            pass
+
+        admin_state_sweeper_task = None
+
+
+# ============================================================================
+# HEALTHCHECK И ПЛАНОВЫЙ ПЕРЕЗАПУСК
+# ============================================================================
+
+web_runner: web.AppRunner | None = None
+
+webhook_handler: SimpleRequestHandler | None = None
+
+# В режиме webhook main() ждёт этого события вместо polling.
+shutdown_requested = asyncio.Event()
+
+
+async def handle_healthz(
+    request: web.Request,
+) -> web.Response:
+    return web.Response(
+        text="OK"
+    )
+
+
+async def handle_readyz(
+    request: web.Request,
+) -> web.Response:
+    problems = []
+
+    if restart_reason or shutdown_requested.is_set():
+        problems.append(
+            "shutting down"
+        )
+
+    if not db_pool:
+        problems.append(
+            "database pool is not ready"
+        )
+
+    else:
+        try:
+            await asyncio.wait_for(
+                db_pool.fetchval(
+                    "SELECT 1"
+                ),
+                timeout=2,
+            )
+
+        except Exception as exc:
+            problems.append(
+                f"database: {safe_str(exc)[:200]}"
+            )
+
+    outbound = telegram_rate_governor.scheduler.snapshot()
+
+    for lane, metrics in outbound.items():
+        if metrics["queued"] > READY_MAX_OUTBOUND_QUEUE:
+            problems.append(
+                f"outbound {lane}: {int(metrics['queued'])} queued"
+            )
+
+        if metrics["oldest_wait"] > READY_MAX_OUTBOUND_WAIT_SECONDS:
+            problems.append(
+                f"outbound {lane}: waiting {metrics['oldest_wait']:.0f}s"
+            )
+
+    return web.json_response(
+        {
+            "ready": not problems,
+            "mode": BOT_MODE,
+            "problems": problems,
+            "in_flight_updates": in_flight_updates.count,
+            "outbound": {
+                lane: {
+                    "queued": int(metrics["queued"]),
+                    "oldest_wait": round(metrics["oldest_wait"], 3),
+                }
+                for lane, metrics in outbound.items()
+            },
+        },
+        status=200 if not problems else 503,
+    )
+
+
+def build_web_app() -> web.Application:
+    global webhook_handler
+
+    app = web.Application()
+
+    # Railway по умолчанию проверяет корень.
+    app.router.add_get(
+        "/",
+        handle_healthz,
+    )
+
+    app.router.add_get(
+        "/healthz",
+        handle_healthz,
+    )
+
+    app.router.add_get(
+        "/readyz",
+        handle_readyz,
+    )
+
+    if BOT_MODE == "webhook":
+        webhook_handler = SimpleRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            secret_token=WEBHOOK_SECRET,
+            handle_in_background=True,
+        )
+
+        webhook_handler.register(
+            app,
+            path=WEBHOOK_PATH,
+        )
+
+    return app
+
+
+async def start_web_server(
+    port: int = PORT,
+) -> None:
+    global web_runner
+
+    web_runner = web.AppRunner(
+        build_web_app(),
+        access_log=None,
+    )
+
+    await web_runner.setup()
+
+    await web.TCPSite(
+        web_runner,
+        port=port,
+    ).start()
+
+    logger.info(
+        "HTTP-сервер слушает порт %s (режим %s)",
+        port,
+        BOT_MODE,
+    )
+
+
+async def stop_web_server() -> None:
+    global web_runner
+
+    if web_runner is not None:
+        await web_runner.cleanup()
+        web_runner = None
+
+
+async def request_shutdown() -> None:
+    """
+    Прекращает приём новых обновлений в текущем режиме.
+    """
+    if BOT_MODE == "webhook":
+        shutdown_requested.set()
+        return
+
+    await dp.stop_polling()
+
+
+async def run_webhook() -> None:
+    if not WEBHOOK_BASE_URL:
+        raise RuntimeError(
+            "Для BOT_MODE=webhook нужен WEBHOOK_BASE_URL"
+        )
+
+    await bot.set_webhook(
+        f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+
+    loop = asyncio.get_running_loop()
+
+    for sig in (
+        signal.SIGINT,
+        signal.SIGTERM,
+    ):
+        try:
+            loop.add_signal_handler(
+                sig,
+                shutdown_requested.set,
+            )
+
+        except NotImplementedError:
+            pass
+
+    logger.info(
+        "Webhook установлен: %s%s",
+        WEBHOOK_BASE_URL,
+        WEBHOOK_PATH,
+    )
+
+    await shutdown_requested.wait()
+
+    # Обновления, принятые в фоне, уже получили 200, и Telegram
+    # их не повторит — их дожидается main() через in_flight_updates.
+    # Новые запросы до остановки сервера обрабатываем сразу:
+    # 200 уйдёт только после обработки, а если сервер закроется
+    # раньше, Telegram повторит доставку следующему экземпляру.
+    if webhook_handler is not None:
+        webhook_handler.handle_in_background = False
+
+
+class InFlightUpdatesMiddleware(
+    BaseMiddleware
+):
+    """
+    Считает обновления, которые сейчас обрабатываются,
+    чтобы перезапуск дождался их завершения.
+    """
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    async def __call__(
+        self,
+        handler,
+        event,
+        data,
+    ):
+        self.count += 1
+        self.idle.clear()
+
+        try:
+            return await handler(
+                event,
+                data,
+            )
+
+        finally:
+            self.count -= 1
+
+            if self.count == 0:
+                self.idle.set()
+
+    async def drain(
+        self,
+        timeout: float,
+    ) -> bool:
+        try:
+            await asyncio.wait_for(
+                self.idle.wait(),
+                timeout=timeout,
+            )
+            return True
+
+        except asyncio.TimeoutError:
+            return False
+
+
+in_flight_updates = InFlightUpdatesMiddleware()
+
+dp.update.outer_middleware(
+    in_flight_updates
+)
+
+restart_reason: str | None = None
+restart_task: asyncio.Task | None = None
+
+
+def read_rss_mb() -> float | None:
+    try:
+        with open("/proc/self/status", encoding="utf-8") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+
+    except Exception:
+        return None
+
+    return None
+
+
+def count_open_fds() -> int | None:
+    try:
+        return len(os.listdir("/proc/self/fd"))
+
+    except Exception:
+        return None
+
+
+def check_restart_reason(
+    started_at: float,
+) -> str | None:
+    uptime = time.monotonic() - started_at
+
+    if RESTART_MINUTES > 0 and uptime >= RESTART_MINUTES * 60:
+        return f"uptime {int(uptime // 60)} min"
+
+    if RESTART_MAX_RSS_MB > 0:
+        rss_mb = read_rss_mb()
+
+        if rss_mb is not None and rss_mb >= RESTART_MAX_RSS_MB:
+            return f"rss {rss_mb:.0f} MB"
+
+    if RESTART_MAX_OPEN_FDS > 0:
+        open_fds = count_open_fds()
+
+        if open_fds is not None and open_fds >= RESTART_MAX_OPEN_FDS:
+            return f"open fds {open_fds}"
+
+    return None
+
+
+async def restart_watchdog() -> None:
+    """
+    Следит за временем работы, памятью и дескрипторами.
+    При превышении останавливает polling — дальше main()
+    корректно завершает работу и перезапускает процесс.
+    """
+    global restart_reason
+
+    started_at = time.monotonic()
+
+    while True:
+        await asyncio.sleep(
+            RESTART_CHECK_SECONDS
+        )
+
+        reason = check_restart_reason(
+            started_at
+        )
+
+        if reason is None:
+            continue
+
+        # Экземпляры перезапускаются по очереди, чтобы бот
+        # не пропадал целиком. Аренда не освобождается:
+        # она истечёт, когда этот экземпляр уже поднимется.
+        try:
+            if not await try_acquire_lease(
+                LEASE_RESTART,
+                RESTART_DRAIN_SECONDS + 2 * LEASE_TTL_SECONDS,
+            ):
+                logger.info(
+                    "Перезапуск (%s) отложен: перезапускается "
+                    "другой экземпляр",
+                    reason,
+                )
+                continue
+
+        except Exception:
+            logger.exception(
+                "Не удалось согласовать перезапуск, "
+                "перезапускаюсь без согласования"
+            )
+
+        restart_reason = reason
+
+        logger.warning(
+            "Плановый перезапуск: %s",
+            reason,
+        )
+
+        await request_shutdown()
+        return
+
+
+def start_restart_watchdog() -> None:
+    global restart_task
+
+    if (
+        RESTART_MINUTES <= 0
+        and RESTART_MAX_RSS_MB <= 0
+        and RESTART_MAX_OPEN_FDS <= 0
+    ):
+        logger.info(
+            "Плановый перезапуск отключён"
+        )
+        return
+
+    if restart_task is None:
+        restart_task = asyncio.create_task(
+            restart_watchdog()
+        )
+
+
+async def stop_restart_watchdog() -> None:
+    global restart_task
+
+    if restart_task is not None:
+        restart_task.cancel()
+
+        try:
+            await restart_task
+
+        except asyncio.CancelledError:
+            pass
+
+        restart_task = None
+
+
+def restart_process() -> None:
+    """
+    Вызывается после полного закрытия бота и пулов.
+    """
+    if RESTART_MODE == "exit":
+        logger.info(
+            "Процесс завершается для перезапуска платформой"
+        )
+        sys.exit(0)
+
+    logger.info(
+        "Процесс перезапускается через execv"
+    )
+
+    os.execv(
+        sys.executable,
+        [
+            sys.executable,
+            *sys.argv,
+        ],
+    )
+
+
+# ============================================================================
+# ПОДПИСАННАЯ ССЫЛКА MINI APP
+# ============================================================================
+
+def build_signed_webapp_url(
+    user: types.User,
+) -> str:
+    payload = {
+        "i": user.id,
+        "n": user.username or "",
+        "f": user.first_name or "",
+        "l": user.last_name or "",
+        "t": int(time.time()),
+    }
+
+    payload_json = json.dumps(
+        payload,
+        ensure_ascii=False,
+        separators=(",", ":"),
+        sort_keys=True,
+    ).encode(
+        "utf-8"
+    )
+
+    token = (
+        base64
+        .urlsafe_b64encode(
+            payload_json
+        )
+        .decode("ascii")
+        .rstrip("=")
+    )
+
+    signature = hmac.new(
+        API_TOKEN.encode(
+            "utf-8"
+        ),
+        token.encode(
+            "ascii"
+        ),
+        hashlib.sha256,
+    ).hexdigest()
+
+    parts = urlsplit(
+        WEBAPP_URL
+    )
+
+    query = dict(
+        parse_qsl(
+            parts.query,
+            keep_blank_values=True,
+        )
+    )
+
+    query.update(
+        {
+            "u": token,
+            "s": signature,
+        }
+    )
+
+    return urlunsplit(
+        (
+            parts.scheme,
+            parts.netloc,
+            parts.path or "/",
+            urlencode(query),
+            parts.fragment,
+        )
+    )
+
+
+def start_keyboard(
+    user: types.User,
+) -> types.ReplyKeyboardMarkup:
+    web_app_btn = types.KeyboardButton(
+        text=MENU_BTN_TEXT,
+        web_app=types.WebAppInfo(
+            url=build_signed_webapp_url(
+                user
+            )
+        ),
+    )
+
+    ask_btn = types.KeyboardButton(
+        text=ASK_BTN_TEXT
+    )
+
+    return types.ReplyKeyboardMarkup(
+        keyboard=[
+            [
+                web_app_btn
+            ],
+            [
+                ask_btn
+            ],
+        ],
+        resize_keyboard=True,
+        is_persistent=True,
+    )
+
+
+def updated_keyboard(
+    user: types.User,
+) -> types.ReplyKeyboardMarkup:
+    return start_keyboard(
+        user
+    )
+
+
+async def send_main_keyboard(
+    message: types.Message,
+    text: str,
+    force: bool = False,
+) -> bool:
+    uid = message.from_user.id
+
+    if (
+        uid in KEYBOARD_SHOWN_USERS
+        and not force
+    ):
+        return False
+
+    await message.answer(
+        text,
+        reply_markup=start_keyboard(
+            message.from_user
+        ),
+    )
+
+    KEYBOARD_SHOWN_USERS.add(
+        uid
+    )
+
+    return True
+
+
+def make_user_from_database(
+    row: asyncpg.Record,
+) -> types.User:
+    return types.User(
+        id=int(
+            row["telegram_id"]
+        ),
+        is_bot=False,
+        first_name=(
+            row[
+                "telegram_first_name"
+            ]
+            or "Пользователь"
+        ),
+        last_name=row[
+            "telegram_last_name"
+        ],
+        username=row[
+            "username"
+        ],
+    )
+
+
+# ============================================================================
+# КНОПКИ
+# ============================================================================
+
+def build_admin_kb_full(
+    client_id: int,
+    order_id: int,
+) -> types.InlineKeyboardMarkup:
+    kb = InlineKeyboardBuilder()
+
+    kb.button(
+        text="👤 Открыть профиль клиента",
+        url=f"tg://user?id={client_id}",
+    )
+
+    kb.button(
+        text="✍️ Написать клиенту",
+        callback_data=(
+            f"write_client:{client_id}"
+        ),
+    )
+
+    kb.button(
+        text="🧾 Отправить чек",
+        callback_data=(
+            f"resend_receipt:{order_id}"
+        ),
+    )
+
+    kb.adjust(1)
+
+    return kb.as_markup()
+
+
+def build_admin_kb_safe(
+    client_id: int,
+    order_id: int,
+) -> types.InlineKeyboardMarkup:
+    kb = InlineKeyboardBuilder()
+
+    kb.button(
+        text="✍️ Написать клиенту",
+        callback_data=(
+            f"write_client:{client_id}"
+        ),
+    )
+
+    kb.button(
+        text="🧾 Отправить чек",
+        callback_data=(
+            f"resend_receipt:{order_id}"
+        ),
+    )
+
+    kb.adjust(1)
+
+    return kb.as_markup()
+
+def build_unsubscribe_keyboard(
+) -> types.InlineKeyboardMarkup:
+    kb = InlineKeyboardBuilder()
+
+    kb.button(
+        text="🔕 Не получать рекламу",
+        callback_data="unsubscribe_ads",
+    )
+
+    return kb.as_markup()
+
+
+def build_broadcast_confirm_keyboard(
+) -> types.InlineKeyboardMarkup:
+    kb = InlineKeyboardBuilder()
+
+    kb.button(
+        text="✅ Начать рассылку",
+        callback_data="broadcast_confirm",
+    )
+
+    kb.button(
+        text="❌ Отменить",
+        callback_data="broadcast_cancel",
+    )
+
+    kb.adjust(1)
+
+    return kb.as_markup()
+
+
+def build_keyboard_update_confirm(
+) -> types.InlineKeyboardMarkup:
+    kb = InlineKeyboardBuilder()
+
+    kb.button(
+        text="✅ Отправить клавиатуру всем",
+        callback_data="keyboard_update_confirm",
+    )
+
+    kb.button(
+        text="❌ Отменить",
+        callback_data="keyboard_update_cancel",
+    )
+
+    kb.adjust(1)
+
+    return kb.as_markup()
+
+
+# ============================================================================
+# ОТПРАВКА ЗАКАЗА МЕНЕДЖЕРУ
+# ============================================================================
+
+async def send_order_to_admin(
+    admin_text_html: str,
+    client_id: int,
+    order_id: int,
+) -> None:
+    try:
+        await bot.send_message(
+            ADMIN_CHAT_ID,
+            admin_text_html,
+            parse_mode="HTML",
+            reply_markup=(
+                build_admin_kb_full(
+                    client_id,
+                    order_id,
+                )
+            ),
+        )
+
+        logger.info(
+            "ADMIN: заказ отправлен с полной клавиатурой"
+        )
+
+    except Exception as exc:
+        error_text = str(
+            exc
+        )
+
+        logger.error(
+            "ADMIN send failed: %s",
+            error_text,
+        )
+
+        if (
+            "BUTTON_USER_PRIVACY_RESTRICTED"
+            in error_text
+        ):
+            await bot.send_message(
+                ADMIN_CHAT_ID,
+                admin_text_html,
+                parse_mode="HTML",
+                reply_markup=(
+                    build_admin_kb_safe(
+                        client_id,
+                        order_id,
+                    )
+                ),
+            )
+
+            return
+
+        raise
+
+
+# ============================================================================
+# HTTP-СОЕДИНЕНИЯ С MINI APP И ЧЕКОВОЙ ПРОГРАММОЙ
+# ============================================================================
+
+# Отдельный пул keep-alive соединений на каждый внешний сервис.
+http_sessions: dict[
+    str,
+    aiohttp.ClientSession,
+] = {}
+
+
+def create_http_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit_per_host=HTTP_LIMIT_PER_HOST,
+        ttl_dns_cache=300,
+        keepalive_timeout=60,
+    )
+
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(
+            total=30
+        ),
+    )
+
+
+def get_http_session(
+    upstream: str,
+) -> aiohttp.ClientSession:
+    session = http_sessions.get(
+        upstream
+    )
+
+    if session is None or session.closed:
+        session = create_http_session()
+
+        http_sessions[
+            upstream
+        ] = session
+
+    return session
+
+
+def open_http_sessions() -> None:
+    for upstream in (
+        HTTP_UPSTREAM_MINI_APP,
+        HTTP_UPSTREAM_PRINT,
+    ):
+        get_http_session(
+            upstream
+        )
+
+
+async def close_http_sessions() -> None:
+    for session in list(
+        http_sessions.values()
+    ):
+        if not session.closed:
+            await session.close()
+
+    http_sessions.clear()
+
+
+# ============================================================================
+# ЗАЩИЩЁННАЯ СИСТЕМА ЛОЯЛЬНОСТИ
+# ============================================================================
+
+def make_loyalty_signature_payload(
+    telegram_id: int,
+    order_ref: str,
+    items_total: int,
+    delivery: int,
+    requested_bonus: int,
+    timestamp: int,
+) -> str:
+    return "|".join(
+        [
+            str(telegram_id),
+            str(order_ref),
+            str(items_total),
+            str(delivery),
+            str(requested_bonus),
+            str(timestamp),
+        ]
+    )
+
+
+async def settle_loyalty_order(
+    telegram_id: int,
+    order_ref: str,
+    items_total: int,
+    delivery: int,
+    requested_bonus: int,
+) -> dict:
+    timestamp = int(time.time())
+    body = {
+        "telegramId": str(telegram_id),
+        "orderRef": str(order_ref),
+        "itemsTotal": int(items_total),
+        "delivery": int(delivery),
+        "requestedBonus": int(requested_bonus),
+    }
+
+    signature_payload = make_loyalty_signature_payload(
+        telegram_id,
+        order_ref,
+        items_total,
+        delivery,
+        requested_bonus,
+        timestamp,
+    )
+
+    signature = hmac.new(
+        API_TOKEN.encode("utf-8"),
+        signature_payload.encode("utf-8"),
+        hashlib.sha256,
+    ).hexdigest()
+
+    timeout = aiohttp.ClientTimeout(total=20)
+
+    session = get_http_session(
+        HTTP_UPSTREAM_MINI_APP
+    )
+
+    async with session.post(
+        LOYALTY_SETTLE_URL,
+        json=body,
+        headers={
+            "X-Loyalty-Timestamp": str(timestamp),
+            "X-Loyalty-Signature": signature,
+        },
+        timeout=timeout,
+    ) as response:
+        raw = await response.text()
+
+        try:
+            result = json.loads(raw)
+        except Exception:
+            result = {"ok": False, "error": raw[:500]}
+
+        if response.status != 200 or not result.get("ok"):
+            raise RuntimeError(
+                result.get("error")
+                or f"Loyalty HTTP {response.status}"
+            )
+
+        return result
+
+
+# ============================================================================
+# СОХРАНЕНИЕ ЗАКАЗА В БАЗУ
+# ============================================================================
+
+async def find_order_by_request_id(
+    order_request_id: str,
+) -> asyncpg.Record | None:
+    if not db_pool:
+        raise RuntimeError(
+            "База данных не подключена"
+        )
+
+    return await db_pool.fetchrow(
+        """
+        SELECT
+            id,
+            order_number
+        FROM orders
+        WHERE order_request_id = $1
+        """,
+        order_request_id,
+    )
+
+
+async def save_order_to_database(
+    user: types.User,
+    data: dict,
+    order_items: list[dict],
+    order_request_id: str,
+    print_payload: dict,
+) -> tuple[int, str, bool]:
+    """
+    Сохраняет уже рассчитанный заказ и атомарно получает
+    следующий номер SM-*.
+
+    Вызывается после списания бонусов, поэтому заказ, позиции
+    и задача печати пишутся один раз и сразу в итоговом виде.
+
+    SM-* — это внутренний номер заказа, а не номер кассового чека.
+    Пропуски в номерах заказов допустимы. Нумерацию чеков ведёт
+    локальная программа printer_gui.py.
+
+    Повторный payload с тем же orderRequestId не создаёт новый
+    заказ и не тратит номер: возвращается (id, номер, False).
+    """
+
+    if not db_pool:
+        raise RuntimeError(
+            "База данных не подключена"
+        )
+
+    # Гарантирует наличие строки users для внешнего ключа.
+    # Для уже известного пользователя это не запрос к базе,
+    # а отметка в буфере активности.
+    await touch_user(
+        user
+    )
+
+    items_total = sum(
+        max(
+            0,
+            safe_int(
+                item.get("qty")
+            ),
+        )
+        *
+        max(
+            0,
+            safe_int(
+                item.get("price")
+            ),
+        )
+        for item in order_items
+    )
+
+    delivery = max(
+        0,
+        safe_int(
+            data.get(
+                "delivery",
+                0,
+            )
+        ),
+    )
+
+    discount_percent = max(
+        0,
+        min(
+            100,
+            safe_int(
+                data.get(
+                    "discountPercent",
+                    data.get(
+                        "discount_percent",
+                        0,
+                    ),
+                )
+            ),
+        ),
+    )
+
+    discount_amount = max(
+        0,
+        safe_int(
+            data.get(
+                "discountAmount",
+                data.get(
+                    "discount_amount",
+                    data.get(
+                        "discount",
+                        0,
+                    ),
+                ),
+            )
+        ),
+    )
+
+    total = max(
+        0,
+        safe_int(
+            data.get(
+                "total",
+                items_total
+                + delivery
+                - discount_amount,
+            )
+        ),
+    )
+
+    bonus_used = max(
+        0,
+        safe_int(
+            data.get(
+                "bonusUsed",
+                0,
+            )
+        ),
+    )
+
+    cashback_percent = max(
+        0,
+        min(
+            100,
+            safe_int(
+                data.get(
+                    "cashbackPercent",
+                    0,
+                )
+            ),
+        ),
+    )
+
+    cashback_earned = max(
+        0,
+        safe_int(
+            data.get(
+                "cashbackEarned",
+                0,
+            )
+        ),
+    )
+
+    order_date = None
+
+    raw_order_date = data.get(
+        "orderDate"
+    )
+
+    if raw_order_date:
+        try:
+            order_date = datetime.strptime(
+                str(raw_order_date),
+                "%Y-%m-%d",
+            ).date()
+
+        except Exception:
+            order_date = None
+
+    item_names = []
+    item_quantities = []
+    item_prices = []
+    item_images = []
+
+    for item in order_items:
+        item_names.append(item["name"])
+        item_quantities.append(item["qty"])
+        item_prices.append(item["price"])
+        item_images.append(item.get("img"))
+
+    # Заголовок заказа, номер SM-*, позиции и задача печати
+    # пишутся одним оператором: один round-trip до базы
+    # и атомарность без явной транзакции. Задача сразу
+    # 'pending', номер заказа уже добавлен в её payload.
+    async with db_pool.acquire() as conn:
+        row = await conn.fetchrow(
+            """
+            WITH existing AS (
+                SELECT
+                    id,
+                    order_number
+                FROM orders
+                WHERE order_request_id = $16
+            ),
+            inserted AS (
+                INSERT INTO orders (
+                    order_number,
+                    telegram_id,
+                    customer_name,
+                    phone,
+                    address,
+                    address_plain,
+                    payment_method,
+                    delivery_fee,
+                    items_total,
+                    discount_percent,
+                    discount_amount,
+                    total,
+                    order_when,
+                    order_date,
+                    order_time,
+                    comment,
+                    order_request_id,
+                    bonus_used,
+                    cashback_percent,
+                    cashback_earned,
+                    loyalty_request_id
+                )
+                SELECT
+                    'SM-' || nextval('sm_order_number_seq'),
+                    $1,$2,$3,$4,$5,
+                    $6,$7,$8,$9,$10,
+                    $11,$12,$13,$14,$15,
+                    $16,$22,$23,$24,$16
+                WHERE NOT EXISTS (
+                    SELECT 1
+                    FROM existing
+                )
+                ON CONFLICT (order_request_id)
+                WHERE order_request_id IS NOT NULL
+                DO NOTHING
+                RETURNING
+                    id,
+                    order_number
+            ),
+            inserted_items AS (
+                INSERT INTO order_items (
+                    order_id,
+                    item_name,
+                    quantity,
+                    unit_price,
+                    image_url
+                )
+                SELECT
+                    inserted.id,
+                    item.item_name,
+                    item.quantity,
+                    item.unit_price,
+                    item.image_url
+                FROM inserted
+                CROSS JOIN unnest(
+                    $17::TEXT[],
+                    $18::INTEGER[],
+                    $19::INTEGER[],
+                    $20::TEXT[]
+                ) WITH ORDINALITY AS item(
+                    item_name,
+                    quantity,
+                    unit_price,
+                    image_url,
+                    position
+                )
+                ORDER BY item.position
+            ),
+            /*
+             * Задача печати сразу готова к отправке.
+             * Номер заказа известен только здесь, поэтому
+             * он дописывается в payload внутри запроса.
+             */
+            inserted_job AS (
+                INSERT INTO print_jobs (
+                    order_id,
+                    status,
+                    payload
+                )
+                SELECT
+                    id,
+                    'pending',
+                    $21::JSONB || jsonb_build_object(
+                        'order_number', order_number,
+                        'orderNumber', order_number,
+                        'order_no', order_number,
+                        'orderNo', order_number
+                    )
+                FROM inserted
+            )
+            SELECT
+                id,
+                order_number,
+                TRUE AS created
+            FROM inserted
+
+            UNION ALL
+
+            SELECT
+                id,
+                order_number,
+                FALSE AS created
+            FROM existing
+            """,
+            user.id,
+            safe_str(
+                data.get("name")
+                or user.full_name
+            ),
+            safe_str(
+                data.get("phone")
+            ),
+            safe_str(
+                data.get("address")
+            ),
+            safe_str(
+                data.get(
+                    "address_plain"
+                )
+            ),
+            safe_str(
+                data.get(
+                    "payMethod"
+                )
+            ),
+            delivery,
+            items_total,
+            discount_percent,
+            discount_amount,
+            total,
+            safe_str(
+                data.get(
+                    "orderWhen"
+                )
+            ),
+            order_date,
+            safe_str(
+                data.get(
+                    "orderTime"
+                )
+            ),
+            safe_str(
+                data.get("comment")
+                or data.get(
+                    "comments"
+                )
+                or data.get(
+                    "note"
+                )
+            ),
+            order_request_id,
+            item_names,
+            item_quantities,
+            item_prices,
+            item_images,
+            json.dumps(
+                print_payload,
+                ensure_ascii=False,
+            ),
+            bonus_used,
+            cashback_percent,
+            cashback_earned,
+        )
+
+        if row is None:
+            # Параллельная доставка того же payload успела
+            # вставить заказ первой — возвращаем её результат.
+            row = await conn.fetchrow(
+                """
+                SELECT
+                    id,
+                    order_number,
+                    FALSE AS created
+                FROM orders
+                WHERE order_request_id = $1
+                """,
+                order_request_id,
+            )
+
+    if row is None:
+        raise RuntimeError(
+            "Заказ не найден после вставки"
+        )
+
+    if row["created"]:
+        print_outbox_wakeup.set()
+
+    return (
+        int(row["id"]),
+        row["order_number"],
+        bool(row["created"]),
+    )
+
+
+# ============================================================================
+# ОТПРАВКА / ПОВТОРНАЯ ОТПРАВКА ЧЕКА
+# ============================================================================
+
+async def build_print_payload_from_database(
+    order_id: int,
+) -> dict:
+    """
+    Восстанавливает полный payload заказа из PostgreSQL.
+    Используется кнопкой «Отправить чек» и очередью печати, поэтому
+    повторная отправка работает даже после перезапуска Railway.
+    """
+    if not db_pool:
+        raise RuntimeError(
+            "База данных не подключена"
+        )
+
+    async with db_pool.acquire() as conn:
+        order_row = await conn.fetchrow(
+            """
+            SELECT
+                id,
+                order_number,
+                customer_name,
+                phone,
+                address,
+                payment_method,
+                delivery_fee,
+                items_total,
+                discount_percent,
+                discount_amount,
+                bonus_used,
+                cashback_percent,
+                cashback_earned,
+                total,
+                order_when,
+                order_date,
+                order_time,
+                comment,
+                created_at
+            FROM orders
+            WHERE id = $1
+            """,
+            order_id,
+        )
+
+        if not order_row:
+            raise LookupError(
+                "Заказ не найден в базе"
+            )
+
+        item_rows = await conn.fetch(
+            """
+            SELECT
+                item_name,
+                quantity,
+                unit_price,
+                image_url
+            FROM order_items
+            WHERE order_id = $1
+            ORDER BY id
+            """,
+            order_id,
+        )
+
+    order_number = safe_str(
+        order_row["order_number"]
+    )
+
+    comment = safe_str(
+        order_row["comment"]
+    )
+
+    items = [
+        {
+            "name": safe_str(
+                row["item_name"]
+            ),
+            "qty": max(
+                1,
+                safe_int(
+                    row["quantity"],
+                    1,
+                ),
+            ),
+            "price": max(
+                0,
+                safe_int(
+                    row["unit_price"],
+                    0,
+                ),
+            ),
+            "img": safe_str(
+                row["image_url"]
+            ),
+        }
+        for row in item_rows
+    ]
+
+    created_at = order_row[
+        "created_at"
+    ]
+
+    if created_at:
+        try:
+            created_at = created_at.astimezone(
+                TIMEZONE
+            ).strftime(
+                "%Y-%m-%d %H:%M:%S"
+            )
+        except Exception:
+            created_at = safe_str(
+                created_at
+            )
+    else:
+        created_at = datetime.now(
+            TIMEZONE
+        ).strftime(
+            "%Y-%m-%d %H:%M:%S"
+        )
+
+    order_time = safe_str(
+        order_row["order_time"]
+    )
+
+    return {
+        "order_number": order_number,
+        "orderNumber": order_number,
+        "order_no": order_number,
+        "orderNo": order_number,
+
+        "name": safe_str(
+            order_row["customer_name"]
+        ),
+        "phone": safe_str(
+            order_row["phone"]
+        ),
+        "address": safe_str(
+            order_row["address"]
+        ),
+        "delivery": max(
+            0,
+            safe_int(
+                order_row["delivery_fee"],
+                0,
+            ),
+        ),
+        "payment": safe_str(
+            order_row["payment_method"]
+        ),
+        "items": items,
+
+        "items_total": max(
+            0,
+            safe_int(
+                order_row["items_total"],
+                0,
+            ),
+        ),
+        "itemsTotal": max(
+            0,
+            safe_int(
+                order_row["items_total"],
+                0,
+            ),
+        ),
+        "subtotal": max(
+            0,
+            safe_int(
+                order_row["items_total"],
+                0,
+            ),
+        ),
+
+        "discount_percent": max(
+            0,
+            safe_int(
+                order_row["discount_percent"],
+                0,
+            ),
+        ),
+        "discountPercent": max(
+            0,
+            safe_int(
+                order_row["discount_percent"],
+                0,
+            ),
+        ),
+        "discount_amount": max(
+            0,
+            safe_int(
+                order_row["discount_amount"],
+                0,
+            ),
+        ),
+        "discountAmount": max(
+            0,
+            safe_int(
+                order_row["discount_amount"],
+                0,
+            ),
+        ),
+        "discount": max(
+            0,
+            safe_int(
+                order_row["bonus_used"] or order_row["discount_amount"],
+                0,
+            ),
+        ),
+        "bonus_used": max(
+            0,
+            safe_int(
+                order_row["bonus_used"] or order_row["discount_amount"],
+                0,
+            ),
+        ),
+        "used_bonuses": max(
+            0,
+            safe_int(
+                order_row["bonus_used"] or order_row["discount_amount"],
+                0,
+            ),
+        ),
+        "cashback_percent": max(
+            0,
+            safe_int(order_row["cashback_percent"], 0),
+        ),
+        "cashback_earned": max(
+            0,
+            safe_int(order_row["cashback_earned"], 0),
+        ),
+
+        "total": max(
+            0,
+            safe_int(
+                order_row["total"],
+                0,
+            ),
+        ),
+        "date": created_at,
+        "order_time": order_time,
+        "order_when": safe_str(
+            order_row["order_when"]
+        ),
+
+        "comment": comment,
+        "comments": comment,
+        "comment_text": comment,
+        "note": comment,
+        "notes": comment,
+    }
+
+
+async def send_payload_to_receipt_program(
+    print_payload: dict,
+    timeout_seconds: int = 12,
+) -> tuple[int, str]:
+    """
+    Отправляет заказ в чековую программу.
+    При временной ошибке ngrok (502/503/504) или сети делает один повтор.
+    Повтор безопасен, потому что printer_gui.py не создаёт второй JSON
+    для уже принятого order_number.
+    """
+    timeout = aiohttp.ClientTimeout(
+        total=timeout_seconds
+    )
+
+    last_error: Exception | None = None
+
+    session = get_http_session(
+        HTTP_UPSTREAM_PRINT
+    )
+
+    for attempt in range(2):
+        try:
+            async with session.post(
+                PRINT_URL,
+                json=print_payload,
+                timeout=timeout,
+            ) as response:
+                response_text = await response.text()
+
+                if 200 <= response.status < 300:
+                    return (
+                        response.status,
+                        response_text,
+                    )
+
+                error = RuntimeError(
+                    (
+                        f"Чековая программа вернула HTTP "
+                        f"{response.status}: "
+                        f"{response_text[:500]}"
+                    )
+                )
+
+                if response.status in (502, 503, 504) and attempt == 0:
+                    last_error = error
+                    logger.warning(
+                        "PRINT HTTP %s. Повторная отправка через 1 секунду.",
+                        response.status,
+                    )
+                    await asyncio.sleep(1)
+                    continue
+
+                raise error
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            last_error = exc
+
+            if attempt == 0:
+                logger.warning(
+                    "PRINT network error: %s. Повторная отправка через 1 секунду.",
+                    safe_str(exc),
+                )
+                await asyncio.sleep(1)
+                continue
+
+            raise
+
+    if last_error is not None:
+        raise last_error
+
+    raise RuntimeError("Не удалось отправить заказ в чековую программу")
+
+
+# ============================================================================
+# ОЧЕРЕДЬ ПЕЧАТИ
+# ============================================================================
+
+async def mark_print_job_delivered(
+    order_id: int,
+) -> None:
+    if not db_pool:
+        return
+
+    await db_pool.execute(
+        """
+        UPDATE print_jobs
+        SET
+            status = 'delivered',
+            delivered_at = NOW(),
+            last_error = NULL
+        WHERE
+            order_id = $1
+            AND status <> 'delivered'
+        """,
+        order_id,
+    )
+
+
+async def claim_print_job() -> asyncpg.Record | None:
+    """
+    Берёт одну задачу, которой пора отправляться.
+
+    На время попытки задача «арендуется» сдвигом next_attempt_at,
+    поэтому после падения процесса она вернётся в работу сама.
+    """
+    if not db_pool:
+        return None
+
+    return await db_pool.fetchrow(
+        """
+        UPDATE print_jobs AS j
+        SET
+            attempts = j.attempts + 1,
+            next_attempt_at =
+                NOW() + make_interval(secs => $1)
+        WHERE j.id = (
+            SELECT p.id
+            FROM print_jobs p
+            WHERE
+                p.status = 'pending'
+                AND p.next_attempt_at <= NOW()
+            ORDER BY p.id
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING
+            j.id,
+            j.order_id,
+            j.payload,
+            j.attempts,
+            j.alerted
+        """,
+        PRINT_JOB_LEASE_SECONDS,
+    )
+
+
+async def deliver_print_job(
+    job: asyncpg.Record,
+) -> None:
+    order_id = int(job["order_id"])
+    attempts = int(job["attempts"])
+    order_number = ""
+
+    try:
+        if job["payload"]:
+            print_payload = json.loads(
+                job["payload"]
+            )
+
+        else:
+            print_payload = await build_print_payload_from_database(
+                order_id
+            )
+
+        order_number = safe_str(
+            print_payload.get(
+                "order_number"
+            )
+        )
+
+        (
+            print_status,
+            print_response,
+        ) = await send_payload_to_receipt_program(
+            print_payload,
+            timeout_seconds=7,
+        )
+
+    except asyncio.CancelledError:
+        raise
+
+    except Exception as exc:
+        delay = min(
+            PRINT_RETRY_MAX_SECONDS,
+            PRINT_RETRY_BASE_SECONDS * 2 ** (attempts - 1),
+        )
+
+        logger.warning(
+            "PRINT JOB FAILED: order_id=%s attempt=%s retry_in=%ss error=%s",
+            order_id,
+            attempts,
+            delay,
+            safe_str(exc)[:500],
+        )
+
+        alert = (
+            not job["alerted"]
+            and attempts >= PRINT_ALERT_AFTER_ATTEMPTS
+        )
+
+        await db_pool.execute(
+            """
+            UPDATE print_jobs
+            SET
+                next_attempt_at =
+                    NOW() + make_interval(secs => $2),
+                last_error = LEFT($3, 1000),
+                alerted = alerted OR $4
+            WHERE id = $1
+            """,
+            job["id"],
+            delay,
+            safe_str(exc),
+            alert,
+        )
+
+        if alert:
+            try:
+                await bot.send_message(
+                    ADMIN_CHAT_ID,
+                    (
+                        f"⚠️ Заказ {order_number or order_id} принят, "
+                        "но чековая программа сейчас недоступна.\n\n"
+                        "Заказ НЕ потерян: бот продолжает отправлять чек "
+                        "автоматически. Можно также нажать "
+                        "«🧾 Отправить чек» под заказом.\n\n"
+                        f"Ошибка: {safe_str(exc)[:500]}"
+                    ),
+                )
+
+            except Exception:
+                logger.exception(
+                    "Не удалось отправить менеджеру предупреждение о печати"
+                )
+
+        return
+
+    await mark_print_job_delivered(
+        order_id
+    )
+
+    logger.info(
+        (
+            "Печать отправлена: "
+            "order_id=%s attempt=%s HTTP %s, ответ: %s"
+        ),
+        order_id,
+        attempts,
+        print_status,
+        print_response[:500],
+    )
+
+    if job["alerted"]:
+        try:
+            await bot.send_message(
+                ADMIN_CHAT_ID,
+                (
+                    f"✅ Чек заказа {order_number or order_id} "
+                    "отправлен в чековую программу "
+                    f"с {attempts}-й попытки."
+                ),
+            )
+
+        except Exception:
+            logger.exception(
+                "Не удалось сообщить менеджеру об отправке чека"
+            )
+
+
+async def print_outbox_worker() -> None:
+    while not print_outbox_stopping.is_set():
+        try:
+            job = await claim_print_job()
+
+            if job is None:
+                try:
+                    await asyncio.wait_for(
+                        print_outbox_wakeup.wait(),
+                        timeout=PRINT_OUTBOX_POLL_SECONDS,
+                    )
+
+                except asyncio.TimeoutError:
+                    pass
+
+                print_outbox_wakeup.clear()
+                continue
+
+            await deliver_print_job(
+                job
+            )
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception:
+            logger.exception(
+                "PRINT OUTBOX ERROR"
+            )
+
+            await asyncio.sleep(
+                PRINT_OUTBOX_POLL_SECONDS
+            )
+
+
+def start_print_outbox() -> None:
+    global print_outbox_task
+
+    if print_outbox_task is None:
+        print_outbox_task = asyncio.create_task(
+            print_outbox_worker()
+        )
+
+
+async def stop_print_outbox(
+    drain_seconds: float = 0,
+) -> None:
+    """
+    Останавливает очередь печати. С drain_seconds текущей
+    отправке дают завершиться; иначе задача вернётся
+    в очередь после истечения аренды.
+    """
+    global print_outbox_task
+
+    if print_outbox_task is not None:
+        print_outbox_stopping.set()
+        print_outbox_wakeup.set()
+
+        if drain_seconds > 0:
+            try:
+                await asyncio.wait_for(
+                    asyncio.shield(print_outbox_task),
+                    timeout=drain_seconds,
+                )
+
+            except asyncio.TimeoutError:
+                pass
+
+        print_outbox_task.cancel()
+
+        try:
+            await print_outbox_task
+
+        except asyncio.CancelledError:
+            pass
+
+        print_outbox_task = None
+
+
+# ============================================================================
+# КАТАЛОГ МЕНЮ
+# ============================================================================
+
+class MenuCatalog:
+    """
+    Неизменяемый снимок меню одной версии.
+
+    Каталог целиком заменяется новым объектом, поэтому обработчик
+    заказа, взявший снимок, видит согласованные цены до конца.
+    """
+
+    __slots__ = (
+        "version",
+        "items",
+    )
+
+    def __init__(
+        self,
+        version: int,
+        items: dict[str, tuple[int, bool]],
+    ) -> None:
+        self.version = version
+        self.items = MappingProxyType(
+            dict(items)
+        )
+
+    def lookup(
+        self,
+        name: str,
+    ) -> tuple[int, bool] | None:
+        """
+        Возвращает (цена, доступно) или None для неизвестного блюда.
+        """
+        return self.items.get(name)
+
+
+menu_catalog = MenuCatalog(
+    0,
+    {},
+)
+
+menu_catalog_changed = asyncio.Event()
+menu_catalog_task: asyncio.Task | None = None
+
+
+async def load_menu_catalog(
+    conn: asyncpg.Connection | None = None,
+) -> None:
+    """
+    Загружает каталог из базы и подменяет снимок,
+    если версия в базе новее текущей.
+    """
+    global menu_catalog
+
+    source = conn or db_pool
+
+    if source is None:
+        return
+
+    rows = await source.fetch(
+        """
+        SELECT
+            v.version,
+            m.name,
+            m.price,
+            m.is_available
+        FROM menu_catalog_version v
+        LEFT JOIN menu_items m
+            ON TRUE
+        """
+    )
+
+    if not rows:
+        return
+
+    version = int(rows[0]["version"])
+
+    if version <= menu_catalog.version:
+        return
+
+    menu_catalog = MenuCatalog(
+        version,
+        {
+            row["name"]: (
+                int(row["price"]),
+                bool(row["is_available"]),
+            )
+            for row in rows
+            if row["name"] is not None
+        },
+    )
+
+    logger.info(
+        "Каталог меню загружен: version=%s items=%s",
+        version,
+        len(menu_catalog.items),
+    )
+
+
+def on_menu_catalog_notify(
+    connection: asyncpg.Connection,
+    pid: int,
+    channel: str,
+    payload: str,
+) -> None:
+    if safe_int(payload, 0) > menu_catalog.version:
+        menu_catalog_changed.set()
+
+
+async def menu_catalog_listener() -> None:
+    """
+    Держит отдельное соединение с LISTEN на канал меню.
+
+    Пул не подходит: соединение с LISTEN должно жить постоянно.
+    Раз в MENU_CATALOG_POLL_SECONDS версия сверяется и без
+    уведомления — на случай обрыва соединения.
+    """
+    while True:
+        conn = None
+
+        try:
+            conn = await asyncpg.connect(
+                DATABASE_URL
+            )
+
+            await conn.add_listener(
+                MENU_CATALOG_CHANNEL,
+                on_menu_catalog_notify,
+            )
+
+            # Изменения, пропущенные, пока соединения не было.
+            await load_menu_catalog(
+                conn
+            )
+
+            while not conn.is_closed():
+                try:
+                    await asyncio.wait_for(
+                        menu_catalog_changed.wait(),
+                        timeout=MENU_CATALOG_POLL_SECONDS,
+                    )
+
+                except asyncio.TimeoutError:
+                    pass
+
+                menu_catalog_changed.clear()
+
+                await load_menu_catalog(
+                    conn
+                )
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception:
+            logger.exception(
+                "MENU CATALOG LISTENER ERROR"
+            )
+
+        finally:
+            if conn is not None and not conn.is_closed():
+                try:
+                    await conn.close()
+
+                except Exception:
+                    pass
+
+        await asyncio.sleep(
+            MENU_CATALOG_POLL_SECONDS
+        )
+
+
+async def start_menu_catalog() -> None:
+    global menu_catalog_task
+
+    await load_menu_catalog()
+
+    if menu_catalog_task is None:
+        menu_catalog_task = asyncio.create_task(
+            menu_catalog_listener()
+        )
+
+
+async def stop_menu_catalog() -> None:
+    global menu_catalog_task
+
+    if menu_catalog_task is not None:
+        menu_catalog_task.cancel()
+
+        try:
+            await menu_catalog_task
+
+        except asyncio.CancelledError:
+            pass
+
+        menu_catalog_task = None
+
+
+# ============================================================================
+# СТАТИСТИКА
+# ============================================================================
+
+def bangkok_today() -> date:
+    return datetime.now(
+        TIMEZONE
+    ).date()
+
+
+def bangkok_day_bounds(
+    stat_date: date,
+) -> tuple[datetime, datetime]:
+    start = datetime(
+        stat_date.year,
+        stat_date.month,
+        stat_date.day,
+        tzinfo=TIMEZONE,
+    )
+
+    return (
+        start,
+        start + timedelta(days=1),
+    )
+
+
+def parse_report_date(
+    value: str,
+) -> date | None:
+    for fmt in (
+        "%Y-%m-%d",
+        "%d.%m.%Y",
+        "%d.%m.%y",
+    ):
+        try:
+            return datetime.strptime(
+                value.strip(),
+                fmt,
+            ).date()
+
+        except ValueError:
+            continue
+
+    return None
+
+
+# Строка daily_stats за день: $1 — дата, $2..$3 — её границы
+# в UTC, $4 — закрыть день. Каждая таблица читается один раз:
+# users — одним проходом, visits и orders — одним диапазоном
+# по индексу даты (это проверяет tests/test_daily_stats_plan.py).
+DAILY_STATS_ROLLUP_SQL = """
+    WITH user_totals AS (
+        SELECT
+            COUNT(*) AS total_users,
+
+            COUNT(*) FILTER (
+                WHERE is_active = TRUE
+            ) AS active_users,
+
+            COUNT(*) FILTER (
+                WHERE
+                    is_active = TRUE
+                    AND marketing_allowed = TRUE
+            ) AS marketing_users,
+
+            COUNT(*) FILTER (
+                WHERE is_active = FALSE
+            ) AS blocked_users,
+
+            COUNT(*) FILTER (
+                WHERE
+                    last_bot_activity_at >= $2
+                    AND last_bot_activity_at < $3
+            ) AS active_today,
+
+            COUNT(*) FILTER (
+                WHERE
+                    created_at >= $2
+                    AND created_at < $3
+            ) AS new_users
+        FROM users
+    ),
+
+    visit_totals AS (
+        SELECT
+            COUNT(*) AS visits,
+            COUNT(DISTINCT telegram_id) AS unique_visitors
+        FROM visits
+        WHERE
+            visited_at >= $2
+            AND visited_at < $3
+    ),
+
+    order_totals AS (
+        SELECT
+            COUNT(*) AS orders_count,
+            COUNT(DISTINCT telegram_id) AS buyers,
+            COALESCE(SUM(total), 0) AS revenue
+        FROM orders
+        WHERE
+            created_at >= $2
+            AND created_at < $3
+    )
+
+    INSERT INTO daily_stats (
+        stat_date,
+        total_users,
+        active_users,
+        marketing_users,
+        blocked_users,
+        active_today,
+        new_users,
+        visits,
+        unique_visitors,
+        orders_count,
+        buyers,
+        revenue,
+        is_final,
+        refreshed_at
+    )
+    SELECT
+        $1,
+        CASE WHEN $4 THEN NULL ELSE u.total_users END,
+        CASE WHEN $4 THEN NULL ELSE u.active_users END,
+        CASE WHEN $4 THEN NULL ELSE u.marketing_users END,
+        CASE WHEN $4 THEN NULL ELSE u.blocked_users END,
+        CASE WHEN $4 THEN NULL ELSE u.active_today END,
+        u.new_users,
+        v.visits,
+        v.unique_visitors,
+        o.orders_count,
+        o.buyers,
+        o.revenue,
+        $4,
+        NOW()
+    FROM user_totals u
+    CROSS JOIN visit_totals v
+    CROSS JOIN order_totals o
+
+    ON CONFLICT (stat_date)
+    DO UPDATE SET
+        total_users = COALESCE(
+            EXCLUDED.total_users,
+            daily_stats.total_users
+        ),
+        active_users = COALESCE(
+            EXCLUDED.active_users,
+            daily_stats.active_users
+        ),
+        marketing_users = COALESCE(
+            EXCLUDED.marketing_users,
+            daily_stats.marketing_users
+        ),
+        blocked_users = COALESCE(
+            EXCLUDED.blocked_users,
+            daily_stats.blocked_users
+        ),
+        active_today = COALESCE(
+            EXCLUDED.active_today,
+            daily_stats.active_today
+        ),
+        new_users = EXCLUDED.new_users,
+        visits = EXCLUDED.visits,
+        unique_visitors = EXCLUDED.unique_visitors,
+        orders_count = EXCLUDED.orders_count,
+        buyers = EXCLUDED.buyers,
+        revenue = EXCLUDED.revenue,
+        is_final = EXCLUDED.is_final,
+        refreshed_at = NOW()
+
+    RETURNING *
+"""
+
+
+async def refresh_daily_stats(
+    stat_date: date,
+    final: bool = False,
+) -> asyncpg.Record:
+    """
+    Пересчитывает строку daily_stats за бангкокскую дату.
+
+    Колонки по диапазонам created_at и visited_at считаются
+    всегда. Итоги по пользователям и active_today — снимок
+    текущего состояния users, поэтому при закрытии дня (final)
+    остаётся последний снимок, снятый в течение дня, а у дня
+    без такого снимка они NULL.
+    """
+    if not db_pool:
+        raise RuntimeError(
+            "База данных не подключена"
+        )
+
+    start_utc, end_utc = bangkok_day_bounds(
+        stat_date
+    )
+
+    return await db_pool.fetchrow(
+        DAILY_STATS_ROLLUP_SQL,
+        stat_date,
+        start_utc,
+        end_utc,
+        final,
+    )
+
+
+daily_stats_backfill_days: set[date] = set()
+
+daily_stats_backfill_task: asyncio.Task | None = None
+
+
+async def daily_stats_backfill() -> None:
+    """
+    Досчитывает запрошенные прошедшие дни по одному,
+    начиная с самого старого.
+    """
+    while daily_stats_backfill_days:
+        day = min(daily_stats_backfill_days)
+
+        try:
+            await refresh_daily_stats(
+                day,
+                final=True,
+            )
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception:
+            logger.exception(
+                "DAILY STATS BACKFILL ERROR: %s",
+                day,
+            )
+
+        daily_stats_backfill_days.discard(
+            day
+        )
+
+
+def schedule_daily_stats_backfill(
+    days: list[date],
+) -> None:
+    global daily_stats_backfill_task
+
+    daily_stats_backfill_days.update(
+        days
+    )
+
+    if (
+        daily_stats_backfill_task is None
+        or daily_stats_backfill_task.done()
+    ):
+        daily_stats_backfill_task = asyncio.create_task(
+            daily_stats_backfill()
+        )
+
+
+async def load_daily_stats(
+    start_date: date,
+    end_date: date,
+) -> tuple[list[asyncpg.Record], int]:
+    """
+    Строки daily_stats за период включительно и число дней,
+    которые ещё досчитываются в фоне.
+
+    Недостающие прошедшие дни сохраняются сразу закрытыми,
+    без снимка итогов по пользователям. Не больше
+    DAILY_STATS_INLINE_BACKFILL_DAYS из них считаются прямо
+    здесь, иначе все уходят в фоновую задачу: каждый день —
+    проход по всей таблице users.
+    """
+    if not db_pool:
+        raise RuntimeError(
+            "База данных не подключена"
+        )
+
+    today = bangkok_today()
+
+    rows = {
+        row["stat_date"]: row
+        for row in await db_pool.fetch(
+            """
+            SELECT *
+            FROM daily_stats
+            WHERE stat_date BETWEEN $1 AND $2
+            """,
+            start_date,
+            end_date,
+        )
+    }
+
+    missing = [
+        start_date + timedelta(days=offset)
+        for offset in range(
+            (end_date - start_date).days + 1
+        )
+        if start_date + timedelta(days=offset) not in rows
+    ]
+
+    missing_past = [
+        day
+        for day in missing
+        if day < today
+    ]
+
+    if len(missing_past) > DAILY_STATS_INLINE_BACKFILL_DAYS:
+        schedule_daily_stats_backfill(
+            missing_past
         )
-        *
-        max(
-            0,
-            safe_int(
-                item.get("price")
-            ),
+
+        return [], len(missing_past)
+
+    for day in missing:
+        rows[day] = await refresh_daily_stats(
+            day,
+            final=day < today,
         )
-        for item in order_items
-    )
 
-    delivery = max(
+    return (
+        [
+            rows[day]
+            for day in sorted(rows)
+        ],
         0,
-        safe_int(
-            data.get(
-                "delivery",
-                0,
-            )
-        ),
     )
 
-    discount_percent = max(
-        0,
-        min(
-            100,
-            safe_int(
-                data.get(
-                    "discountPercent",
-                    data.get(
-                        "discount_percent",
-                        0,
-                    ),
+
+async def daily_stats_loop() -> None:
+    """
+    Пересчитывает текущий день и закрывает прошедшие.
+    За интервал это делает один экземпляр бота.
+    """
+    while True:
+        try:
+            if await try_acquire_lease(
+                LEASE_DAILY_STATS,
+                DAILY_STATS_REFRESH_SECONDS,
+            ):
+                today = bangkok_today()
+
+                open_days = await db_pool.fetch(
+                    """
+                    SELECT stat_date
+                    FROM daily_stats
+                    WHERE
+                        is_final = FALSE
+                        AND stat_date < $1
+                    """,
+                    today,
                 )
-            ),
-        ),
-    )
 
-    discount_amount = max(
-        0,
-        safe_int(
-            data.get(
-                "discountAmount",
-                data.get(
-                    "discount_amount",
-                    data.get(
-                        "discount",
-                        0,
-                    ),
-                ),
-            )
-        ),
-    )
+                for row in open_days:
+                    await refresh_daily_stats(
+                        row["stat_date"],
+                        final=True,
+                    )
 
-    total = max(
-        0,
-        safe_int(
-            data.get(
-                "total",
-                items_total
-                + delivery
-                - discount_amount,
+                await refresh_daily_stats(
+                    today
+                )
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception:
+            logger.exception(
+                "DAILY STATS REFRESH ERROR"
             )
-        ),
+
+        await asyncio.sleep(
+            DAILY_STATS_REFRESH_SECONDS
+        )
+
+
+daily_stats_task: asyncio.Task | None = None
+
+
+def start_daily_stats() -> None:
+    global daily_stats_task
+
+    if daily_stats_task is None:
+        daily_stats_task = asyncio.create_task(
+            daily_stats_loop()
+        )
+
+
+async def stop_daily_stats() -> None:
+    global daily_stats_task
+    global daily_stats_backfill_task
+
+    if daily_stats_task is not None:
+        daily_stats_task.cancel()
+
+        try:
+            await daily_stats_task
+
+        except asyncio.CancelledError:
+            pass
+
+        daily_stats_task = None
+
+    if daily_stats_backfill_task is not None:
+        daily_stats_backfill_task.cancel()
+
+        try:
+            await daily_stats_backfill_task
+
+        except asyncio.CancelledError:
+            pass
+
+        daily_stats_backfill_task = None
+
+
+def format_user_snapshot(
+    value: int | None,
+) -> str:
+    return (
+        "н/д"
+        if value is None
+        else str(int(value))
     )
 
-    order_date = None
 
-    raw_order_date = data.get(
-        "orderDate"
+async def build_daily_report(
+    start_date: date | None = None,
+    end_date: date | None = None,
+) -> str:
+    """
+    Отчёт /nu4etam по строкам daily_stats: за сегодня,
+    за одну дату или за период включительно.
+    """
+    start_date = start_date or bangkok_today()
+    end_date = end_date or start_date
+
+    rows, pending_days = await load_daily_stats(
+        start_date,
+        end_date,
     )
 
-    if raw_order_date:
-        try:
-            order_date = datetime.strptime(
-                str(raw_order_date),
-                "%Y-%m-%d",
-            ).date()
+    if pending_days:
+        return (
+            f"⏳ Статистика за {pending_days} дн. ещё не посчитана — "
+            f"считаю в фоне. Повторите запрос через несколько минут."
+        )
 
-        except Exception:
-            order_date = None
+    # Итоги по базе пользователей — из последнего дня периода.
+    # Для дня без снимка (досчитан задним числом) — «н/д».
+    last = rows[-1]
 
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():
-            sequence_number = await conn.fetchval(
-                """
-                SELECT nextval(
-                    'sm_order_number_seq'
-                )
-                """
-            )
+    visits = sum(int(row["visits"]) for row in rows)
+    unique_visitors = sum(int(row["unique_visitors"]) for row in rows)
+    orders_count = sum(int(row["orders_count"]) for row in rows)
+    buyers = sum(int(row["buyers"]) for row in rows)
+    revenue = sum(int(row["revenue"]) for row in rows)
+    active_users_period = (
+        "н/д"
+        if any(row["active_today"] is None for row in rows)
+        else sum(int(row["active_today"]) for row in rows)
+    )
+    new_users = sum(int(row["new_users"]) for row in rows)
 
-            order_number = (
-                f"SM-{int(sequence_number)}"
-            )
+    conversion = (
+        orders_count
+        / unique_visitors
+        * 100
+        if unique_visitors
+        else 0
+    )
 
-            order_id = await conn.fetchval(
-                """
-                INSERT INTO orders (
-                    order_number,
-                    telegram_id,
-                    customer_name,
-                    phone,
-                    address,
-                    address_plain,
-                    payment_method,
-                    delivery_fee,
-                    items_total,
-                    discount_percent,
-                    discount_amount,
-                    total,
-                    order_when,
-                    order_date,
-                    order_time,
-                    comment
-                )
-                VALUES (
-                    $1,$2,$3,$4,$5,$6,
-                    $7,$8,$9,$10,$11,
-                    $12,$13,$14,$15,$16
-                )
-                RETURNING id
-                """,
-                order_number,
-                user.id,
-                safe_str(
-                    data.get("name")
-                    or user.full_name
-                ),
-                safe_str(
-                    data.get("phone")
-                ),
-                safe_str(
-                    data.get("address")
-                ),
-                safe_str(
-                    data.get(
-                        "address_plain"
-                    )
-                ),
-                safe_str(
-                    data.get(
-                        "payMethod"
-                    )
-                ),
-                delivery,
-                items_total,
-                discount_percent,
-                discount_amount,
-                total,
-                safe_str(
-                    data.get(
-                        "orderWhen"
-                    )
-                ),
-                order_date,
-                safe_str(
-                    data.get(
-                        "orderTime"
-                    )
-                ),
-                safe_str(
-                    data.get("comment")
-                    or data.get(
-                        "comments"
-                    )
-                    or data.get(
-                        "note"
-                    )
-                ),
-            )
+    avg_check = (
+        revenue / orders_count
+        if orders_count
+        else 0
+    )
 
-            if order_items:
-                await conn.executemany(
-                    """
-                    INSERT INTO order_items (
-                        order_id,
-                        item_name,
-                        quantity,
-                        unit_price,
-                        image_url
-                    )
-                    VALUES (
-                        $1,$2,$3,$4,$5
-                    )
-                    """,
-                    [
-                        (
-                            order_id,
-                            item["name"],
-                            item["qty"],
-                            item["price"],
-                            item.get("img"),
-                        )
-                        for item
-                        in order_items
-                    ],
-                )
+    if start_date == end_date:
+        title = f"📊 Статистика за {start_date.strftime('%d.%m.%Y')}"
+        per_day_note = ""
+        active_label = (
+            "сегодня"
+            if start_date == bangkok_today()
+            else "за день"
+        )
+
+    else:
+        title = (
+            f"📊 Статистика за "
+            f"{start_date.strftime('%d.%m.%Y')}"
+            f" — {end_date.strftime('%d.%m.%Y')}"
+        )
+        per_day_note = " (сумма по дням)"
+        active_label = "за период (сумма по дням)"
 
     return (
-        int(order_id),
-        order_number,
+        f"{title}\n\n"
+
+        f"👥 Всего ID в базе: "
+        f"{format_user_snapshot(last['total_users'])}\n"
+
+        f"✅ Активных пользователей: "
+        f"{format_user_snapshot(last['active_users'])}\n"
+
+        f"📣 Доступно для рекламы: "
+        f"{format_user_snapshot(last['marketing_users'])}\n"
+
+        f"🚫 Заблокировали/недоступны: "
+        f"{format_user_snapshot(last['blocked_users'])}\n"
+
+        f"💬 Пользователей бота {active_label}: "
+        f"{active_users_period}\n"
+
+        f"🆕 Новых пользователей: "
+        f"{new_users}\n\n"
+
+        f"Открытий сайта: {visits}\n"
+
+        f"Уникальных посетителей{per_day_note}: "
+        f"{unique_visitors}\n\n"
+
+        f"Заказов: {orders_count}\n"
+
+        f"Покупателей{per_day_note}: "
+        f"{buyers}\n"
+
+        f"Конверсия: "
+        f"{conversion:.1f}%\n\n"
+
+        f"Выручка: "
+        f"{revenue} ฿\n"
+
+        f"Средний чек: "
+        f"{round(avg_check)} ฿"
+    )
+
+
+# ============================================================================
+# АНАЛИТИКА /stats
+# ============================================================================
+
+# Метрики закрытых периодов в памяти процесса: LRU
+# на ANALYTICS_MEMORY_CACHE_MAX периодов, остальное —
+# в таблице analytics_cache.
+analytics_memory_cache: OrderedDict[
+    tuple[date, date],
+    dict[str, int],
+] = OrderedDict()
+
+
+def remember_period_metrics(
+    key: tuple[date, date],
+    metrics: dict[str, int],
+) -> None:
+    analytics_memory_cache[key] = metrics
+    analytics_memory_cache.move_to_end(
+        key
+    )
+
+    while len(analytics_memory_cache) > ANALYTICS_MEMORY_CACHE_MAX:
+        analytics_memory_cache.popitem(
+            last=False
+        )
+
+
+async def compute_period_metrics(
+    start_date: date,
+    end_date: date,
+) -> dict[str, int]:
+    """
+    Метрики за бангкокские даты start_date..end_date включительно.
+    Отменённые заказы в выручку не входят.
+    """
+    if not db_pool:
+        raise RuntimeError(
+            "База данных не подключена"
+        )
+
+    start_utc, _ = bangkok_day_bounds(
+        start_date
+    )
+
+    _, end_utc = bangkok_day_bounds(
+        end_date
+    )
+
+    row = await db_pool.fetchrow(
+        """
+        WITH order_totals AS (
+            SELECT
+                COUNT(*) AS orders_count,
+                COUNT(DISTINCT telegram_id) AS buyers,
+                COALESCE(SUM(total), 0) AS revenue,
+                COALESCE(SUM(bonus_used), 0) AS bonus_used,
+                COALESCE(SUM(cashback_earned), 0) AS cashback_earned
+            FROM orders
+            WHERE
+                created_at >= $1
+                AND created_at < $2
+                AND status <> 'cancelled'
+        ),
+
+        visit_totals AS (
+            SELECT
+                COUNT(DISTINCT telegram_id) AS unique_visitors
+            FROM visits
+            WHERE
+                visited_at >= $1
+                AND visited_at < $2
+        )
+
+        SELECT *
+        FROM order_totals
+        CROSS JOIN visit_totals
+        """,
+        start_utc,
+        end_utc,
     )
 
+    return {
+        key: int(row[key] or 0)
+        for key in (
+            "orders_count",
+            "buyers",
+            "revenue",
+            "bonus_used",
+            "cashback_earned",
+            "unique_visitors",
+        )
+    }
 
-# ============================================================================
-# ОТПРАВКА / ПОВТОРНАЯ ОТПРАВКА ЧЕКА
-# ============================================================================
 
-async def build_print_payload_from_database(
-    order_id: int,
-) -> dict:
+async def get_period_metrics(
+    start_date: date,
+    end_date: date,
+) -> dict[str, int]:
     """
-    Восстанавливает полный payload заказа из PostgreSQL.
-    Используется кнопкой «Отправить чек», поэтому повторная отправка
-    работает даже после перезапуска Railway.
+    Закрытый период берётся из кэша (память, затем analytics_cache),
+    открытый — тот, что включает сегодня, — считается заново.
     """
-    if not db_pool:
-        raise RuntimeError(
-            "База данных не подключена"
+    if end_date >= bangkok_today():
+        return await compute_period_metrics(
+            start_date,
+            end_date,
         )
 
-    async with db_pool.acquire() as conn:
-        order_row = await conn.fetchrow(
-            """
-            SELECT
-                id,
-                order_number,
-                customer_name,
-                phone,
-                address,
-                payment_method,
-                delivery_fee,
-                items_total,
-                discount_percent,
-                discount_amount,
-                bonus_used,
-                cashback_percent,
-                cashback_earned,
-                total,
-                order_when,
-                order_date,
-                order_time,
-                comment,
-                created_at
-            FROM orders
-            WHERE id = $1
-            """,
-            order_id,
-        )
+    key = (
+        start_date,
+        end_date,
+    )
 
-        if not order_row:
-            raise LookupError(
-                "Заказ не найден в базе"
-            )
+    cached = analytics_memory_cache.get(key)
 
-        item_rows = await conn.fetch(
-            """
-            SELECT
-                item_name,
-                quantity,
-                unit_price,
-                image_url
-            FROM order_items
-            WHERE order_id = $1
-            ORDER BY id
-            """,
-            order_id,
+    if cached is not None:
+        analytics_memory_cache.move_to_end(
+            key
         )
 
-    order_number = safe_str(
-        order_row["order_number"]
-    )
+        return cached
 
-    comment = safe_str(
-        order_row["comment"]
+    raw = await db_pool.fetchval(
+        """
+        SELECT metrics
+        FROM analytics_cache
+        WHERE
+            period_start = $1
+            AND period_end = $2
+        """,
+        start_date,
+        end_date,
     )
 
-    items = [
-        {
-            "name": safe_str(
-                row["item_name"]
-            ),
-            "qty": max(
-                1,
-                safe_int(
-                    row["quantity"],
-                    1,
-                ),
-            ),
-            "price": max(
-                0,
-                safe_int(
-                    row["unit_price"],
-                    0,
-                ),
-            ),
-            "img": safe_str(
-                row["image_url"]
-            ),
-        }
-        for row in item_rows
-    ]
+    if raw:
+        metrics = json.loads(raw)
 
-    created_at = order_row[
-        "created_at"
-    ]
+    else:
+        metrics = await compute_period_metrics(
+            start_date,
+            end_date,
+        )
 
-    if created_at:
-        try:
-            created_at = created_at.astimezone(
-                TIMEZONE
-            ).strftime(
-                "%Y-%m-%d %H:%M:%S"
+        await db_pool.execute(
+            """
+            INSERT INTO analytics_cache (
+                period_start,
+                period_end,
+                metrics
             )
-        except Exception:
-            created_at = safe_str(
-                created_at
+            VALUES (
+                $1,
+                $2,
+                $3::JSONB
             )
-    else:
-        created_at = datetime.now(
-            TIMEZONE
-        ).strftime(
-            "%Y-%m-%d %H:%M:%S"
+            ON CONFLICT (period_start, period_end)
+            DO NOTHING
+            """,
+            start_date,
+            end_date,
+            json.dumps(metrics),
         )
 
-    order_time = safe_str(
-        order_row["order_time"]
+    remember_period_metrics(
+        key,
+        metrics,
     )
 
-    return {
-        "order_number": order_number,
-        "orderNumber": order_number,
-        "order_no": order_number,
-        "orderNo": order_number,
+    return metrics
 
-        "name": safe_str(
-            order_row["customer_name"]
-        ),
-        "phone": safe_str(
-            order_row["phone"]
-        ),
-        "address": safe_str(
-            order_row["address"]
-        ),
-        "delivery": max(
-            0,
-            safe_int(
-                order_row["delivery_fee"],
-                0,
-            ),
-        ),
-        "payment": safe_str(
-            order_row["payment_method"]
-        ),
-        "items": items,
 
-        "items_total": max(
-            0,
-            safe_int(
-                order_row["items_total"],
-                0,
-            ),
-        ),
-        "itemsTotal": max(
-            0,
-            safe_int(
-                order_row["items_total"],
-                0,
-            ),
-        ),
-        "subtotal": max(
-            0,
-            safe_int(
-                order_row["items_total"],
-                0,
-            ),
-        ),
+def resolve_analytics_periods(
+    args: list[str],
+) -> tuple[date, date, date, date] | None:
+    """
+    Возвращает текущий период и период для сравнения:
+    day — сегодня и вчера, week — неделя с понедельника
+    и те же дни прошлой недели, month — месяц с 1-го числа
+    и те же дни прошлого месяца, две даты — период
+    и такой же по длине период перед ним.
+    """
+    today = bangkok_today()
+    kind = args[0].lower() if args else "day"
 
-        "discount_percent": max(
-            0,
-            safe_int(
-                order_row["discount_percent"],
-                0,
-            ),
-        ),
-        "discountPercent": max(
-            0,
-            safe_int(
-                order_row["discount_percent"],
-                0,
-            ),
-        ),
-        "discount_amount": max(
-            0,
-            safe_int(
-                order_row["discount_amount"],
-                0,
-            ),
-        ),
-        "discountAmount": max(
-            0,
-            safe_int(
-                order_row["discount_amount"],
-                0,
-            ),
-        ),
-        "discount": max(
-            0,
-            safe_int(
-                order_row["bonus_used"] or order_row["discount_amount"],
-                0,
-            ),
-        ),
-        "bonus_used": max(
-            0,
-            safe_int(
-                order_row["bonus_used"] or order_row["discount_amount"],
-                0,
-            ),
-        ),
-        "used_bonuses": max(
-            0,
-            safe_int(
-                order_row["bonus_used"] or order_row["discount_amount"],
-                0,
-            ),
-        ),
-        "cashback_percent": max(
-            0,
-            safe_int(order_row["cashback_percent"], 0),
-        ),
-        "cashback_earned": max(
-            0,
-            safe_int(order_row["cashback_earned"], 0),
-        ),
+    if kind == "day":
+        return (
+            today,
+            today,
+            today - timedelta(days=1),
+            today - timedelta(days=1),
+        )
 
-        "total": max(
-            0,
-            safe_int(
-                order_row["total"],
-                0,
+    if kind == "week":
+        start = today - timedelta(days=today.weekday())
+
+        return (
+            start,
+            today,
+            start - timedelta(days=7),
+            today - timedelta(days=7),
+        )
+
+    if kind == "month":
+        start = today.replace(day=1)
+        prev_end_of_month = start - timedelta(days=1)
+        prev_start = prev_end_of_month.replace(day=1)
+
+        return (
+            start,
+            today,
+            prev_start,
+            prev_start.replace(
+                day=min(
+                    today.day,
+                    prev_end_of_month.day,
+                )
             ),
-        ),
-        "date": created_at,
-        "order_time": order_time,
-        "order_when": safe_str(
-            order_row["order_when"]
-        ),
+        )
 
-        "comment": comment,
-        "comments": comment,
-        "comment_text": comment,
-        "note": comment,
-        "notes": comment,
-    }
+    start = parse_report_date(args[0])
+    end = (
+        parse_report_date(args[1])
+        if len(args) > 1
+        else start
+    )
+
+    if start is None or end is None:
+        return None
+
+    if end < start:
+        start, end = end, start
+
+    end = min(end, today)
+
+    if start > end:
+        return None
 
+    length = end - start + timedelta(days=1)
 
-async def send_payload_to_receipt_program(
-    print_payload: dict,
-    timeout_seconds: int = 12,
-) -> tuple[int, str]:
-    """
-    Отправляет заказ в чековую программу.
-    При временной ошибке ngrok (502/503/504) или сети делает один повтор.
-    Повтор безопасен, потому что printer_gui.py не создаёт второй JSON
-    для уже принятого order_number.
-    """
-    timeout = aiohttp.ClientTimeout(
-        total=timeout_seconds
+    return (
+        start,
+        end,
+        start - length,
+        end - length,
     )
 
-    last_error: Exception | None = None
 
-    async with aiohttp.ClientSession(
-        timeout=timeout
-    ) as session:
-        for attempt in range(2):
-            try:
-                async with session.post(
-                    PRINT_URL,
-                    json=print_payload,
-                ) as response:
-                    response_text = await response.text()
-
-                    if 200 <= response.status < 300:
-                        return (
-                            response.status,
-                            response_text,
-                        )
+def format_metric_change(
+    current: float,
+    previous: float,
+) -> str:
+    if not previous:
+        return "—" if not current else "новое"
 
-                    error = RuntimeError(
-                        (
-                            f"Чековая программа вернула HTTP "
-                            f"{response.status}: "
-                            f"{response_text[:500]}"
-                        )
-                    )
+    change = (current - previous) / previous * 100
 
-                    if response.status in (502, 503, 504) and attempt == 0:
-                        last_error = error
-                        logger.warning(
-                            "PRINT HTTP %s. Повторная отправка через 1 секунду.",
-                            response.status,
-                        )
-                        await asyncio.sleep(1)
-                        continue
+    return f"{change:+.1f}%"
 
-                    raise error
 
-            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
-                last_error = exc
+async def build_analytics_report(
+    start_date: date,
+    end_date: date,
+    prev_start: date,
+    prev_end: date,
+) -> str:
+    current, previous = await asyncio.gather(
+        get_period_metrics(start_date, end_date),
+        get_period_metrics(prev_start, prev_end),
+    )
 
-                if attempt == 0:
-                    logger.warning(
-                        "PRINT network error: %s. Повторная отправка через 1 секунду.",
-                        safe_str(exc),
-                    )
-                    await asyncio.sleep(1)
-                    continue
+    def derived(metrics: dict[str, int]) -> dict[str, float]:
+        orders_count = metrics["orders_count"]
+        unique_visitors = metrics["unique_visitors"]
 
-                raise
+        return {
+            "avg_check": (
+                metrics["revenue"] / orders_count
+                if orders_count
+                else 0
+            ),
+            "conversion": (
+                orders_count / unique_visitors * 100
+                if unique_visitors
+                else 0
+            ),
+        }
 
-    if last_error is not None:
-        raise last_error
+    current_derived = derived(current)
+    previous_derived = derived(previous)
 
-    raise RuntimeError("Не удалось отправить заказ в чековую программу")
+    def period_title(start: date, end: date) -> str:
+        if start == end:
+            return start.strftime("%d.%m.%Y")
 
+        return (
+            f"{start.strftime('%d.%m.%Y')}"
+            f" — {end.strftime('%d.%m.%Y')}"
+        )
 
-# ============================================================================
-# СТАТИСТИКА
-# ============================================================================
+    lines = [
+        f"📈 Аналитика за {period_title(start_date, end_date)}",
+        f"Сравнение с {period_title(prev_start, prev_end)}",
+        "",
+    ]
 
-async def build_daily_report() -> str:
-    if not db_pool:
-        raise RuntimeError(
-            "База данных не подключена"
+    for label, cur, prev, unit in (
+        ("Выручка", current["revenue"], previous["revenue"], " ฿"),
+        ("Заказов", current["orders_count"], previous["orders_count"], ""),
+        (
+            "Средний чек",
+            round(current_derived["avg_check"]),
+            round(previous_derived["avg_check"]),
+            " ฿",
+        ),
+        ("Покупателей", current["buyers"], previous["buyers"], ""),
+        (
+            "Уникальных посетителей",
+            current["unique_visitors"],
+            previous["unique_visitors"],
+            "",
+        ),
+    ):
+        lines.append(
+            f"{label}: {cur}{unit} "
+            f"({format_metric_change(cur, prev)}, было {prev}{unit})"
         )
 
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            """
-            WITH day_bounds AS (
-                SELECT
-                    (
-                        date_trunc(
-                            'day',
-                            NOW()
-                            AT TIME ZONE
-                            'Asia/Bangkok'
-                        )
-                        AT TIME ZONE
-                        'Asia/Bangkok'
-                    ) AS start_utc,
+    lines.append(
+        f"Конверсия: {current_derived['conversion']:.1f}% "
+        f"(было {previous_derived['conversion']:.1f}%)"
+    )
 
-                    (
-                        (
-                            date_trunc(
-                                'day',
-                                NOW()
-                                AT TIME ZONE
-                                'Asia/Bangkok'
-                            )
-                            + INTERVAL '1 day'
-                        )
-                        AT TIME ZONE
-                        'Asia/Bangkok'
-                    ) AS end_utc
-            )
+    lines += [
+        "",
+        f"🎁 Списано бонусов: {current['bonus_used']} ฿ "
+        f"(было {previous['bonus_used']} ฿)",
+        f"💸 Начислено кэшбэка: {current['cashback_earned']} ฿ "
+        f"(было {previous['cashback_earned']} ฿)",
+        f"Баланс бонусов за период: "
+        f"{current['cashback_earned'] - current['bonus_used']:+} ฿",
+    ]
 
-            SELECT
-                (
-                    SELECT COUNT(*)
-                    FROM users
-                ) AS total_users,
+    return "\n".join(lines)
 
-                (
-                    SELECT COUNT(*)
-                    FROM users
-                    WHERE is_active = TRUE
-                ) AS active_users,
 
-                (
-                    SELECT COUNT(*)
-                    FROM users
-                    WHERE
-                        is_active = TRUE
-                        AND marketing_allowed = TRUE
-                ) AS marketing_users,
+# ============================================================================
+# РАССЫЛКИ
+# ============================================================================
 
-                (
-                    SELECT COUNT(*)
-                    FROM users
-                    WHERE is_active = FALSE
-                ) AS blocked_users,
+def broadcast_target_condition(
+    broadcast_type: str,
+) -> str:
+    if broadcast_type == "advertising":
+        return (
+            "is_active = TRUE "
+            "AND marketing_allowed = TRUE "
+            "AND telegram_id <> $1"
+        )
 
-                (
-                    SELECT COUNT(*)
-                    FROM users u,
-                         day_bounds d
-                    WHERE
-                        u.last_bot_activity_at
-                            >= d.start_utc
-                        AND
-                        u.last_bot_activity_at
-                            < d.end_utc
-                ) AS active_today,
+    return (
+        "is_active = TRUE "
+        "AND telegram_id <> $1"
+    )
 
-                (
-                    SELECT COUNT(*)
-                    FROM visits v,
-                         day_bounds d
-                    WHERE
-                        v.visited_at
-                            >= d.start_utc
-                        AND
-                        v.visited_at
-                            < d.end_utc
-                ) AS visits,
 
-                (
-                    SELECT COUNT(
-                        DISTINCT telegram_id
-                    )
-                    FROM visits v,
-                         day_bounds d
-                    WHERE
-                        v.visited_at
-                            >= d.start_utc
-                        AND
-                        v.visited_at
-                            < d.end_utc
-                        AND
-                        telegram_id
-                            IS NOT NULL
-                ) AS unique_visitors,
+def invalidate_broadcast_target_counts() -> None:
+    broadcast_target_count_cache.clear()
 
-                (
-                    SELECT COUNT(*)
-                    FROM users u,
-                         day_bounds d
-                    WHERE
-                        u.created_at
-                            >= d.start_utc
-                        AND
-                        u.created_at
-                            < d.end_utc
-                ) AS new_users,
 
-                (
-                    SELECT COUNT(*)
-                    FROM orders o,
-                         day_bounds d
-                    WHERE
-                        o.created_at
-                            >= d.start_utc
-                        AND
-                        o.created_at
-                            < d.end_utc
-                ) AS orders_count,
+async def get_broadcast_target_count(
+    broadcast_type: str,
+) -> int:
+    if not db_pool:
+        return 0
 
-                (
-                    SELECT COUNT(
-                        DISTINCT telegram_id
-                    )
-                    FROM orders o,
-                         day_bounds d
-                    WHERE
-                        o.created_at
-                            >= d.start_utc
-                        AND
-                        o.created_at
-                            < d.end_utc
-                ) AS buyers,
+    cached = broadcast_target_count_cache.get(
+        broadcast_type
+    )
 
-                (
-                    SELECT
-                        COALESCE(
-                            SUM(total),
-                            0
-                        )
-                    FROM orders o,
-                         day_bounds d
-                    WHERE
-                        o.created_at
-                            >= d.start_utc
-                        AND
-                        o.created_at
-                            < d.end_utc
-                ) AS revenue,
+    if (
+        cached
+        and cached[1] > time.monotonic()
+    ):
+        return cached[0]
 
-                (
-                    SELECT
-                        COALESCE(
-                            AVG(total),
-                            0
-                        )
-                    FROM orders o,
-                         day_bounds d
-                    WHERE
-                        o.created_at
-                            >= d.start_utc
-                        AND
-                        o.created_at
-                            < d.end_utc
-                ) AS avg_check
-            """
+    count = int(
+        await db_pool.fetchval(
+            f"""
+            SELECT COUNT(*)
+            FROM users
+            WHERE {broadcast_target_condition(broadcast_type)}
+            """,
+            ADMIN_CHAT_ID,
         )
-
-    visits = int(
-        row["visits"]
         or 0
     )
 
-    unique_visitors = int(
-        row["unique_visitors"]
-        or 0
+    broadcast_target_count_cache[
+        broadcast_type
+    ] = (
+        count,
+        time.monotonic() + BROADCAST_COUNT_CACHE_SECONDS,
     )
 
-    orders_count = int(
-        row["orders_count"]
-        or 0
-    )
+    return count
 
-    conversion = (
-        orders_count
-        / unique_visitors
-        * 100
-        if unique_visitors
-        else 0
-    )
 
-    today = datetime.now(
-        TIMEZONE
-    ).strftime(
-        "%d.%m.%Y"
-    )
+async def create_broadcast_log(
+    broadcast_type: str,
+    source_chat_id: int | None,
+    source_message_id: int | None,
+) -> tuple[int, int]:
+    """
+    Создаёт рассылку и сразу фиксирует список получателей
+    в broadcast_recipients. Возвращает (log_id, total_targets).
+    """
+    if not db_pool:
+        return 0, 0
 
-    return (
-        f"📊 Статистика за {today}\n\n"
+    async with db_pool.acquire() as conn:
+        async with conn.transaction():
+            log_id = await conn.fetchval(
+                """
+                INSERT INTO broadcast_logs (
+                    broadcast_type,
+                    created_by,
+                    source_chat_id,
+                    source_message_id,
+                    status,
+                    owner
+                )
+                VALUES (
+                    $1,$2,$3,$4,
+                    'running',
+                    $5
+                )
+                RETURNING id
+                """,
+                broadcast_type,
+                ADMIN_CHAT_ID,
+                source_chat_id,
+                source_message_id,
+                INSTANCE_ID,
+            )
 
-        f"👥 Всего ID в базе: "
-        f"{int(row['total_users'] or 0)}\n"
+            total = await conn.fetchval(
+                f"""
+                WITH inserted AS (
+                    INSERT INTO broadcast_recipients (
+                        broadcast_id,
+                        telegram_id
+                    )
+                    SELECT
+                        $2,
+                        telegram_id
+                    FROM users
+                    WHERE {broadcast_target_condition(broadcast_type)}
+                    RETURNING 1
+                )
+                SELECT COUNT(*)
+                FROM inserted
+                """,
+                ADMIN_CHAT_ID,
+                log_id,
+            )
 
-        f"✅ Активных пользователей: "
-        f"{int(row['active_users'] or 0)}\n"
+            await conn.execute(
+                """
+                UPDATE broadcast_logs
+                SET total_targets = $2
+                WHERE id = $1
+                """,
+                log_id,
+                total,
+            )
 
-        f"📣 Доступно для рекламы: "
-        f"{int(row['marketing_users'] or 0)}\n"
+    return (
+        int(log_id),
+        int(total),
+    )
 
-        f"🚫 Заблокировали/недоступны: "
-        f"{int(row['blocked_users'] or 0)}\n"
 
-        f"💬 Пользователей бота сегодня: "
-        f"{int(row['active_today'] or 0)}\n"
+async def take_over_broadcast_log(
+    log_id: int,
+) -> bool:
+    """
+    Забирает прерванную рассылку себе. Получатели в статусе
+    sending могли уже получить сообщение, поэтому они
+    помечаются skipped и повторно не отправляются.
 
-        f"🆕 Новых пользователей: "
-        f"{int(row['new_users'] or 0)}\n\n"
+    False — рассылку уже забрал другой процесс.
+    """
+    if not db_pool:
+        return False
 
-        f"Открытий сайта: {visits}\n"
+    return bool(
+        await db_pool.fetchval(
+            """
+            WITH claimed AS (
+                UPDATE broadcast_logs
+                SET
+                    status = 'running',
+                    owner = $2,
+                    completed_at = NULL
+                WHERE
+                    id = $1
+                    AND status = 'interrupted'
+                RETURNING id
+            ),
 
-        f"Уникальных посетителей: "
-        f"{unique_visitors}\n\n"
+            skipped AS (
+                UPDATE broadcast_recipients AS r
+                SET
+                    status = 'skipped',
+                    processed_at = NOW()
+                FROM claimed c
+                WHERE
+                    r.broadcast_id = c.id
+                    AND r.status = 'sending'
+            )
 
-        f"Заказов: {orders_count}\n"
+            SELECT COUNT(*)
+            FROM claimed
+            """,
+            log_id,
+            INSTANCE_ID,
+        )
+    )
 
-        f"Покупателей: "
-        f"{int(row['buyers'] or 0)}\n"
 
-        f"Конверсия: "
-        f"{conversion:.1f}%\n\n"
+async def load_broadcast_progress(
+    log_id: int,
+) -> tuple[int, dict[str, int]]:
+    """
+    Возвращает общее число получателей и уже
+    обработанных по статусам.
+    """
+    counters = {
+        "processed": 0,
+        "delivered": 0,
+        "blocked": 0,
+        "failed": 0,
+    }
 
-        f"Выручка: "
-        f"{int(row['revenue'] or 0)} ฿\n"
+    if not db_pool or not log_id:
+        return 0, counters
 
-        f"Средний чек: "
-        f"{round(float(row['avg_check'] or 0))} ฿"
+    rows = await db_pool.fetch(
+        """
+        SELECT
+            status,
+            COUNT(*) AS amount
+        FROM broadcast_recipients
+        WHERE broadcast_id = $1
+        GROUP BY status
+        """,
+        log_id,
     )
 
+    total = 0
 
-# ============================================================================
-# РАССЫЛКИ
-# ============================================================================
+    for row in rows:
+        amount = int(row["amount"])
+        total += amount
 
-async def get_broadcast_targets(
-    broadcast_type: str,
-) -> list[asyncpg.Record]:
+        if row["status"] in ("pending", "sending"):
+            continue
+
+        counters["processed"] += amount
+
+        if row["status"] in counters:
+            counters[row["status"]] += amount
+
+        else:
+            counters["failed"] += amount
+
+    return total, counters
+
+
+async def iter_pending_broadcast_recipients(
+    log_id: int,
+    page_size: int = BROADCAST_PAGE_SIZE,
+):
+    """
+    Keyset-пагинация по ещё не отправленным получателям рассылки.
+    """
     if not db_pool:
-        return []
+        return
 
-    if broadcast_type == "advertising":
-        return await db_pool.fetch(
+    last_id = None
+
+    while True:
+        page = await db_pool.fetch(
             """
             SELECT
-                telegram_id,
-                username,
-                telegram_first_name,
-                telegram_last_name
-            FROM users
+                r.telegram_id,
+                u.username,
+                u.telegram_first_name,
+                u.telegram_last_name
+            FROM broadcast_recipients r
+            LEFT JOIN users u
+                ON u.telegram_id = r.telegram_id
             WHERE
-                is_active = TRUE
-                AND marketing_allowed = TRUE
-                AND telegram_id <> $1
-            ORDER BY telegram_id
+                r.broadcast_id = $1
+                AND r.status = 'pending'
+                AND ($2::BIGINT IS NULL OR r.telegram_id > $2)
+            ORDER BY r.telegram_id
+            LIMIT $3
             """,
-            ADMIN_CHAT_ID,
+            log_id,
+            last_id,
+            page_size,
         )
 
-    return await db_pool.fetch(
-        """
-        SELECT
-            telegram_id,
-            username,
-            telegram_first_name,
-            telegram_last_name
-        FROM users
-        WHERE
-            is_active = TRUE
-            AND telegram_id <> $1
-        ORDER BY telegram_id
-        """,
-        ADMIN_CHAT_ID,
-    )
+        if not page:
+            return
 
+        yield page
 
-async def get_broadcast_target_count(
-    broadcast_type: str,
-) -> int:
-    targets = await get_broadcast_targets(
-        broadcast_type
-    )
+        last_id = int(
+            page[-1]["telegram_id"]
+        )
+
+
+async def claim_broadcast_recipients(
+    log_id: int,
+    telegram_ids: list[int],
+) -> None:
+    """
+    Помечает получателей как взятых в работу до отправки.
+    При штатной остановке тех, кто не дошёл до воркера,
+    возвращает release_broadcast_recipients. После падения
+    оставшиеся 'sending' не получат сообщение повторно.
+    """
+    if not db_pool or not telegram_ids:
+        return
 
-    return len(
-        targets
+    await db_pool.execute(
+        """
+        UPDATE broadcast_recipients
+        SET status = 'sending'
+        WHERE
+            broadcast_id = $1
+            AND telegram_id = ANY($2::BIGINT[])
+            AND status = 'pending'
+        """,
+        log_id,
+        telegram_ids,
     )
 
 
-async def create_broadcast_log(
-    broadcast_type: str,
-    source_chat_id: int | None,
-    source_message_id: int | None,
-    total_targets: int,
-) -> int:
-    if not db_pool:
-        return 0
+async def release_broadcast_recipients(
+    log_id: int,
+    telegram_ids: set[int],
+) -> None:
+    """
+    Возвращает в очередь получателей, которых взяли
+    в работу, но ещё не начали отправлять.
+    """
+    if not db_pool or not telegram_ids:
+        return
 
-    log_id = await db_pool.fetchval(
+    await db_pool.execute(
         """
-        INSERT INTO broadcast_logs (
-            broadcast_type,
-            created_by,
-            source_chat_id,
-            source_message_id,
-            total_targets,
-            status
-        )
-        VALUES (
-            $1,$2,$3,$4,$5,
-            'running'
-        )
-        RETURNING id
+        UPDATE broadcast_recipients
+        SET status = 'pending'
+        WHERE
+            broadcast_id = $1
+            AND telegram_id = ANY($2::BIGINT[])
+            AND status = 'sending'
         """,
-        broadcast_type,
-        ADMIN_CHAT_ID,
-        source_chat_id,
-        source_message_id,
-        total_targets,
-    )
-
-    return int(
-        log_id
+        log_id,
+        list(telegram_ids),
     )
 
 
@@ -2495,6 +6467,8 @@ async def finish_broadcast_log(
     ):
         return
 
+    # Если аренду забрал другой процесс, рассылка уже его:
+    # его статус не перезаписываем.
     await db_pool.execute(
         """
         UPDATE broadcast_logs
@@ -2504,20 +6478,218 @@ async def finish_broadcast_log(
             failed = $4,
             status = $5,
             completed_at = NOW()
-        WHERE id = $1
+        WHERE
+            id = $1
+            AND owner = $6
         """,
         log_id,
         delivered,
         blocked,
         failed,
         status,
+        INSTANCE_ID,
     )
 
 
+class BroadcastResultBuffer:
+    """
+    Копит результаты отправки рассылки и записывает их
+    в users и broadcast_recipients одним запросом на пачку.
+
+    Семантика колонок та же, что у mark_send_success
+    и mark_send_error.
+    """
+
+    def __init__(
+        self,
+        send_type: str,
+        broadcast_id: int,
+        batch_size: int = BROADCAST_RESULT_BATCH,
+    ) -> None:
+        self.send_type = send_type
+        self.broadcast_id = broadcast_id
+        self.batch_size = max(
+            1,
+            batch_size,
+        )
+
+        self._rows: list[tuple] = []
+        self._lock = asyncio.Lock()
+
+    async def add(
+        self,
+        telegram_id: int,
+        ok: bool,
+        error_text: str | None = None,
+        deactivate: bool = False,
+    ) -> None:
+        self._rows.append(
+            (
+                telegram_id,
+                ok,
+                deactivate,
+                error_text,
+                datetime.now(
+                    timezone.utc
+                ),
+            )
+        )
+
+        if len(self._rows) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self) -> bool:
+        """
+        Записывает накопленное. При ошибке строки остаются
+        в буфере; возвращает False, если что-то не записано.
+        """
+        async with self._lock:
+            if not self._rows:
+                return True
+
+            if not db_pool:
+                return False
+
+            rows = self._rows
+            self._rows = []
+
+            try:
+                await db_pool.execute(
+                    """
+                    WITH r AS (
+                        SELECT *
+                        FROM unnest(
+                            $1::BIGINT[],
+                            $2::BOOLEAN[],
+                            $3::BOOLEAN[],
+                            $4::TEXT[],
+                            $5::TIMESTAMPTZ[]
+                        ) AS r(
+                            telegram_id,
+                            ok,
+                            deactivate,
+                            error_text,
+                            sent_at
+                        )
+                    ),
+
+                    recipients AS (
+                        UPDATE broadcast_recipients AS b
+                        SET
+                            status = CASE
+                                WHEN r.ok THEN 'delivered'
+                                WHEN r.deactivate THEN 'blocked'
+                                ELSE 'failed'
+                            END,
+                            processed_at = r.sent_at
+                        FROM r
+                        WHERE
+                            b.broadcast_id = $7
+                            AND b.telegram_id = r.telegram_id
+                    )
+
+                    UPDATE users AS u
+                    SET
+                        is_active = CASE
+                            WHEN r.ok THEN TRUE
+                            WHEN r.deactivate THEN FALSE
+                            ELSE u.is_active
+                        END,
+
+                        blocked_at = CASE
+                            WHEN r.ok THEN NULL
+                            WHEN r.deactivate THEN r.sent_at
+                            ELSE u.blocked_at
+                        END,
+
+                        last_send_error = CASE
+                            WHEN r.ok THEN NULL
+                            ELSE LEFT(r.error_text, 1000)
+                        END,
+
+                        last_successful_send_at = CASE
+                            WHEN r.ok THEN r.sent_at
+                            ELSE u.last_successful_send_at
+                        END,
+
+                        last_broadcast_at = CASE
+                            WHEN r.ok AND $6 = 'broadcast'
+                            THEN r.sent_at
+                            ELSE u.last_broadcast_at
+                        END,
+
+                        last_keyboard_sent_at = CASE
+                            WHEN r.ok AND $6 = 'keyboard'
+                            THEN r.sent_at
+                            ELSE u.last_keyboard_sent_at
+                        END,
+
+                        updated_at = CASE
+                            WHEN r.ok THEN u.updated_at
+                            ELSE NOW()
+                        END
+
+                    FROM r
+
+                    WHERE u.telegram_id = r.telegram_id
+                    """,
+                    [row[0] for row in rows],
+                    [row[1] for row in rows],
+                    [row[2] for row in rows],
+                    [row[3] for row in rows],
+                    [row[4] for row in rows],
+                    self.send_type,
+                    self.broadcast_id,
+                )
+
+                if any(row[2] for row in rows):
+                    invalidate_broadcast_target_counts()
+
+                return True
+
+            except (Exception, asyncio.CancelledError) as exc:
+                # Повторим вместе со следующей пачкой или в close():
+                # при отмене воркера пачка тоже не должна пропасть.
+                self._rows[:0] = rows
+
+                if isinstance(exc, asyncio.CancelledError):
+                    raise
+
+                logger.exception(
+                    "BROADCAST RESULTS FLUSH ERROR: rows=%s",
+                    len(rows),
+                )
+
+                return False
+
+    async def close(self) -> None:
+        """
+        Последняя запись в конце рассылки: следующей пачки
+        уже не будет, поэтому повторяем с паузой. Что так и
+        не записалось, попадает в лог поимённо.
+        """
+        for attempt in range(
+            1,
+            BROADCAST_RESULT_FLUSH_ATTEMPTS + 1,
+        ):
+            if await self.flush():
+                return
+
+            if attempt < BROADCAST_RESULT_FLUSH_ATTEMPTS:
+                await asyncio.sleep(attempt)
+
+        logger.error(
+            "BROADCAST RESULTS LOST: broadcast=%s rows=%s",
+            self.broadcast_id,
+            self._rows,
+        )
+
+
 async def send_advertising_message(
     telegram_id: int,
     source_chat_id: int,
     source_message_id: int,
+    results: BroadcastResultBuffer,
 ) -> str:
     try:
         await bot.copy_message(
@@ -2529,34 +6701,21 @@ async def send_advertising_message(
             ),
         )
 
-        await mark_send_success(
+        await results.add(
             telegram_id,
-            "broadcast",
+            True,
         )
 
         return "delivered"
 
-    except TelegramRetryAfter as exc:
-        await asyncio.sleep(
-            float(
-                exc.retry_after
-            )
-            + 1
-        )
-
-        return await send_advertising_message(
-            telegram_id,
-            source_chat_id,
-            source_message_id,
-        )
-
     except Exception as exc:
         blocked = is_blocking_error(
             exc
         )
 
-        await mark_send_error(
+        await results.add(
             telegram_id,
+            False,
             str(exc),
             blocked,
         )
@@ -2575,6 +6734,7 @@ async def send_advertising_message(
 
 async def send_new_keyboard(
     user_row: asyncpg.Record,
+    results: BroadcastResultBuffer,
 ) -> str:
     telegram_id = int(
         user_row[
@@ -2600,32 +6760,21 @@ async def send_new_keyboard(
             ),
         )
 
-        await mark_send_success(
+        await results.add(
             telegram_id,
-            "keyboard",
+            True,
         )
 
         return "delivered"
 
-    except TelegramRetryAfter as exc:
-        await asyncio.sleep(
-            float(
-                exc.retry_after
-            )
-            + 1
-        )
-
-        return await send_new_keyboard(
-            user_row
-        )
-
     except Exception as exc:
         blocked = is_blocking_error(
             exc
         )
 
-        await mark_send_error(
+        await results.add(
             telegram_id,
+            False,
             str(exc),
             blocked,
         )
@@ -2642,137 +6791,340 @@ async def send_new_keyboard(
         return "failed"
 
 
+def build_broadcast_progress_text(
+    title: str,
+    total: int,
+    counters: dict[str, int],
+) -> str:
+    return (
+        f"{title}\n\n"
+        f"Получателей: {total}\n"
+        f"Обработано: {counters['processed']}\n"
+        f"Доставлено: {counters['delivered']}\n"
+        f"Недоступны: {counters['blocked']}\n"
+        f"Другие ошибки: {counters['failed']}"
+    )
+
+
+async def broadcast_worker(
+    queue: asyncio.Queue,
+    broadcast_type: str,
+    source_chat_id: int | None,
+    source_message_id: int | None,
+    counters: dict[str, int],
+    results: BroadcastResultBuffer,
+    queued_ids: set[int],
+) -> None:
+    OUTBOUND_PRIORITY.set(
+        PRIORITY_BULK
+    )
+
+    while True:
+        user_row = await queue.get()
+
+        if user_row is None:
+            return
+
+        telegram_id = int(
+            user_row[
+                "telegram_id"
+            ]
+        )
+
+        # С этого момента отправка могла уйти в Telegram:
+        # при остановке получатель уже не вернётся в очередь.
+        queued_ids.discard(
+            telegram_id
+        )
+
+        try:
+            if broadcast_type == "advertising":
+                result = await send_advertising_message(
+                    telegram_id,
+                    source_chat_id,
+                    source_message_id,
+                    results,
+                )
+
+            else:
+                result = await send_new_keyboard(
+                    user_row,
+                    results,
+                )
+
+        except Exception:
+            logger.exception(
+                "BROADCAST WORKER ERROR: user=%s",
+                telegram_id,
+            )
+
+            result = "failed"
+
+        counters["processed"] += 1
+
+        if result in (
+            "delivered",
+            "blocked",
+        ):
+            counters[result] += 1
+
+        else:
+            counters["failed"] += 1
+
+
+async def broadcast_progress_loop(
+    total: int,
+    counters: dict[str, int],
+    progress_message_id: int,
+) -> None:
+    OUTBOUND_PRIORITY.set(
+        PRIORITY_BULK
+    )
+
+    last_processed = -1
+
+    while True:
+        await asyncio.sleep(
+            BROADCAST_PROGRESS_SECONDS
+        )
+
+        if counters["processed"] == last_processed:
+            continue
+
+        last_processed = counters["processed"]
+
+        try:
+            await bot.edit_message_text(
+                chat_id=ADMIN_CHAT_ID,
+                message_id=progress_message_id,
+                text=build_broadcast_progress_text(
+                    "🚀 Рассылка выполняется",
+                    total,
+                    counters,
+                ),
+            )
+
+        except TelegramBadRequest:
+            pass
+
+        except Exception:
+            logger.exception(
+                "BROADCAST PROGRESS UPDATE ERROR"
+            )
+
+
 async def run_broadcast(
     broadcast_type: str,
     source_chat_id: int | None = None,
     source_message_id: int | None = None,
+    resume_log_id: int | None = None,
 ) -> None:
+    """
+    Рассылка через пул из BROADCAST_WORKERS отправителей.
+
+    Скорость ограничивает telegram_rate_governor: рассылка идёт
+    в полосе PRIORITY_BULK и уступает транзакционным отправкам.
+    Поэтому пропускная способность не зависит от задержки API.
+
+    Получатели фиксируются в broadcast_recipients, поэтому
+    прерванную рассылку можно продолжить через resume_log_id.
+    """
     global broadcast_running
 
     if broadcast_lock.locked():
-        await bot.send_message(
-            ADMIN_CHAT_ID,
-            "⚠️ Другая рассылка уже выполняется.",
-        )
+        if not resume_log_id:
+            await bot.send_message(
+                ADMIN_CHAT_ID,
+                "⚠️ Другая рассылка уже выполняется.",
+            )
 
         return
 
+    # Между проверкой и захватом нет await: свободный
+    # asyncio.Lock берётся без переключения задач.
     async with broadcast_lock:
+        if not await broadcast_lease.acquire():
+            if not resume_log_id:
+                await bot.send_message(
+                    ADMIN_CHAT_ID,
+                    (
+                        "⚠️ Другая рассылка уже выполняется "
+                        "на другом экземпляре бота."
+                    ),
+                )
+
+            return
+
         broadcast_running = True
 
-        delivered = 0
-        blocked = 0
-        failed = 0
-        log_id = 0
+        counters = {
+            "processed": 0,
+            "delivered": 0,
+            "blocked": 0,
+            "failed": 0,
+        }
+
+        log_id = resume_log_id or 0
+        workers: list[asyncio.Task] = []
+        progress_task: asyncio.Task | None = None
+        results: BroadcastResultBuffer | None = None
+
+        # Взяты в работу ('sending'), но ни один воркер
+        # их ещё не получил из очереди.
+        queued_ids: set[int] = set()
 
         try:
-            targets = await get_broadcast_targets(
-                broadcast_type
-            )
+            if (
+                broadcast_type == "advertising"
+                and (
+                    source_chat_id is None
+                    or source_message_id is None
+                )
+            ):
+                raise RuntimeError(
+                    "Не найдено сообщение для рассылки"
+                )
 
-            total = len(
-                targets
-            )
+            if resume_log_id:
+                if not await take_over_broadcast_log(
+                    resume_log_id
+                ):
+                    logger.info(
+                        "Рассылку %s уже возобновил другой процесс",
+                        resume_log_id,
+                    )
+                    return
 
-            log_id = await create_broadcast_log(
-                broadcast_type,
-                source_chat_id,
-                source_message_id,
-                total,
+                total, counters = await load_broadcast_progress(
+                    resume_log_id
+                )
+
+                title = (
+                    f"🔁 Рассылка №{resume_log_id} возобновлена"
+                )
+
+            else:
+                log_id, total = await create_broadcast_log(
+                    broadcast_type,
+                    source_chat_id,
+                    source_message_id,
+                )
+
+                title = "🚀 Рассылка запущена"
+
+            results = BroadcastResultBuffer(
+                (
+                    "broadcast"
+                    if broadcast_type == "advertising"
+                    else "keyboard"
+                ),
+                log_id,
             )
 
             progress_message = await bot.send_message(
                 ADMIN_CHAT_ID,
-                (
-                    "🚀 Рассылка запущена\n\n"
-                    f"Получателей: {total}\n"
-                    "Обработано: 0"
+                build_broadcast_progress_text(
+                    title,
+                    total,
+                    counters,
                 ),
             )
 
-            for index, user_row in enumerate(
-                targets,
-                start=1,
-            ):
-                telegram_id = int(
-                    user_row[
-                        "telegram_id"
-                    ]
-                )
-
-                if broadcast_type == "advertising":
-                    if (
-                        source_chat_id is None
-                        or source_message_id is None
-                    ):
-                        raise RuntimeError(
-                            "Не найдено сообщение для рассылки"
-                        )
+            queue: asyncio.Queue = asyncio.Queue(
+                maxsize=BROADCAST_WORKERS * 2
+            )
 
-                    result = await send_advertising_message(
-                        telegram_id,
+            workers = [
+                asyncio.create_task(
+                    broadcast_worker(
+                        queue,
+                        broadcast_type,
                         source_chat_id,
                         source_message_id,
+                        counters,
+                        results,
+                        queued_ids,
                     )
-
-                else:
-                    result = await send_new_keyboard(
-                        user_row
+                )
+                for _ in range(
+                    max(
+                        1,
+                        min(
+                            BROADCAST_WORKERS,
+                            total - counters["processed"],
+                        ),
                     )
+                )
+            ]
+
+            progress_task = asyncio.create_task(
+                broadcast_progress_loop(
+                    total,
+                    counters,
+                    progress_message.message_id,
+                )
+            )
+
+            async for page in iter_pending_broadcast_recipients(
+                log_id
+            ):
+                for offset in range(
+                    0,
+                    len(page),
+                    BROADCAST_RESULT_BATCH,
+                ):
+                    chunk = page[
+                        offset:offset + BROADCAST_RESULT_BATCH
+                    ]
 
-                if result == "delivered":
-                    delivered += 1
+                    chunk_ids = [
+                        int(row["telegram_id"])
+                        for row in chunk
+                    ]
 
-                elif result == "blocked":
-                    blocked += 1
+                    queued_ids.update(
+                        chunk_ids
+                    )
 
-                else:
-                    failed += 1
+                    await claim_broadcast_recipients(
+                        log_id,
+                        chunk_ids,
+                    )
 
-                if (
-                    index % 25 == 0
-                    or index == total
-                ):
-                    try:
-                        await bot.edit_message_text(
-                            chat_id=ADMIN_CHAT_ID,
-                            message_id=(
-                                progress_message
-                                .message_id
-                            ),
-                            text=(
-                                "🚀 Рассылка выполняется\n\n"
-                                f"Получателей: {total}\n"
-                                f"Обработано: {index}\n"
-                                f"Доставлено: {delivered}\n"
-                                f"Недоступны: {blocked}\n"
-                                f"Другие ошибки: {failed}"
-                            ),
+                    for user_row in chunk:
+                        await queue.put(
+                            user_row
                         )
 
-                    except TelegramBadRequest:
-                        pass
-
-                await asyncio.sleep(
-                    BROADCAST_DELAY
+            for _ in workers:
+                await queue.put(
+                    None
                 )
 
+            await asyncio.gather(
+                *workers
+            )
+
+            await results.close()
+
             await finish_broadcast_log(
                 log_id,
-                delivered,
-                blocked,
-                failed,
+                counters["delivered"],
+                counters["blocked"],
+                counters["failed"],
                 "completed",
             )
 
             result_text = (
                 "✅ Рассылка завершена\n\n"
                 f"Всего получателей: {total}\n"
-                f"Доставлено: {delivered}\n"
-                f"Недоступны: {blocked}\n"
-                f"Другие ошибки: {failed}"
+                f"Доставлено: {counters['delivered']}\n"
+                f"Недоступны: {counters['blocked']}\n"
+                f"Другие ошибки: {counters['failed']}"
             )
 
+            progress_task.cancel()
+
             try:
                 await bot.edit_message_text(
                     chat_id=ADMIN_CHAT_ID,
@@ -2789,16 +7141,66 @@ async def run_broadcast(
                     result_text,
                 )
 
+        except asyncio.CancelledError:
+            # Остановка процесса: сохраняем прогресс,
+            # после запуска рассылка продолжится.
+            logger.warning(
+                "Рассылка %s прервана остановкой бота",
+                log_id,
+            )
+
+            for task in workers:
+                task.cancel()
+
+            await asyncio.gather(
+                *workers,
+                return_exceptions=True,
+            )
+
+            if results is not None:
+                await results.close()
+
+            await release_broadcast_recipients(
+                log_id,
+                queued_ids,
+            )
+
+            await finish_broadcast_log(
+                log_id,
+                counters["delivered"],
+                counters["blocked"],
+                counters["failed"],
+                "interrupted",
+            )
+
+            raise
+
         except Exception as exc:
             logger.exception(
                 "MASS BROADCAST ERROR"
             )
 
+            for task in workers:
+                task.cancel()
+
+            await asyncio.gather(
+                *workers,
+                return_exceptions=True,
+            )
+
+            if results is not None:
+                await results.close()
+
+            await release_broadcast_recipients(
+                log_id,
+                queued_ids,
+            )
+
             await finish_broadcast_log(
                 log_id,
-                delivered,
-                blocked,
-                failed,
+                counters["delivered"],
+                counters["blocked"],
+                counters["failed"],
                 "failed",
             )
 
@@ -2811,8 +7213,155 @@ async def run_broadcast(
             )
 
         finally:
+            for task in workers:
+                task.cancel()
+
+            if progress_task is not None:
+                progress_task.cancel()
+
             broadcast_running = False
 
+            await broadcast_lease.release()
+
+            broadcast_resume_wakeup.set()
+
+
+def start_broadcast_task(
+    broadcast_type: str,
+    source_chat_id: int | None = None,
+    source_message_id: int | None = None,
+    resume_log_id: int | None = None,
+) -> asyncio.Task:
+    task = asyncio.create_task(
+        run_broadcast(
+            broadcast_type,
+            source_chat_id,
+            source_message_id,
+            resume_log_id,
+        )
+    )
+
+    broadcast_tasks.add(
+        task
+    )
+
+    task.add_done_callback(
+        broadcast_tasks.discard
+    )
+
+    return task
+
+
+async def stop_broadcast_tasks() -> None:
+    """
+    Прерывает текущие рассылки с сохранением прогресса.
+    """
+    tasks = list(
+        broadcast_tasks
+    )
+
+    for task in tasks:
+        task.cancel()
+
+    if tasks:
+        await asyncio.gather(
+            *tasks,
+            return_exceptions=True,
+        )
+
+
+async def resume_interrupted_broadcasts() -> None:
+    """
+    Продолжает рассылки, прерванные перезапуском или падением
+    любого экземпляра бота: по таймеру и сразу после окончания
+    текущей рассылки.
+
+    Работает только у процесса, взявшего аренду рассылок.
+    Пока аренда у нас, рассылки в статусе running с чужим
+    владельцем осиротели: их вёл упавший процесс.
+    """
+    while True:
+        broadcast_resume_wakeup.clear()
+
+        try:
+            if (
+                db_pool
+                and not broadcast_lock.locked()
+                and await broadcast_lease.acquire()
+            ):
+                try:
+                    await resume_broadcasts_once()
+
+                finally:
+                    await broadcast_lease.release()
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception:
+            logger.exception(
+                "Не удалось проверить прерванные рассылки"
+            )
+
+        try:
+            await asyncio.wait_for(
+                broadcast_resume_wakeup.wait(),
+                timeout=BROADCAST_RESUME_CHECK_SECONDS,
+            )
+
+        except asyncio.TimeoutError:
+            pass
+
+
+async def resume_broadcasts_once() -> None:
+    """
+    Запускает в фоне самую старую прерванную рассылку.
+    Следующую возьмём, когда эта закончится.
+    """
+    await interrupt_orphaned_broadcasts(
+        db_pool
+    )
+
+    row = await db_pool.fetchrow(
+        """
+        SELECT
+            l.id,
+            l.broadcast_type,
+            l.source_chat_id,
+            l.source_message_id
+        FROM broadcast_logs l
+        WHERE
+            l.status = 'interrupted'
+            AND l.created_at
+                >= NOW() - make_interval(hours => $1)
+            AND EXISTS (
+                SELECT 1
+                FROM broadcast_recipients r
+                WHERE
+                    r.broadcast_id = l.id
+                    AND r.status IN ('pending', 'sending')
+            )
+        ORDER BY l.id
+        LIMIT 1
+        """,
+        BROADCAST_RESUME_HOURS,
+    )
+
+    if row is None:
+        return
+
+    logger.info(
+        "Возобновляю рассылку %s",
+        row["id"],
+    )
+
+    start_broadcast_task(
+        safe_str(row["broadcast_type"]),
+        row["source_chat_id"],
+        row["source_message_id"],
+        int(row["id"]),
+    )
+
 
 # ============================================================================
 # КОМАНДА /bonus
@@ -2886,49 +7435,51 @@ async def update_bonus_in_mini_app(
         total=15
     )
 
-    async with aiohttp.ClientSession(
-        timeout=timeout
-    ) as session:
-        async with session.post(
-            url,
-            json=request_body,
-            headers={
-                "X-Bonus-Signature":
-                    signature,
-            },
-        ) as response:
-            response_text = (
-                await response.text()
-            )
+    session = get_http_session(
+        HTTP_UPSTREAM_MINI_APP
+    )
 
-            try:
-                response_data = json.loads(
-                    response_text
-                )
+    async with session.post(
+        url,
+        json=request_body,
+        headers={
+            "X-Bonus-Signature":
+                signature,
+        },
+        timeout=timeout,
+    ) as response:
+        response_text = (
+            await response.text()
+        )
 
-            except Exception:
-                response_data = {
-                    "ok": False,
-                    "error": response_text,
-                }
+        try:
+            response_data = json.loads(
+                response_text
+            )
 
-            if (
-                response.status != 200
-                or not response_data.get(
-                    "ok"
+        except Exception:
+            response_data = {
+                "ok": False,
+                "error": response_text,
+            }
+
+        if (
+            response.status != 200
+            or not response_data.get(
+                "ok"
+            )
+        ):
+            raise RuntimeError(
+                response_data.get(
+                    "error"
                 )
-            ):
-                raise RuntimeError(
-                    response_data.get(
-                        "error"
-                    )
-                    or (
-                        "Mini App вернул ошибку "
-                        f"HTTP {response.status}"
-                    )
+                or (
+                    "Mini App вернул ошибку "
+                    f"HTTP {response.status}"
                 )
+            )
 
-            return response_data
+        return response_data
 
 
 async def save_bonus_in_bot_database(
@@ -3229,9 +7780,9 @@ async def process_bonus_amount(
             )
         )
 
-        waiting_bonus.pop(
+        await admin_states.pop(
             message.from_user.id,
-            None,
+            ADMIN_STATE_BONUS,
         )
 
     except Exception as exc:
@@ -3261,10 +7812,7 @@ async def process_bonus_amount(
 async def cmd_start(
     message: types.Message,
 ) -> None:
-    await upsert_user(
-        message.from_user
-    )
-
+    # Активность уже отмечена в UserTrackingMiddleware.
     await send_main_keyboard(
         message,
         (
@@ -3379,42 +7927,435 @@ async def open_manager_chat(
 ) -> None:
     kb = InlineKeyboardBuilder()
 
-    kb.button(
-        text="👉 Открыть чат менеджера",
-        url=MANAGER_URL,
-    )
+    kb.button(
+        text="👉 Открыть чат менеджера",
+        url=MANAGER_URL,
+    )
+
+    kb.button(
+        text="⬅️ Назад в меню",
+        callback_data="back_to_menu",
+    )
+
+    kb.adjust(1)
+
+    await message.answer(
+        "Открой чат менеджера по кнопке ниже 👇",
+        reply_markup=kb.as_markup(),
+    )
+
+
+@dp.callback_query(
+    F.data == "back_to_menu"
+)
+async def back_to_menu(
+    call: types.CallbackQuery,
+) -> None:
+    await call.message.answer(
+        "Ок. Возвращаю кнопки меню 👇",
+        reply_markup=start_keyboard(
+            call.from_user
+        ),
+    )
+
+    KEYBOARD_SHOWN_USERS.add(
+        call.from_user.id
+    )
+
+    await call.answer()
+
+
+# ============================================================================
+# ПОТОКОВАЯ ВЫГРУЗКА
+# ============================================================================
+
+class GzipPartWriter:
+    """
+    Сжимает поток байтов в gzip-файлы не больше max_bytes.
+
+    Новая часть начинается только на границе записи, поэтому
+    каждая часть — самостоятельный файл. В начало каждой части
+    пишется part_header (например, заголовок CSV).
+    """
+
+    def __init__(
+        self,
+        name_prefix: str,
+        name_suffix: str,
+        max_bytes: int = EXPORT_PART_MAX_BYTES,
+    ) -> None:
+        self.name_prefix = name_prefix
+        self.name_suffix = name_suffix
+        self.max_bytes = max_bytes
+        self.part_header = b""
+        self.paths: list[str] = []
+        self._file = None
+        self._compressor = None
+        self._size = 0
+
+    @property
+    def full(self) -> bool:
+        return (
+            self._file is not None
+            and self._size >= self.max_bytes
+        )
+
+    def _open_part(self) -> None:
+        self._file = tempfile.NamedTemporaryFile(
+            prefix=f"{self.name_prefix}.",
+            suffix=self.name_suffix,
+            delete=False,
+        )
+        self.paths.append(self._file.name)
+
+        # wbits=31 — формат gzip, а не «голый» zlib.
+        self._compressor = zlib.compressobj(
+            6,
+            zlib.DEFLATED,
+            31,
+        )
+        self._size = 0
+
+        if self.part_header:
+            self._write_compressed(
+                self.part_header
+            )
+
+    def _write_compressed(
+        self,
+        data: bytes,
+    ) -> None:
+        chunk = self._compressor.compress(data)
+
+        if chunk:
+            self._file.write(chunk)
+            self._size += len(chunk)
+
+    def _close_part(self) -> None:
+        if self._file is None:
+            return
+
+        self._file.write(
+            self._compressor.flush()
+        )
+        self._file.close()
+        self._file = None
+        self._compressor = None
+
+    def write(
+        self,
+        data: bytes,
+    ) -> None:
+        """
+        Пишет целые записи. Если текущая часть заполнена,
+        следующая запись начнёт новую часть.
+        """
+        if not data:
+            return
+
+        if self.full:
+            self._close_part()
+
+        if self._file is None:
+            self._open_part()
+
+        self._write_compressed(data)
+
+    def close(self) -> list[str]:
+        if self._file is None and not self.paths:
+            self._open_part()
+
+        self._close_part()
+
+        return self.paths
+
+    def discard(self) -> None:
+        self._close_part()
+
+        for path in self.paths:
+            try:
+                os.remove(path)
+
+            except OSError:
+                pass
+
+        self.paths = []
+
+
+class CsvRecordSplitter:
+    """
+    Режет поток CSV из COPY на целые строки с учётом
+    переводов строк внутри полей в кавычках.
+    """
+
+    def __init__(self) -> None:
+        self._pending = b""
+        self._in_quotes = False
+
+    def feed(
+        self,
+        data: bytes,
+    ) -> bytes:
+        data = self._pending + data
+        boundary = 0
+        pos = 0
+        in_quotes = self._in_quotes
+        boundary_state = in_quotes
+
+        while True:
+            quote = data.find(b'"', pos)
+            newline = data.find(b"\n", pos)
+
+            if quote == -1 and newline == -1:
+                break
+
+            if newline != -1 and (quote == -1 or newline < quote):
+                if not in_quotes:
+                    boundary = newline + 1
+                    boundary_state = in_quotes
+
+                pos = newline + 1
+
+            else:
+                in_quotes = not in_quotes
+                pos = quote + 1
+
+        self._pending = data[boundary:]
+        self._in_quotes = boundary_state
+
+        return data[:boundary]
+
+    def rest(self) -> bytes:
+        rest = self._pending
+        self._pending = b""
+        return rest
+
+
+async def copy_query_to_gzip_parts(
+    query: str,
+    *args,
+    name_prefix: str,
+) -> tuple[list[str], int]:
+    """
+    Выгружает запрос через COPY ... TO STDOUT (CSV с заголовком)
+    в gzip-части. В памяти держится только текущий фрагмент.
+    Возвращает пути к частям и число строк.
+    """
+    if not db_pool:
+        raise RuntimeError(
+            "База данных не подключена"
+        )
+
+    writer = GzipPartWriter(
+        name_prefix,
+        ".csv.gz",
+    )
+    splitter = CsvRecordSplitter()
+
+    async def consume(chunk: bytes) -> None:
+        records = splitter.feed(chunk)
+
+        if not records:
+            return
+
+        if not writer.part_header:
+            # Первая строка COPY — заголовок: повторяем его
+            # в каждой части, BOM — для Excel.
+            header_end = records.index(b"\n") + 1
+            writer.part_header = (
+                b"\xef\xbb\xbf" + records[:header_end]
+            )
+            records = records[header_end:]
+
+        writer.write(records)
+
+    try:
+        async with db_pool.acquire() as conn:
+            status = await conn.copy_from_query(
+                query,
+                *args,
+                output=consume,
+                format="csv",
+                header=True,
+            )
+
+        writer.write(splitter.rest())
+
+        return (
+            writer.close(),
+            safe_int(
+                status.split()[-1],
+                0,
+            ),
+        )
+
+    except BaseException:
+        writer.discard()
+        raise
+
+
+def export_json_value(
+    value: object,
+) -> object:
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+
+    return value
+
+
+async def cursor_query_to_gzip_parts(
+    query: str,
+    *args,
+    name_prefix: str,
+    name_suffix: str,
+    part_header: bytes,
+    encode_batch: Callable[[list[str], list[asyncpg.Record]], bytes],
+) -> tuple[list[str], int]:
+    """
+    Читает запрос серверным курсором пачками по
+    EXPORT_CURSOR_BATCH_ROWS строк и пишет их в gzip-части.
+    encode_batch получает имена колонок и пачку строк
+    и возвращает байты целых записей.
+    """
+    if not db_pool:
+        raise RuntimeError(
+            "База данных не подключена"
+        )
+
+    writer = GzipPartWriter(
+        name_prefix,
+        name_suffix,
+    )
+    writer.part_header = part_header
+    rows_count = 0
+
+    try:
+        async with db_pool.acquire() as conn:
+            # Курсор PostgreSQL живёт только внутри транзакции.
+            async with conn.transaction(
+                readonly=True,
+            ):
+                cursor = await conn.cursor(
+                    query,
+                    *args,
+                )
+
+                while True:
+                    batch = await cursor.fetch(
+                        EXPORT_CURSOR_BATCH_ROWS
+                    )
+
+                    if not batch:
+                        break
+
+                    columns = list(
+                        batch[0].keys()
+                    )
+
+                    writer.write(
+                        encode_batch(
+                            columns,
+                            batch,
+                        )
+                    )
+                    rows_count += len(batch)
+
+        return (
+            writer.close(),
+            rows_count,
+        )
+
+    except BaseException:
+        writer.discard()
+        raise
+
 
-    kb.button(
-        text="⬅️ Назад в меню",
-        callback_data="back_to_menu",
+def encode_jsonl_batch(
+    columns: list[str],
+    batch: list[asyncpg.Record],
+) -> bytes:
+    return "".join(
+        json.dumps(
+            {
+                column: export_json_value(value)
+                for column, value in zip(columns, record)
+            },
+            ensure_ascii=False,
+        )
+        + "\n"
+        for record in batch
+    ).encode(
+        "utf-8"
     )
 
-    kb.adjust(1)
 
-    await message.answer(
-        "Открой чат менеджера по кнопке ниже 👇",
-        reply_markup=kb.as_markup(),
+def encode_columnar_batch(
+    columns: list[str],
+    batch: list[asyncpg.Record],
+) -> bytes:
+    """
+    Одна группа строк: значения каждой колонки подряд.
+    """
+    return (
+        json.dumps(
+            {
+                "rows": len(batch),
+                "columns": {
+                    column: [
+                        export_json_value(record[index])
+                        for record in batch
+                    ]
+                    for index, column in enumerate(columns)
+                },
+            },
+            ensure_ascii=False,
+        )
+        + "\n"
+    ).encode(
+        "utf-8"
     )
 
 
-@dp.callback_query(
-    F.data == "back_to_menu"
-)
-async def back_to_menu(
-    call: types.CallbackQuery,
+async def send_export_parts(
+    message: types.Message,
+    paths: list[str],
+    filename: str,
+    caption: str,
 ) -> None:
-    await call.message.answer(
-        "Ок. Возвращаю кнопки меню 👇",
-        reply_markup=start_keyboard(
-            call.from_user
-        ),
-    )
+    """
+    Отправляет части выгрузки документами и удаляет файлы.
+    """
+    try:
+        for number, path in enumerate(paths, start=1):
+            base_name, _, extension = filename.partition(".")
 
-    KEYBOARD_SHOWN_USERS.add(
-        call.from_user.id
-    )
+            part_name = (
+                filename
+                if len(paths) == 1
+                else f"{base_name}.part{number}.{extension}"
+            )
 
-    await call.answer()
+            part_caption = (
+                caption
+                if len(paths) == 1
+                else f"{caption}\nЧасть {number} из {len(paths)}"
+            )
+
+            await message.answer_document(
+                FSInputFile(
+                    path,
+                    filename=part_name,
+                ),
+                caption=part_caption,
+            )
+
+    finally:
+        for path in paths:
+            try:
+                os.remove(path)
+
+            except OSError:
+                pass
 
 
 # ============================================================================
@@ -3436,7 +8377,9 @@ async def cmd_admin_help(
         (
             "🛠 Команды администратора\n\n"
 
-            "/nu4etam — общая статистика\n"
+            "/nu4etam — статистика за сегодня\n"
+
+            "/nu4etam ДАТА [ДАТА] — за день или период\n"
 
             "/users — пользователи бота\n"
 
@@ -3444,12 +8387,20 @@ async def cmd_admin_help(
 
             "/export_users — выгрузить CSV\n"
 
+            "/export_orders [ДАТА] [ДАТА] [СТАТУС] [csv|jsonl|columnar] — выгрузить заказы\n"
+
             "/broadcast — создать рекламу\n"
 
             "/broadcast_history — история рассылок\n"
 
             "/update_keyboard — обновить клавиатуру всем\n"
 
+            "/outbound_stats — очереди исходящих сообщений\n"
+
+            "/stats day|week|month — аналитика со сравнением\n"
+
+            "/stats ДАТА ДАТА — аналитика за период\n"
+
             "/bonus — установить ручную накопленную сумму\n"
 
             "/cancel — отменить текущее действие"
@@ -3505,11 +8456,13 @@ async def cmd_bonus(
 
         return
 
-    waiting_bonus[
-        message.from_user.id
-    ] = {
-        "stage": "telegram_id"
-    }
+    await admin_states.set(
+        message.from_user.id,
+        ADMIN_STATE_BONUS,
+        {
+            "stage": "telegram_id"
+        },
+    )
 
     await message.answer(
         (
@@ -3545,9 +8498,58 @@ async def cmd_daily_report(
     ):
         return
 
+    # /nu4etam, /nu4etam 2024-05-01
+    # или /nu4etam 01.05.2024 07.05.2024
+    args = (message.text or "").split()[1:]
+
+    dates = [
+        parse_report_date(arg)
+        for arg in args[:2]
+    ]
+
+    if None in dates:
+        await message.answer(
+            (
+                "Дата указана неправильно.\n"
+                "Примеры: /nu4etam 2024-05-01\n"
+                "/nu4etam 01.05.2024 07.05.2024"
+            )
+        )
+        return
+
+    start_date = dates[0] if dates else None
+    end_date = dates[1] if len(dates) > 1 else start_date
+
+    if start_date and end_date < start_date:
+        start_date, end_date = end_date, start_date
+
+    if start_date and start_date > bangkok_today():
+        await message.answer(
+            "Эта дата ещё не наступила."
+        )
+        return
+
+    if end_date:
+        end_date = min(
+            end_date,
+            bangkok_today(),
+        )
+
+    if (
+        start_date
+        and (end_date - start_date).days >= DAILY_STATS_MAX_RANGE_DAYS
+    ):
+        await message.answer(
+            f"Период не может быть длиннее {DAILY_STATS_MAX_RANGE_DAYS} дней."
+        )
+        return
+
     try:
         await message.answer(
-            await build_daily_report()
+            await build_daily_report(
+                start_date,
+                end_date,
+            )
         )
 
     except Exception:
@@ -3560,6 +8562,120 @@ async def cmd_daily_report(
         )
 
 
+@dp.message(
+    Command("stats")
+)
+async def cmd_stats(
+    message: types.Message,
+) -> None:
+    if not is_admin(
+        message.from_user.id
+    ):
+        return
+
+    periods = resolve_analytics_periods(
+        (message.text or "").split()[1:3]
+    )
+
+    if periods is None:
+        await message.answer(
+            (
+                "Период указан неправильно.\n"
+                "Примеры: /stats week\n"
+                "/stats month\n"
+                "/stats 01.05.2024 31.05.2024"
+            )
+        )
+        return
+
+    (
+        start_date,
+        end_date,
+        _,
+        _,
+    ) = periods
+
+    if (end_date - start_date).days >= DAILY_STATS_MAX_RANGE_DAYS:
+        await message.answer(
+            f"Период не может быть длиннее {DAILY_STATS_MAX_RANGE_DAYS} дней."
+        )
+        return
+
+    try:
+        await message.answer(
+            await build_analytics_report(
+                *periods
+            )
+        )
+
+    except Exception:
+        logger.exception(
+            "Ошибка формирования аналитики"
+        )
+
+        await message.answer(
+            "⚠️ Не удалось сформировать аналитику."
+        )
+
+
+@dp.message(
+    Command("outbound_stats")
+)
+async def cmd_outbound_stats(
+    message: types.Message,
+) -> None:
+    if not is_admin(
+        message.from_user.id
+    ):
+        return
+
+    snapshot = (
+        telegram_rate_governor
+        .scheduler
+        .snapshot()
+    )
+
+    titles = {
+        PRIORITY_TRANSACTIONAL: "Транзакционные",
+        PRIORITY_BULK: "Массовые",
+    }
+
+    lines = [
+        "📮 Очереди исходящих сообщений",
+        "",
+    ]
+
+    for lane in OUTBOUND_LANES:
+        metrics = snapshot[lane]
+
+        lines.append(
+            (
+                f"{titles.get(lane, lane)}:\n"
+                f"В очереди: {metrics['queued']}\n"
+                f"Ждёт дольше всех: {metrics['oldest_wait']:.2f} с\n"
+                f"Отправлено: {metrics['granted']}\n"
+                f"Среднее ожидание: {metrics['avg_wait']:.3f} с\n"
+                f"Максимальное ожидание: {metrics['max_wait']:.2f} с\n"
+            )
+        )
+
+    pause = (
+        telegram_rate_governor.paused_until
+        - time.monotonic()
+    )
+
+    if pause > 0:
+        lines.append(
+            f"⏸ Пауза по flood control: ещё {pause:.0f} с"
+        )
+
+    await message.answer(
+        "\n".join(
+            lines
+        )
+    )
+
+
 @dp.message(
     Command("users")
 )
@@ -3814,117 +8930,315 @@ async def cmd_check_user(
             f"Заблокирован: "
             f"{user['blocked_at'] or '-'}\n"
 
-            f"Последняя ошибка: "
-            f"{user['last_send_error'] or '-'}"
-        )
-    )
+            f"Последняя ошибка: "
+            f"{user['last_send_error'] or '-'}"
+        )
+    )
+
+
+@dp.message(
+    Command("export_users")
+)
+async def cmd_export_users(
+    message: types.Message,
+) -> None:
+    if not is_admin(
+        message.from_user.id
+    ):
+        return
+
+    if not db_pool:
+        return
+
+    filename = (
+        "smoke_factory_users_"
+        + datetime.now(
+            TIMEZONE
+        ).strftime(
+            "%Y%m%d_%H%M"
+        )
+        + ".csv.gz"
+    )
+
+    try:
+        paths, users_count = await copy_query_to_gzip_parts(
+            """
+            SELECT
+                telegram_id,
+                username,
+                telegram_first_name,
+                telegram_last_name,
+                profile_name,
+                phone,
+                address,
+                manual_spend,
+                bonus_updated_at,
+                bonus_updated_by,
+                is_active,
+                marketing_allowed,
+                created_at,
+                last_bot_activity_at,
+                last_broadcast_at,
+                last_keyboard_sent_at,
+                blocked_at,
+                last_send_error
+
+            FROM users
+
+            ORDER BY created_at
+            """,
+            name_prefix="users",
+        )
+
+        await send_export_parts(
+            message,
+            paths,
+            filename,
+            (
+                f"Пользователей в базе: "
+                f"{users_count}"
+            ),
+        )
+
+    except Exception:
+        logger.exception(
+            "Ошибка выгрузки пользователей"
+        )
+
+        await message.answer(
+            "⚠️ Не удалось выгрузить пользователей."
+        )
+
+
+# Заказ с позициями: одна строка на позицию,
+# заказ без позиций выгружается одной строкой.
+EXPORT_ORDERS_QUERY = """
+    SELECT
+        o.order_number,
+        o.id AS order_id,
+        o.created_at,
+        o.status,
+        o.source,
+        o.telegram_id,
+        o.customer_name,
+        o.phone,
+        o.address_plain,
+        o.payment_method,
+        o.order_date,
+        o.order_time,
+        o.items_total,
+        o.delivery_fee,
+        o.discount_percent,
+        o.discount_amount,
+        o.bonus_used,
+        o.cashback_earned,
+        o.total,
+        o.comment,
+        i.item_name,
+        i.quantity,
+        i.unit_price,
+        i.quantity * i.unit_price AS line_total
+
+    FROM orders o
+
+    LEFT JOIN order_items i
+    ON i.order_id = o.id
+
+    WHERE o.created_at >= $1
+      AND o.created_at < $2
+      AND (
+          $3::TEXT[] IS NULL
+          OR o.status = ANY($3::TEXT[])
+      )
+
+    ORDER BY
+        o.created_at,
+        o.id,
+        i.id
+"""
+
+EXPORT_ORDERS_FORMATS = (
+    "csv",
+    "jsonl",
+    "columnar",
+)
+
+# Статусы, которые бывают у заказа в orders.status.
+ORDER_STATUSES = (
+    "created",
+    "cancelled",
+)
+
+EXPORT_ORDERS_USAGE = (
+    "Примеры: /export_orders 01.05.2024 31.05.2024\n"
+    "/export_orders 2024-05-01 created jsonl\n"
+    f"Статусы: {', '.join(ORDER_STATUSES)}\n"
+    f"Форматы: {', '.join(EXPORT_ORDERS_FORMATS)}"
+)
+
+
+@dp.message(
+    Command("export_orders")
+)
+async def cmd_export_orders(
+    message: types.Message,
+) -> None:
+    if not is_admin(
+        message.from_user.id
+    ):
+        return
+
+    if not db_pool:
+        return
+
+    # /export_orders 01.05.2024 31.05.2024 created jsonl
+    # Даты, статусы (через запятую) и формат — в любом порядке.
+    dates: list[date] = []
+    statuses: list[str] | None = None
+    export_format = "csv"
+
+    for arg in (message.text or "").split()[1:]:
+        if arg.lower() in EXPORT_ORDERS_FORMATS:
+            export_format = arg.lower()
+            continue
+
+        report_date = parse_report_date(arg)
+
+        if report_date is not None and len(dates) < 2:
+            dates.append(report_date)
+            continue
+
+        arg_statuses = [
+            status
+            for status in arg.lower().split(",")
+            if status
+        ]
+
+        # Опечатка не должна молча превращаться
+        # в фильтр, который ничего не находит.
+        if (
+            report_date is not None
+            or not arg_statuses
+            or any(
+                status not in ORDER_STATUSES
+                for status in arg_statuses
+            )
+        ):
+            await message.answer(
+                (
+                    f"Неизвестный параметр: {arg}\n"
+                    f"{EXPORT_ORDERS_USAGE}"
+                )
+            )
+            return
+
+        statuses = (statuses or []) + arg_statuses
+
+    start_date = dates[0] if dates else bangkok_today()
+    end_date = dates[1] if len(dates) > 1 else start_date
 
+    if end_date < start_date:
+        start_date, end_date = end_date, start_date
 
-@dp.message(
-    Command("export_users")
-)
-async def cmd_export_users(
-    message: types.Message,
-) -> None:
-    if not is_admin(
-        message.from_user.id
-    ):
+    if (end_date - start_date).days >= EXPORT_ORDERS_MAX_RANGE_DAYS:
+        await message.answer(
+            f"Период не может быть длиннее {EXPORT_ORDERS_MAX_RANGE_DAYS} дней."
+        )
         return
 
-    if not db_pool:
-        return
+    start_utc, _ = bangkok_day_bounds(start_date)
+    _, end_utc = bangkok_day_bounds(end_date)
 
-    users = await db_pool.fetch(
-        """
-        SELECT
-            telegram_id,
-            username,
-            telegram_first_name,
-            telegram_last_name,
-            profile_name,
-            phone,
-            address,
-            manual_spend,
-            bonus_updated_at,
-            bonus_updated_by,
-            is_active,
-            marketing_allowed,
-            created_at,
-            last_bot_activity_at,
-            last_broadcast_at,
-            last_keyboard_sent_at,
-            blocked_at,
-            last_send_error
+    filename = (
+        f"smoke_factory_orders_"
+        f"{start_date:%Y%m%d}_{end_date:%Y%m%d}"
+    )
 
-        FROM users
+    period = (
+        start_date.strftime("%d.%m.%Y")
+        if start_date == end_date
+        else (
+            f"{start_date:%d.%m.%Y} — "
+            f"{end_date:%d.%m.%Y}"
+        )
+    )
 
-        ORDER BY created_at
-        """
+    await message.answer(
+        "⏳ Готовлю выгрузку заказов..."
     )
 
-    output = io.StringIO()
-
-    writer = csv.writer(
-        output
-    )
-
-    columns = [
-        "telegram_id",
-        "username",
-        "telegram_first_name",
-        "telegram_last_name",
-        "profile_name",
-        "phone",
-        "address",
-        "manual_spend",
-        "bonus_updated_at",
-        "bonus_updated_by",
-        "is_active",
-        "marketing_allowed",
-        "created_at",
-        "last_bot_activity_at",
-        "last_broadcast_at",
-        "last_keyboard_sent_at",
-        "blocked_at",
-        "last_send_error",
-    ]
+    try:
+        if export_format == "csv":
+            filename += ".csv.gz"
+
+            paths, rows_count = await copy_query_to_gzip_parts(
+                EXPORT_ORDERS_QUERY,
+                start_utc,
+                end_utc,
+                statuses,
+                name_prefix="orders",
+            )
 
-    writer.writerow(
-        columns
-    )
+        elif export_format == "jsonl":
+            filename += ".jsonl.gz"
+
+            paths, rows_count = await cursor_query_to_gzip_parts(
+                EXPORT_ORDERS_QUERY,
+                start_utc,
+                end_utc,
+                statuses,
+                name_prefix="orders",
+                name_suffix=".jsonl.gz",
+                part_header=b"",
+                encode_batch=encode_jsonl_batch,
+            )
 
-    for user in users:
-        writer.writerow(
-            [
-                user[column]
-                for column in columns
-            ]
-        )
+        else:
+            filename += ".columnar.jsonl.gz"
+
+            # Первая строка каждой части описывает формат,
+            # дальше — группы строк по колонкам.
+            paths, rows_count = await cursor_query_to_gzip_parts(
+                EXPORT_ORDERS_QUERY,
+                start_utc,
+                end_utc,
+                statuses,
+                name_prefix="orders",
+                name_suffix=".columnar.jsonl.gz",
+                part_header=(
+                    json.dumps(
+                        {
+                            "format": "columnar-row-groups",
+                            "version": 1,
+                            "row_group_size": EXPORT_CURSOR_BATCH_ROWS,
+                        }
+                    )
+                    + "\n"
+                ).encode(
+                    "utf-8"
+                ),
+                encode_batch=encode_columnar_batch,
+            )
 
-    filename = (
-        "smoke_factory_users_"
-        + datetime.now(
-            TIMEZONE
-        ).strftime(
-            "%Y%m%d_%H%M"
+        await send_export_parts(
+            message,
+            paths,
+            filename,
+            (
+                f"Заказы за {period}\n"
+                f"Статусы: {', '.join(statuses) if statuses else 'все'}\n"
+                f"Строк (позиций): {rows_count}"
+            ),
         )
-        + ".csv"
-    )
 
-    file = BufferedInputFile(
-        output.getvalue().encode(
-            "utf-8-sig"
-        ),
-        filename=filename,
-    )
+    except Exception:
+        logger.exception(
+            "Ошибка выгрузки заказов"
+        )
 
-    await message.answer_document(
-        file,
-        caption=(
-            f"Пользователей в базе: "
-            f"{len(users)}"
-        ),
-    )
+        await message.answer(
+            "⚠️ Не удалось выгрузить заказы."
+        )
 
 
 # ============================================================================
@@ -3942,22 +9256,20 @@ async def cmd_broadcast(
     ):
         return
 
-    if (
-        broadcast_running
-        or broadcast_lock.locked()
-    ):
+    if await broadcast_busy():
         await message.answer(
             "⚠️ Другая рассылка уже выполняется."
         )
         return
 
-    waiting_broadcast.add(
-        message.from_user.id
+    await admin_states.clear(
+        message.from_user.id,
+        ADMIN_STATE_PENDING_BROADCAST,
     )
 
-    pending_broadcasts.pop(
+    await admin_states.set(
         message.from_user.id,
-        None,
+        ADMIN_STATE_BROADCAST,
     )
 
     await message.answer(
@@ -3989,8 +9301,9 @@ async def callback_broadcast_confirm(
         )
         return
 
-    prepared = pending_broadcasts.get(
-        call.from_user.id
+    prepared = await admin_states.get(
+        call.from_user.id,
+        ADMIN_STATE_PENDING_BROADCAST,
     )
 
     if not prepared:
@@ -4003,16 +9316,27 @@ async def callback_broadcast_confirm(
         )
         return
 
-    if (
-        broadcast_running
-        or broadcast_lock.locked()
-    ):
+    if await broadcast_busy():
         await call.answer(
             "Другая рассылка уже выполняется.",
             show_alert=True,
         )
         return
 
+    # Повторное нажатие или другой экземпляр бота
+    # уже забрали эту рассылку.
+    prepared = await admin_states.pop(
+        call.from_user.id,
+        ADMIN_STATE_PENDING_BROADCAST,
+    )
+
+    if not prepared:
+        await call.answer(
+            "Рассылка уже запущена.",
+            show_alert=True,
+        )
+        return
+
     await call.answer(
         "Рассылка запущена"
     )
@@ -4025,25 +9349,18 @@ async def callback_broadcast_confirm(
     except TelegramBadRequest:
         pass
 
-    pending_broadcasts.pop(
-        call.from_user.id,
-        None,
-    )
-
-    asyncio.create_task(
-        run_broadcast(
-            "advertising",
-            int(
-                prepared[
-                    "source_chat_id"
-                ]
-            ),
-            int(
-                prepared[
-                    "source_message_id"
-                ]
-            ),
-        )
+    start_broadcast_task(
+        "advertising",
+        int(
+            prepared[
+                "source_chat_id"
+            ]
+        ),
+        int(
+            prepared[
+                "source_message_id"
+            ]
+        ),
     )
 
 
@@ -4058,13 +9375,10 @@ async def callback_broadcast_cancel(
     ):
         return
 
-    waiting_broadcast.discard(
-        call.from_user.id
-    )
-
-    pending_broadcasts.pop(
+    await admin_states.clear(
         call.from_user.id,
-        None,
+        ADMIN_STATE_BROADCAST,
+        ADMIN_STATE_PENDING_BROADCAST,
     )
 
     await call.answer(
@@ -4174,10 +9488,7 @@ async def cmd_update_keyboard(
     ):
         return
 
-    if (
-        broadcast_running
-        or broadcast_lock.locked()
-    ):
+    if await broadcast_busy():
         await message.answer(
             "⚠️ Другая рассылка уже выполняется."
         )
@@ -4217,10 +9528,7 @@ async def callback_keyboard_update_confirm(
         )
         return
 
-    if (
-        broadcast_running
-        or broadcast_lock.locked()
-    ):
+    if await broadcast_busy():
         await call.answer(
             "Другая рассылка уже выполняется.",
             show_alert=True,
@@ -4239,10 +9547,8 @@ async def callback_keyboard_update_confirm(
     except TelegramBadRequest:
         pass
 
-    asyncio.create_task(
-        run_broadcast(
-            "keyboard"
-        )
+    start_broadcast_task(
+        "keyboard"
     )
 
 
@@ -4332,6 +9638,17 @@ async def cb_resend_receipt(
             )
         )
 
+        try:
+            await mark_print_job_delivered(
+                order_id
+            )
+
+        except Exception:
+            logger.exception(
+                "Не удалось отметить задачу печати: order_id=%s",
+                order_id,
+            )
+
         await status_message.edit_text(
             (
                 f"✅ Чек заказа {order_number} "
@@ -4433,11 +9750,13 @@ async def cb_write_client(
         )
         return
 
-    waiting_reply[
-        call.from_user.id
-    ] = {
-        "client_id": client_id
-    }
+    await admin_states.set(
+        call.from_user.id,
+        ADMIN_STATE_REPLY,
+        {
+            "client_id": client_id
+        },
+    )
 
     await call.message.answer(
         (
@@ -4464,52 +9783,101 @@ async def cmd_cancel(
 
     admin_id = message.from_user.id
 
-    cancelled = False
+    cancelled = await admin_states.clear(
+        admin_id
+    )
 
-    if admin_id in waiting_reply:
-        waiting_reply.pop(
-            admin_id,
-            None,
+    await message.answer(
+        (
+            "✅ Действие отменено."
+            if cancelled
+            else "Нет активного действия."
         )
+    )
 
-        cancelled = True
 
-    if admin_id in waiting_broadcast:
-        waiting_broadcast.discard(
-            admin_id
-        )
+# ============================================================================
+# ЗАКАЗЫ ИЗ TELEGRAM WEB APP
+# ============================================================================
+
+async def reply_order_already_accepted(
+    message: types.Message,
+    user: types.User,
+    order_request_id: str,
+    order_number: str,
+) -> None:
+    """
+    Ответ на повторную доставку payload: заказ, бонусы
+    и печать уже обработаны при первой доставке.
+    """
+    logger.info(
+        (
+            "Повторный заказ проигнорирован: "
+            "request_id=%s order_number=%s"
+        ),
+        order_request_id,
+        order_number,
+    )
+
+    await message.answer(
+        (
+            f"📦 Ваш заказ {order_number} уже принят. "
+            "Повторно оформлять его не нужно."
+        ),
+        reply_markup=start_keyboard(user),
+    )
 
-        cancelled = True
 
-    if admin_id in pending_broadcasts:
-        pending_broadcasts.pop(
-            admin_id,
-            None,
+async def run_side_effect(
+    name: str,
+    coro,
+    timeout_seconds: float = ORDER_SIDE_EFFECT_TIMEOUT,
+) -> bool:
+    """
+    Выполняет одно побочное действие заказа со своим таймаутом.
+    Ошибка одного действия не влияет на остальные.
+    """
+    try:
+        await asyncio.wait_for(
+            coro,
+            timeout=timeout_seconds,
         )
 
-        cancelled = True
+        return True
 
-    if admin_id in waiting_bonus:
-        waiting_bonus.pop(
-            admin_id,
-            None,
+    except asyncio.TimeoutError:
+        logger.error(
+            "ORDER SIDE EFFECT TIMEOUT: %s (%ss)",
+            name,
+            timeout_seconds,
+        )
+
+    except Exception:
+        logger.exception(
+            "ORDER SIDE EFFECT FAILED: %s",
+            name,
         )
 
-        cancelled = True
+    return False
 
-    await message.answer(
-        (
-            "✅ Действие отменено."
-            if cancelled
-            else "Нет активного действия."
+
+async def run_side_effects(
+    *effects: tuple,
+) -> list[bool]:
+    """
+    Запускает независимые действия одновременно:
+    время ответа равно самому медленному из них, а не сумме.
+    """
+    return await asyncio.gather(
+        *(
+            run_side_effect(
+                *effect
+            )
+            for effect in effects
         )
     )
 
 
-# ============================================================================
-# ЗАКАЗЫ ИЗ TELEGRAM WEB APP
-# ============================================================================
-
 @dp.message(
     F.content_type
     == ContentType.WEB_APP_DATA
@@ -4551,10 +9919,6 @@ async def handle_order(
 
     client_id = user.id
 
-    await upsert_user(
-        user
-    )
-
     pay_method = safe_str(
         data.get(
             "payMethod",
@@ -4723,13 +10087,19 @@ async def handle_order(
         dict
     ] = []
 
+    # Один снимок каталога на весь заказ: горячая перезагрузка
+    # меню не может поменять цены посреди проверки.
+    catalog = menu_catalog
+
     for raw_name, info in items.items():
         if not isinstance(info, dict):
             continue
 
         name = safe_str(raw_name, "").strip()
 
-        if name not in MENU_PRICE_MAP:
+        menu_entry = catalog.lookup(name)
+
+        if menu_entry is None:
             logger.warning(
                 "ORDER REJECTED: unknown item=%r user=%s",
                 name,
@@ -4744,6 +10114,26 @@ async def handle_order(
             )
             return
 
+        (
+            authoritative_price,
+            is_available,
+        ) = menu_entry
+
+        if not is_available:
+            logger.warning(
+                "ORDER REJECTED: unavailable item=%r user=%s",
+                name,
+                client_id,
+            )
+            await message.answer(
+                (
+                    f"⚠️ Блюдо «{name}» сейчас недоступно. "
+                    "Обновите меню и оформите заказ заново."
+                ),
+                reply_markup=start_keyboard(user),
+            )
+            return
+
         qty = safe_int(info.get("qty", 0), 0)
 
         if qty < 1 or qty > 50:
@@ -4753,7 +10143,6 @@ async def handle_order(
             )
             return
 
-        authoritative_price = int(MENU_PRICE_MAP[name])
         client_price = safe_int(
             info.get("price", authoritative_price),
             authoritative_price,
@@ -4838,73 +10227,40 @@ async def handle_order(
         or data.get("order_request_id")
         or f"tg-{client_id}-{message.message_id}",
         f"tg-{client_id}-{message.message_id}",
-    )[:160]
-
-    order_number = ""
-
-    try:
-        (
-            saved_order_id,
-            order_number,
-        ) = await save_order_to_database(
-            user,
-            data,
-            order_items,
-        )
-
-        data[
-            "order_number"
-        ] = order_number
-
-        logger.info(
-            (
-                "Заказ сохранён в БД: "
-                "id=%s order_number=%s"
-            ),
-            saved_order_id,
-            order_number,
-        )
-
-    except Exception:
-        logger.exception(
-            "Не удалось сохранить заказ в БД"
-        )
-
-        await message.answer(
-            (
-                "⚠️ Произошла внутренняя ошибка сохранения заказа. "
-                "Менеджер уже получил уведомление и свяжется с вами. "
-                "Повторно оформлять заказ не нужно."
-            ),
-            reply_markup=start_keyboard(
-                user
-            ),
-        )
-
-        try:
-            await bot.send_message(
-                ADMIN_CHAT_ID,
-                (
-                    "🚨 ЗАКАЗ НЕ СОХРАНИЛСЯ В БАЗУ, "
-                    "НО ЕГО НУЖНО ОБРАБОТАТЬ ВРУЧНУЮ!\n\n"
-                    f"Telegram ID клиента: {client_id}\n"
-                    f"Имя: {data.get('name') or username}\n"
-                    f"Телефон: {phone}\n"
-                    f"Адрес: {address}\n"
-                    f"Оплата: {pay_method}\n"
-                    f"Доставка: {delivery} ฿\n"
-                    f"Состав заказа:\n{items_text}\n\n"
-                    f"Предварительный итог: {total} ฿\n\n"
-                    "Клиенту сообщено, что повторять заказ не нужно."
-                ),
-            )
-        except Exception:
-            logger.exception(
-                "Не удалось сообщить менеджеру об ошибке заказа"
-            )
+    )[:160]
+
+    order_number = ""
+
+    # --------------------------------------------------------
+    # ПОВТОРНАЯ ДОСТАВКА ТОГО ЖЕ ЗАКАЗА
+    # --------------------------------------------------------
+
+    try:
+        existing_order = await find_order_by_request_id(
+            order_request_id
+        )
+
+    except Exception:
+        # Запись заказа всё равно идемпотентна по orderRequestId.
+        logger.exception(
+            "Не удалось проверить повторную доставку заказа"
+        )
+
+        existing_order = None
 
+    if existing_order:
+        await reply_order_already_accepted(
+            message,
+            user,
+            order_request_id,
+            existing_order["order_number"],
+        )
         return
 
+    # --------------------------------------------------------
+    # СПИСАНИЕ БОНУСОВ ДО ЗАПИСИ ЗАКАЗА
+    # --------------------------------------------------------
+
     try:
         loyalty_result = await settle_loyalty_order(
             telegram_id=client_id,
@@ -4952,29 +10308,278 @@ async def handle_order(
         data["discount"] = bonus_used
         data["total"] = total
 
-        await update_saved_order_loyalty(
-            saved_order_id,
-            bonus_used,
-            cashback_percent,
-            cashback_earned,
-            total,
-            order_request_id,
-        )
-
     except Exception:
         logger.exception("LOYALTY SETTLEMENT ERROR")
-        await cancel_saved_order(saved_order_id)
 
         await message.answer(
             (
                 "⚠️ Не удалось безопасно рассчитать бонусы. "
-                "Деньги не списаны, заказ отменён. "
+                "Деньги не списаны, заказ не оформлен. "
                 "Попробуйте оформить заказ ещё раз."
             ),
             reply_markup=start_keyboard(user),
         )
         return
 
+    customer_name = safe_str(
+        data.get(
+            "name"
+        )
+        or username
+    )
+
+    # --------------------------------------------------------
+    # ДАННЫЕ ДЛЯ ЧЕКОВОЙ ПРОГРАММЫ
+    # --------------------------------------------------------
+
+    print_payload = {
+        # Единственный номер заказа.
+        # Чековая программа должна принять его,
+        # сохранить и напечатать без собственного подсчёта.
+        # Номер назначается при сохранении заказа.
+        "order_number":
+            order_number,
+
+        "orderNumber":
+            order_number,
+
+        "order_no":
+            order_number,
+
+        "orderNo":
+            order_number,
+
+        "name": customer_name,
+
+        "phone": phone,
+
+        "address": address,
+
+        "delivery": delivery,
+
+        "payment": pay_method,
+
+        "items": order_items,
+
+        # Сумма блюд до скидки.
+        "items_total":
+            items_total,
+
+        "itemsTotal":
+            items_total,
+
+        "subtotal":
+            items_total,
+
+        # Формат чековой программы.
+        "discount_percent":
+            discount_percent,
+
+        "discount_amount":
+            discount_amount,
+
+        # Дополнительные варианты
+        # для совместимости.
+        "discountPercent":
+            discount_percent,
+
+        "discountAmount":
+            discount_amount,
+
+        "discount":
+            bonus_used,
+
+        "bonus_used":
+            bonus_used,
+
+        "bonusUsed":
+            bonus_used,
+
+        "used_bonuses":
+            bonus_used,
+
+        "cashback_percent":
+            cashback_percent,
+
+        "cashback_earned":
+            cashback_earned,
+
+        "bonus_balance_after":
+            bonus_balance_after,
+
+        # Итог после списания бонусов
+        # и с доставкой.
+        "total": total,
+
+        "date": datetime.now(
+            TIMEZONE
+        ).strftime(
+            "%Y-%m-%d %H:%M:%S"
+        ),
+
+        "order_time":
+            when_str,
+
+        "order_when":
+            safe_str(
+                data.get(
+                    "orderWhen"
+                )
+            ),
+
+        "comment":
+            comment,
+
+        "comments":
+            comment,
+
+        "comment_text":
+            comment,
+
+        "note":
+            comment,
+
+        "notes":
+            comment,
+    }
+
+    # --------------------------------------------------------
+    # ЗАПИСЬ ГОТОВОГО ЗАКАЗА
+    # --------------------------------------------------------
+
+    saved_order = None
+
+    for attempt in range(1, ORDER_SAVE_ATTEMPTS + 1):
+        try:
+            saved_order = await save_order_to_database(
+                user,
+                data,
+                order_items,
+                order_request_id,
+                print_payload,
+            )
+            break
+
+        except Exception:
+            logger.exception(
+                "Не удалось сохранить заказ в БД: attempt=%s request_id=%s",
+                attempt,
+                order_request_id,
+            )
+
+            if attempt < ORDER_SAVE_ATTEMPTS:
+                await asyncio.sleep(attempt)
+
+    if saved_order is None:
+        # Бонусы уже списаны по orderRef, а откатить списание
+        # через Mini App нельзя — заказ и бонусы сверяет менеджер.
+        await message.answer(
+            (
+                "⚠️ Произошла внутренняя ошибка сохранения заказа. "
+                "Менеджер уже получил уведомление и свяжется с вами. "
+                "Повторно оформлять заказ не нужно."
+            ),
+            reply_markup=start_keyboard(
+                user
+            ),
+        )
+
+        try:
+            await bot.send_message(
+                ADMIN_CHAT_ID,
+                (
+                    "🚨 ЗАКАЗ НЕ СОХРАНИЛСЯ В БАЗУ, "
+                    "НО ЕГО НУЖНО ОБРАБОТАТЬ ВРУЧНУЮ!\n\n"
+                    f"Telegram ID клиента: {client_id}\n"
+                    f"Имя: {customer_name}\n"
+                    f"Телефон: {phone}\n"
+                    f"Адрес: {address}\n"
+                    f"Оплата: {pay_method}\n"
+                    f"Доставка: {delivery} ฿\n"
+                    f"Состав заказа:\n{items_text}\n\n"
+                    f"Списано бонусов: {bonus_used} ฿\n"
+                    f"Начислено кэшбэка: {cashback_earned} ฿\n"
+                    f"Итог: {total} ฿\n"
+                    f"orderRef: {order_request_id}\n\n"
+                    "Бонусы по этому orderRef уже проведены в Mini App. "
+                    "Клиенту сообщено, что повторять заказ не нужно."
+                ),
+            )
+        except Exception:
+            logger.exception(
+                "Не удалось сообщить менеджеру об ошибке заказа"
+            )
+
+        return
+
+    (
+        saved_order_id,
+        order_number,
+        order_created,
+    ) = saved_order
+
+    if not order_created:
+        # Параллельная доставка того же payload
+        # успела записать заказ первой.
+        await reply_order_already_accepted(
+            message,
+            user,
+            order_request_id,
+            order_number,
+        )
+        return
+
+    data[
+        "order_number"
+    ] = order_number
+
+    for key in (
+        "order_number",
+        "orderNumber",
+        "order_no",
+        "orderNo",
+    ):
+        print_payload[key] = order_number
+
+    logger.info(
+        (
+            "Заказ сохранён в БД: "
+            "id=%s order_number=%s"
+        ),
+        saved_order_id,
+        order_number,
+    )
+
+    logger.info(
+        (
+            "PRINT PAYLOAD: "
+            "order_number=%s "
+            "discount_percent=%s "
+            "discount_amount=%s "
+            "items_total=%s "
+            "delivery=%s "
+            "total=%s"
+        ),
+        print_payload[
+            "order_number"
+        ],
+        print_payload[
+            "discount_percent"
+        ],
+        print_payload[
+            "discount_amount"
+        ],
+        print_payload[
+            "items_total"
+        ],
+        print_payload[
+            "delivery"
+        ],
+        print_payload[
+            "total"
+        ],
+    )
+
     # --------------------------------------------------------
     # СООБЩЕНИЕ КЛИЕНТУ
     # --------------------------------------------------------
@@ -5029,35 +10634,17 @@ async def handle_order(
         )
 
     client_text += (
-        f"Доставка: "
-        f"{delivery} ฿\n"
-
-        f"💰 Итого: "
-        f"{total} ฿"
-    )
-
-    await message.answer(
-        client_text,
-        reply_markup=start_keyboard(
-            user
-        ),
-    )
+        f"Доставка: "
+        f"{delivery} ฿\n"
 
-    KEYBOARD_SHOWN_USERS.add(
-        client_id
+        f"💰 Итого: "
+        f"{total} ฿"
     )
 
     # --------------------------------------------------------
     # СООБЩЕНИЕ МЕНЕДЖЕРУ
     # --------------------------------------------------------
 
-    customer_name = safe_str(
-        data.get(
-            "name"
-        )
-        or username
-    )
-
     admin_text = (
         f"✅ <b>Новый заказ {order_number}</b>\n"
 
@@ -5124,209 +10711,51 @@ async def handle_order(
         f"{total} ฿"
     )
 
-    try:
-        await send_order_to_admin(
-            admin_text,
-            client_id,
-            saved_order_id,
-        )
-
-    except Exception:
-        logger.exception(
-            (
-                "ADMIN send failed окончательно, "
-                "даже без profile кнопки"
-            )
-        )
-
     # --------------------------------------------------------
-    # ДАННЫЕ ДЛЯ ЧЕКОВОЙ ПРОГРАММЫ
+    # ПОСЛЕ СОХРАНЕНИЯ: ВСЁ ПАРАЛЛЕЛЬНО
     # --------------------------------------------------------
 
-    print_payload = {
-        # Единственный номер заказа.
-        # Чековая программа должна принять его,
-        # сохранить и напечатать без собственного подсчёта.
-        "order_number":
-            order_number,
-
-        "orderNumber":
-            order_number,
-
-        "order_no":
-            order_number,
-
-        "orderNo":
-            order_number,
-
-        "name": customer_name,
-
-        "phone": phone,
-
-        "address": address,
-
-        "delivery": delivery,
-
-        "payment": pay_method,
-
-        "items": order_items,
-
-        # Сумма блюд до скидки.
-        "items_total":
-            items_total,
-
-        "itemsTotal":
-            items_total,
-
-        "subtotal":
-            items_total,
-
-        # Формат чековой программы.
-        "discount_percent":
-            discount_percent,
-
-        "discount_amount":
-            discount_amount,
-
-        # Дополнительные варианты
-        # для совместимости.
-        "discountPercent":
-            discount_percent,
-
-        "discountAmount":
-            discount_amount,
-
-        "discount":
-            bonus_used,
-
-        "bonus_used":
-            bonus_used,
-
-        "bonusUsed":
-            bonus_used,
-
-        "used_bonuses":
-            bonus_used,
-
-        "cashback_percent":
-            cashback_percent,
-
-        "cashback_earned":
-            cashback_earned,
-
-        "bonus_balance_after":
-            bonus_balance_after,
-
-        # Итог после списания бонусов
-        # и с доставкой.
-        "total": total,
-
-        "date": datetime.now(
-            TIMEZONE
-        ).strftime(
-            "%Y-%m-%d %H:%M:%S"
-        ),
-
-        "order_time":
-            when_str,
-
-        "order_when":
-            safe_str(
-                data.get(
-                    "orderWhen"
-                )
-            ),
-
-        "comment":
-            comment,
-
-        "comments":
-            comment,
-
-        "comment_text":
-            comment,
-
-        "note":
-            comment,
-
-        "notes":
-            comment,
-    }
-
-    logger.info(
-        (
-            "PRINT PAYLOAD: "
-            "order_number=%s "
-            "discount_percent=%s "
-            "discount_amount=%s "
-            "items_total=%s "
-            "delivery=%s "
-            "total=%s"
-        ),
-        print_payload[
-            "order_number"
-        ],
-        print_payload[
-            "discount_percent"
-        ],
-        print_payload[
-            "discount_amount"
-        ],
-        print_payload[
-            "items_total"
-        ],
-        print_payload[
-            "delivery"
-        ],
-        print_payload[
-            "total"
-        ],
-    )
-
-    try:
-        (
-            print_status,
-            print_response,
-        ) = await send_payload_to_receipt_program(
-            print_payload,
-            timeout_seconds=7,
-        )
+    # Чек уже поставлен в очередь печати вместе с заказом.
 
-        logger.info(
-            (
-                "Печать отправлена: "
-                "HTTP %s, ответ: %s"
+    async def confirm_to_client() -> None:
+        await message.answer(
+            client_text,
+            reply_markup=start_keyboard(
+                user
             ),
-            print_status,
-            print_response[:500],
         )
 
-    except Exception as exc:
-        logger.exception(
-            (
-                "PRINT DELIVERY FAILED (NON-FATAL). "
-                "Заказ уже сохранён в базе и отправлен менеджеру. "
-                "Чек можно дослать кнопкой «🧾 Отправить чек»."
-            )
+        KEYBOARD_SHOWN_USERS.add(
+            client_id
         )
 
+    async def notify_admin() -> None:
         try:
-            await bot.send_message(
-                ADMIN_CHAT_ID,
-                (
-                    f"⚠️ Заказ {order_number} принят, "
-                    "но чековая программа сейчас недоступна.\n\n"
-                    "Заказ НЕ потерян. Нажмите кнопку "
-                    "«🧾 Отправить чек» под заказом после "
-                    "восстановления связи.\n\n"
-                    f"Ошибка: {safe_str(exc)[:500]}"
-                ),
+            await send_order_to_admin(
+                admin_text,
+                client_id,
+                saved_order_id,
             )
+
         except Exception:
             logger.exception(
-                "Не удалось отправить менеджеру предупреждение о печати"
+                (
+                    "ADMIN send failed окончательно, "
+                    "даже без profile кнопки"
+                )
             )
 
+    await run_side_effects(
+        (
+            "client confirmation",
+            confirm_to_client(),
+        ),
+        (
+            "admin notification",
+            notify_admin(),
+        ),
+    )
+
 
 # ============================================================================
 # СООБЩЕНИЯ АДМИНИСТРАТОРА
@@ -5349,13 +10778,17 @@ async def admin_message_router(
     ):
         return
 
+    states = await admin_states.get_all(
+        admin_id
+    )
+
     # --------------------------------------------------------
     # /bonus
     # --------------------------------------------------------
 
-    if admin_id in waiting_bonus:
-        state = waiting_bonus[
-            admin_id
+    if ADMIN_STATE_BONUS in states:
+        state = states[
+            ADMIN_STATE_BONUS
         ]
 
         if not message.text:
@@ -5435,6 +10868,12 @@ async def admin_message_router(
                 "stage"
             ] = "amount"
 
+            await admin_states.set(
+                admin_id,
+                ADMIN_STATE_BONUS,
+                state,
+            )
+
             known_user = None
 
             if db_pool:
@@ -5563,18 +11002,26 @@ async def admin_message_router(
     # Ответ клиенту
     # --------------------------------------------------------
 
-    if admin_id in waiting_reply:
+    if ADMIN_STATE_REPLY in states:
         if not message.text:
             await message.answer(
                 "Для ответа клиенту отправь текст."
             )
             return
 
-        client_id = waiting_reply.pop(
-            admin_id
-        )[
-            "client_id"
-        ]
+        reply_state = await admin_states.pop(
+            admin_id,
+            ADMIN_STATE_REPLY,
+        )
+
+        if not reply_state:
+            return
+
+        client_id = int(
+            reply_state[
+                "client_id"
+            ]
+        )
 
         try:
             await bot.send_message(
@@ -5623,20 +11070,23 @@ async def admin_message_router(
     # Рекламная рассылка
     # --------------------------------------------------------
 
-    if admin_id in waiting_broadcast:
-        waiting_broadcast.discard(
-            admin_id
+    if ADMIN_STATE_BROADCAST in states:
+        await admin_states.pop(
+            admin_id,
+            ADMIN_STATE_BROADCAST,
         )
 
-        pending_broadcasts[
-            admin_id
-        ] = {
-            "source_chat_id":
-                message.chat.id,
+        await admin_states.set(
+            admin_id,
+            ADMIN_STATE_PENDING_BROADCAST,
+            {
+                "source_chat_id":
+                    message.chat.id,
 
-            "source_message_id":
-                message.message_id,
-        }
+                "source_message_id":
+                    message.message_id,
+            },
+        )
 
         target_count = (
             await get_broadcast_target_count(
@@ -5666,9 +11116,9 @@ async def admin_message_router(
             )
 
         except Exception as exc:
-            pending_broadcasts.pop(
+            await admin_states.pop(
                 admin_id,
-                None,
+                ADMIN_STATE_PENDING_BROADCAST,
             )
 
             logger.exception(
@@ -5726,38 +11176,103 @@ async def main() -> None:
         WEBAPP_URL,
     )
 
-    try:
-        await bot.delete_webhook(
-            drop_pending_updates=True
-        )
+    logger.info(
+        "BOT_MODE=%s",
+        BOT_MODE,
+    )
 
-    except Exception as exc:
-        logger.error(
-            "delete_webhook error: %s",
-            exc,
-        )
+    if BOT_MODE != "webhook":
+        try:
+            await bot.delete_webhook(
+                drop_pending_updates=True
+            )
+
+        except Exception as exc:
+            logger.error(
+                "delete_webhook error: %s",
+                exc,
+            )
 
     await init_database()
 
-    run_fake_server(
+    open_http_sessions()
+
+    start_user_activity_buffer()
+
+    start_print_outbox()
+
+    await start_menu_catalog()
+
+    start_admin_state_sweeper()
+
+    start_daily_stats()
+
+    await start_web_server(
         PORT
     )
 
-    schedule_restart()
+    start_restart_watchdog()
+
+    resume_task = asyncio.create_task(
+        resume_interrupted_broadcasts()
+    )
 
     logger.info(
         "Бот запущен и готов сохранять пользователей"
     )
 
     try:
-        await dp.start_polling(
-            bot
-        )
+        if BOT_MODE == "webhook":
+            await run_webhook()
+
+        else:
+            await dp.start_polling(
+                bot
+            )
 
     finally:
+        await stop_restart_watchdog()
+
+        # Новые обновления уже не принимаются; начатые заказы
+        # и ответы доводим до конца, но не дольше дедлайна.
+        drain_deadline = time.monotonic() + RESTART_DRAIN_SECONDS
+
+        if not await in_flight_updates.drain(
+            RESTART_DRAIN_SECONDS
+        ):
+            logger.warning(
+                "Не дождались завершения обработчиков: %s",
+                in_flight_updates.count,
+            )
+
+        # /healthz отвечает, пока идёт drain; дальше новые
+        # обновления webhook получат отказ соединения.
+        await stop_web_server()
+
+        resume_task.cancel()
+
+        # Рассылки сохраняют прогресс и продолжатся после запуска.
+        await stop_broadcast_tasks()
+
+        await stop_print_outbox(
+            max(0.0, drain_deadline - time.monotonic())
+        )
+
+        await stop_menu_catalog()
+
+        await stop_admin_state_sweeper()
+
+        await stop_daily_stats()
+
+        await stop_user_activity_buffer()
+
         if db_pool:
             await db_pool.close()
 
+        await close_http_sessions()
+
+        await telegram_rate_governor.scheduler.close()
+
         await bot.session.close()
 
 
@@ -5765,3 +11280,6 @@ if __name__ == "__main__":
     asyncio.run(
         main()
     )
+
+    if restart_reason:
+        restart_process()
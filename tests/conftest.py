@@ -0,0 +1,46 @@
+import os
+import sys
+
+import pytest
+
+
+# bot.py при импорте требует токен и строку подключения,
+# но к базе и Telegram не обращается.
+BOT_IMPORT_ENV = {
+    "TELEGRAM_BOT_TOKEN": "123456:TEST",
+    "DATABASE_URL": "postgresql://localhost/test",
+}
+
+
+@pytest.fixture(scope="session")
+def bot_module():
+    pytest.importorskip("asyncpg")
+    pytest.importorskip("aiogram")
+
+    added = [
+        name
+        for name in BOT_IMPORT_ENV
+        if name not in os.environ
+    ]
+
+    for name in added:
+        os.environ[name] = BOT_IMPORT_ENV[name]
+
+    sys.path.insert(
+        0,
+        os.path.dirname(
+            os.path.dirname(
+                os.path.abspath(__file__)
+            )
+        ),
+    )
+
+    try:
+        import bot
+
+    finally:
+        # Тесты с настоящей базой смотрят на DATABASE_URL сами.
+        for name in added:
+            os.environ.pop(name, None)
+
+    return bot
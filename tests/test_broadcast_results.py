@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+
+class SlowPool:
+    """
+    Заменяет db_pool: execute висит, пока его не отменят.
+    """
+
+    def __init__(self) -> None:
+        self.started = asyncio.Event()
+
+    async def execute(self, *args) -> None:
+        self.started.set()
+        await asyncio.sleep(3600)
+
+
+def test_cancelled_flush_keeps_rows(
+    bot_module,
+    monkeypatch,
+) -> None:
+    async def scenario() -> list[tuple]:
+        pool = SlowPool()
+
+        monkeypatch.setattr(
+            bot_module,
+            "db_pool",
+            pool,
+        )
+
+        results = bot_module.BroadcastResultBuffer(
+            "broadcast",
+            1,
+            batch_size=100,
+        )
+
+        await results.add(101, True)
+        await results.add(102, False, "blocked", True)
+
+        flush = asyncio.create_task(
+            results.flush()
+        )
+
+        await pool.started.wait()
+
+        flush.cancel()
+
+        with pytest.raises(asyncio.CancelledError):
+            await flush
+
+        return results._rows
+
+    rows = asyncio.run(
+        scenario()
+    )
+
+    assert [row[0] for row in rows] == [101, 102]
+    assert rows[1][2] is True
@@ -0,0 +1,70 @@
+import asyncio
+from datetime import timedelta
+
+
+class EmptyPool:
+    async def fetch(self, *args) -> list:
+        return []
+
+
+def test_long_missing_range_is_backfilled_in_background(
+    bot_module,
+    monkeypatch,
+) -> None:
+    refreshed: list = []
+
+    async def fake_refresh_daily_stats(
+        stat_date,
+        final: bool = False,
+    ) -> dict:
+        refreshed.append(stat_date)
+        return {"stat_date": stat_date}
+
+    monkeypatch.setattr(
+        bot_module,
+        "db_pool",
+        EmptyPool(),
+    )
+
+    monkeypatch.setattr(
+        bot_module,
+        "refresh_daily_stats",
+        fake_refresh_daily_stats,
+    )
+
+    async def scenario() -> None:
+        today = bot_module.bangkok_today()
+        start = today - timedelta(days=30)
+        end = today - timedelta(days=1)
+
+        rows, pending = await bot_module.load_daily_stats(
+            start,
+            end,
+        )
+
+        # Обработчик ничего не считает сам.
+        assert rows == []
+        assert pending == 30
+        assert refreshed == []
+
+        await bot_module.daily_stats_backfill_task
+
+        assert refreshed == sorted(refreshed)
+        assert len(refreshed) == 30
+        assert not bot_module.daily_stats_backfill_days
+
+        refreshed.clear()
+
+        rows, pending = await bot_module.load_daily_stats(
+            today - timedelta(days=2),
+            today,
+        )
+
+        # Короткий период досчитывается сразу.
+        assert pending == 0
+        assert len(rows) == 3
+        assert len(refreshed) == 3
+
+    asyncio.run(
+        scenario()
+    )
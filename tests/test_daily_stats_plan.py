@@ -0,0 +1,122 @@
+"""
+План запроса daily_stats: каждая таблица читается ровно один раз.
+
+Нужна настоящая база PostgreSQL в DATABASE_URL. Миграции
+применяются внутри транзакции, которая затем откатывается.
+"""
+
+import asyncio
+import json
+import os
+import sys
+from datetime import date
+
+import pytest
+
+
+if not os.getenv("DATABASE_URL"):
+    pytest.skip(
+        "DATABASE_URL не задан",
+        allow_module_level=True,
+    )
+
+pytest.importorskip("asyncpg")
+pytest.importorskip("aiogram")
+
+# bot.py без токена завершает процесс при импорте.
+os.environ.setdefault(
+    "TELEGRAM_BOT_TOKEN",
+    "123456:TEST",
+)
+
+sys.path.insert(
+    0,
+    os.path.dirname(
+        os.path.dirname(
+            os.path.abspath(__file__)
+        )
+    ),
+)
+
+import asyncpg  # noqa: E402
+
+import bot  # noqa: E402
+
+
+def collect_scans(
+    node: dict,
+    scans: dict[str, int],
+) -> None:
+    # Bitmap Index Scan не несёт имени таблицы: таблицу
+    # читает парный Bitmap Heap Scan, его и считаем.
+    if "Scan" in node["Node Type"] and "Relation Name" in node:
+        relation = node["Relation Name"]
+        scans[relation] = scans.get(relation, 0) + 1
+
+    for child in node.get("Plans", ()):
+        collect_scans(
+            child,
+            scans,
+        )
+
+
+async def explain_rollup(
+    final: bool,
+) -> dict[str, int]:
+    conn = await asyncpg.connect(
+        os.environ["DATABASE_URL"]
+    )
+
+    transaction = conn.transaction()
+    await transaction.start()
+
+    try:
+        await bot.apply_migrations(
+            conn
+        )
+
+        start_utc, end_utc = bot.bangkok_day_bounds(
+            date(2024, 5, 1)
+        )
+
+        plan = json.loads(
+            await conn.fetchval(
+                "EXPLAIN (FORMAT JSON) " + bot.DAILY_STATS_ROLLUP_SQL,
+                date(2024, 5, 1),
+                start_utc,
+                end_utc,
+                final,
+            )
+        )
+
+    finally:
+        await transaction.rollback()
+        await conn.close()
+
+    scans: dict[str, int] = {}
+
+    collect_scans(
+        plan[0]["Plan"],
+        scans,
+    )
+
+    return scans
+
+
+@pytest.mark.parametrize(
+    "final",
+    [False, True],
+)
+def test_rollup_reads_each_table_once(
+    final: bool,
+) -> None:
+    scans = asyncio.run(
+        explain_rollup(final)
+    )
+
+    assert scans.get("users") == 1
+    assert scans.get("visits") == 1
+    assert scans.get("orders") == 1
+
+    # Позиции заказов для итогов дня не нужны.
+    assert "order_items" not in scans
@@ -0,0 +1,72 @@
+import asyncio
+
+
+def test_concurrent_acquire_then_single_release(
+    bot_module,
+    monkeypatch,
+) -> None:
+    released: list[str] = []
+
+    async def slow_try_acquire_lease(
+        name: str,
+        ttl_seconds: float,
+    ) -> bool:
+        # Оба acquire успевают дойти до базы одновременно.
+        await asyncio.sleep(0.01)
+        return True
+
+    async def fake_release_lease(
+        name: str,
+    ) -> None:
+        released.append(name)
+
+    monkeypatch.setattr(
+        bot_module,
+        "try_acquire_lease",
+        slow_try_acquire_lease,
+    )
+
+    monkeypatch.setattr(
+        bot_module,
+        "release_lease",
+        fake_release_lease,
+    )
+
+    async def scenario() -> None:
+        lease = bot_module.Lease(
+            "test",
+            ttl_seconds=30,
+            renew_seconds=3600,
+        )
+
+        first, second = await asyncio.gather(
+            lease.acquire(),
+            lease.acquire(),
+        )
+
+        assert first and second
+
+        renew_task = lease._renew_task
+
+        await lease.release()
+
+        # Второй держатель ещё работает: аренда не отпущена,
+        # продление не остановлено.
+        assert lease.held
+        assert released == []
+        assert lease._renew_task is renew_task
+        assert not renew_task.done()
+
+        await lease.release()
+
+        assert not lease.held
+        assert released == ["test"]
+        assert lease._renew_task is None
+
+        await asyncio.sleep(0)
+
+        assert renew_task.cancelled()
+
+    asyncio.run(
+        scenario()
+    )